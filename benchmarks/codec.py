@@ -0,0 +1,96 @@
+"""
+Benchmark the per-frame CPU time of the JPEG work on the stream, inference and capture paths.
+
+    python -m benchmarks.codec --frames-dir media/snapshots --output codec.json
+
+Compares the PIL decode and re-encode the raw stream used to do per viewer with passing
+the frame through, a full decode with the DCT-scaled decodes at 1/2, 1/4 and 1/8, and
+OpenCV's default encode with the codec's quality and subsampling. Runs without a server.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from io import BytesIO
+
+from benchmarks.publisher import DEFAULT_FRAMES_DIR, load_frames
+
+
+def measure(frames, work, repeat):
+    """Mean CPU milliseconds of work(frame) over every frame, repeat times"""
+    started = time.process_time()
+    for _ in range(repeat):
+        for frame in frames:
+            work(frame)
+    return (time.process_time() - started) * 1000 / (repeat * len(frames))
+
+
+def pil_reencode(frame):
+    from PIL import Image
+
+    image = Image.open(BytesIO(frame))
+    output = BytesIO()
+    image.save(output, "JPEG")
+    return output.getvalue()
+
+
+def run(frames, backend, repeat):
+    import cv2
+
+    from stream_api.jpeg import DEFAULTS, SCALES, Codec, create_backend, jpeg_size
+
+    codec = Codec(create_backend(backend), DEFAULTS)
+    images = [codec.decode(frame) for frame in frames]
+    results = {
+        "backend": codec.backend.name,
+        "stream_ms": {
+            "pil_reencode": measure(frames, pil_reencode, repeat),
+            "pass_through": measure(frames, jpeg_size, repeat),
+        },
+        "decode_ms": {f"1/{scale}": measure(frames, lambda frame, scale=scale: codec.decode(frame, scale), repeat)
+                      for scale in SCALES},
+        "encode_ms": {},
+        "encoded_bytes": {},
+    }
+
+    encoders = {
+        "opencv_default": lambda image: cv2.imencode(".jpg", image)[1].tobytes(),
+        f"codec_q{DEFAULTS['QUALITY']}_{DEFAULTS['SUBSAMPLING']}": codec.encode,
+    }
+    for name, encode in encoders.items():
+        results["encode_ms"][name] = measure(images, encode, repeat)
+        results["encoded_bytes"][name] = sum(len(encode(image)) for image in images) // len(images)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames-dir", default=DEFAULT_FRAMES_DIR)
+    parser.add_argument("--backend", choices=("auto", "turbojpeg", "opencv"), default="auto")
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the frames per measurement")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    frames = load_frames(args.frames_dir)
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+        "frames": len(frames),
+        "results": run(frames, args.backend, args.repeat),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
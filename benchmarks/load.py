@@ -0,0 +1,153 @@
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+
+BOUNDARY = b"--frame\r\n"
+
+
+def percentiles(values):
+    """Summarise latencies in seconds as milliseconds"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(q):
+        return round(1000 * values[min(len(values) - 1, int(q * len(values)))], 2)
+
+    return {
+        "p50_ms": pick(0.5),
+        "p90_ms": pick(0.9),
+        "p99_ms": pick(0.99),
+        "max_ms": round(1000 * values[-1], 2),
+        "mean_ms": round(1000 * sum(values) / len(values), 2),
+    }
+
+
+def open_connection(base_url, timeout=30):
+    parts = urlsplit(base_url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    return connection_class(parts.hostname, parts.port, timeout=timeout)
+
+
+class MjpegViewer:
+    """
+    Simulated viewer of a multipart MJPEG endpoint that counts whole frames as they arrive
+    """
+    def __init__(self, base_url, path):
+        self.base_url = base_url
+        self.path = path
+        self.frames = 0
+        self.bytes = 0
+        self.intervals = []
+        self.first_frame_latency = None
+        self.error = None
+
+    def run(self, stop_event):
+        started = time.perf_counter()
+        connection = open_connection(self.base_url)
+        try:
+            connection.request("GET", self.path)
+            response = connection.getresponse()
+            if response.status != 200:
+                raise Exception(f"HTTP {response.status}")
+
+            buffer = b""
+            last_frame = None
+            while not stop_event.is_set():
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                self.bytes += len(chunk)
+                buffer += chunk
+
+                # Every boundary after the first one closes a whole frame
+                while True:
+                    start = buffer.find(BOUNDARY)
+                    end = buffer.find(BOUNDARY, start + len(BOUNDARY)) if start >= 0 else -1
+                    if end < 0:
+                        break
+                    buffer = buffer[end:]
+                    now = time.perf_counter()
+                    if last_frame is None:
+                        self.first_frame_latency = now - started
+                    else:
+                        self.intervals.append(now - last_frame)
+                    last_frame = now
+                    self.frames += 1
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            connection.close()
+
+
+def run_viewers(base_url, path, count, duration):
+    """Run concurrent MJPEG viewers for a fixed duration and summarise what they received"""
+    stop_event = threading.Event()
+    viewers = [MjpegViewer(base_url, path) for _ in range(count)]
+    threads = [threading.Thread(target=viewer.run, args=(stop_event,), daemon=True) for viewer in viewers]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop_event.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    intervals = [interval for viewer in viewers for interval in viewer.intervals]
+    first_frames = [viewer.first_frame_latency for viewer in viewers if viewer.first_frame_latency is not None]
+    return {
+        "path": path,
+        "viewers": count,
+        "duration_s": duration,
+        "frames": sum(viewer.frames for viewer in viewers),
+        "fps_per_viewer": round(sum(viewer.frames for viewer in viewers) / count / duration, 2),
+        "bytes_per_viewer_per_s": round(sum(viewer.bytes for viewer in viewers) / count / duration),
+        "frame_interval": percentiles(intervals),
+        "first_frame": percentiles(first_frames),
+        "errors": [viewer.error for viewer in viewers if viewer.error],
+    }
+
+
+def run_requests(base_url, method, path, count, concurrency, body=None):
+    """Send count requests with the given concurrency and summarise their latency"""
+    payload = json.dumps(body).encode() if body is not None else None
+    headers = {"Content-Type": "application/json"} if payload is not None else {}
+    local = threading.local()
+
+    def send(_):
+        if getattr(local, "connection", None) is None:
+            local.connection = open_connection(base_url)
+        started = time.perf_counter()
+        try:
+            local.connection.request(method, path, body=payload, headers=headers)
+            response = local.connection.getresponse()
+            size = len(response.read())
+            return time.perf_counter() - started, response.status, size
+        except Exception as e:
+            local.connection.close()
+            local.connection = None
+            return time.perf_counter() - started, str(e), 0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(count)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, outcome, _ in results if isinstance(outcome, int) and outcome < 400]
+    errors = {}
+    for _, outcome, _ in results:
+        if not (isinstance(outcome, int) and outcome < 400):
+            errors[str(outcome)] = errors.get(str(outcome), 0) + 1
+    return {
+        "method": method,
+        "path": path,
+        "requests": count,
+        "concurrency": concurrency,
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency": percentiles(latencies),
+        "response_bytes_mean": round(sum(size for _, _, size in results) / count),
+        "errors": errors,
+    }
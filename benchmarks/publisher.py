@@ -0,0 +1,93 @@
+import glob
+import itertools
+import os
+import threading
+import time
+
+
+DEFAULT_FRAMES_DIR = os.path.join("media", "snapshots")
+
+
+def load_frames(frames_dir=DEFAULT_FRAMES_DIR):
+    """Load every JPEG of a directory in a stable order"""
+    paths = sorted(glob.glob(os.path.join(frames_dir, "*.jpg")))
+    if not paths:
+        raise FileNotFoundError(f"No JPEG frames found in {frames_dir}")
+    frames = []
+    for path in paths:
+        with open(path, "rb") as f:
+            frames.append(f.read())
+    return frames
+
+
+class FramePublisher:
+    """
+    Replays JPEG frames at a fixed fps, the same way the drone feed reaches the server.
+
+    'file' mode overwrites image.jpg like receive_stream.py does, 'websocket' mode sends
+    the frames to a running receive_stream.py instead.
+    """
+    def __init__(self, frames, fps=10.0, mode="file", image_path="image.jpg", websocket_url="ws://127.0.0.1:3001"):
+        self.frames = frames
+        self.fps = fps
+        self.mode = mode
+        self.image_path = image_path
+        self.websocket_url = websocket_url
+        self.published = 0
+        self.late = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="frame-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        send = self._open_sender()
+        interval = 1.0 / self.fps
+        next_time = time.perf_counter()
+        try:
+            for frame in itertools.cycle(self.frames):
+                if self._stop.is_set():
+                    break
+                send(frame)
+                self.published += 1
+
+                next_time += interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    self._stop.wait(delay)
+                else:
+                    # Can't keep up, don't try to catch up with a burst
+                    self.late += 1
+                    next_time = time.perf_counter()
+        finally:
+            close = getattr(send, "close", None)
+            if close is not None:
+                close()
+
+    def _open_sender(self):
+        if self.mode == "file":
+            def write(frame):
+                with open(self.image_path, "wb") as f:
+                    f.write(frame)
+            return write
+
+        if self.mode == "websocket":
+            from websockets.sync.client import connect
+            connection = connect(self.websocket_url, max_size=None)
+
+            class Sender:
+                def __call__(self, frame):
+                    connection.send(frame)
+
+                def close(self):
+                    connection.close()
+            return Sender()
+
+        raise ValueError(f"Unknown publisher mode: {self.mode}")
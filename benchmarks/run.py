@@ -0,0 +1,141 @@
+"""
+Benchmark the stream, detection and API endpoints of a running server.
+
+    python manage.py seed_benchmark_data --missions 5 --detections 2000 --victims-per-detection 5
+    python manage.py runserver --noreload &
+    python -m benchmarks.run --server-pid $! --output bench.json
+
+Run it from the project root against a disposable database (see DATABASE_PATH in
+settings), the capture scenario writes Detection rows and snapshots.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import nullcontext
+
+from benchmarks.load import open_connection, run_requests, run_viewers
+from benchmarks.publisher import DEFAULT_FRAMES_DIR, FramePublisher, load_frames
+from benchmarks.sampler import ProcessSampler
+
+
+SCENARIOS = ("stream", "detection-stream", "capture", "lists")
+
+
+def get_json(base_url, path):
+    connection = open_connection(base_url)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def pick_mission_id(base_url):
+    """Use the mission with the highest id, the seed command creates the largest one last"""
+    missions = get_json(base_url, "/api/missions/")
+    if not missions:
+        raise SystemExit("No missions found, run manage.py seed_benchmark_data first")
+    return max(mission["id"] for mission in missions)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def run_scenario(name, args, mission_id):
+    if name in ("stream", "detection-stream"):
+        return [run_viewers(args.base_url, f"/api/{name}/", count, args.stream_duration) for count in args.viewers]
+
+    if name == "capture":
+        body = {"mission_id": mission_id, "latitude": 10.3, "longitude": 123.9}
+        return [run_requests(args.base_url, "POST", "/api/capture-detection/", args.capture_requests,
+                             args.capture_concurrency, body=body)]
+
+    if name == "lists":
+        paths = [
+            "/api/missions/",
+            "/api/person-detection-models/",
+            f"/api/mission/{mission_id}/",
+            f"/api/mission/{mission_id}/detections/",
+            "/api/detections/",
+            "/api/victims/",
+        ]
+        return [run_requests(args.base_url, "GET", path, args.list_requests, args.list_concurrency) for path in paths]
+
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--server-pid", type=int, help="pid of the server process, to sample its CPU and RSS")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated list of " + ", ".join(SCENARIOS))
+    parser.add_argument("--publisher", choices=("file", "websocket", "none"), default="file")
+    parser.add_argument("--frames-dir", default=DEFAULT_FRAMES_DIR)
+    parser.add_argument("--fps", type=float, default=10.0)
+    parser.add_argument("--image-path", default="image.jpg")
+    parser.add_argument("--websocket-url", default="ws://127.0.0.1:3001")
+    parser.add_argument("--viewers", type=lambda value: [int(v) for v in value.split(",")], default=[1, 4, 8],
+                        help="comma separated viewer counts, each one is a separate run")
+    parser.add_argument("--stream-duration", type=float, default=10.0)
+    parser.add_argument("--capture-requests", type=int, default=20)
+    parser.add_argument("--capture-concurrency", type=int, default=2)
+    parser.add_argument("--list-requests", type=int, default=50)
+    parser.add_argument("--list-concurrency", type=int, default=4)
+    parser.add_argument("--mission-id", type=int)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    mission_id = args.mission_id
+    if mission_id is None and any(name in ("capture", "lists") for name in scenarios):
+        mission_id = pick_mission_id(args.base_url)
+
+    publisher = None
+    if args.publisher != "none":
+        publisher = FramePublisher(load_frames(args.frames_dir), fps=args.fps, mode=args.publisher,
+                                   image_path=args.image_path, websocket_url=args.websocket_url)
+        publisher.start()
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+        "mission_id": mission_id,
+        "scenarios": {},
+    }
+    try:
+        for name in scenarios:
+            sampler = ProcessSampler(args.server_pid) if args.server_pid else None
+            with sampler or nullcontext():
+                results = run_scenario(name, args, mission_id)
+            report["scenarios"][name] = {
+                "results": results,
+                "server": sampler.summary() if sampler else None,
+            }
+    finally:
+        if publisher is not None:
+            publisher.stop()
+            report["publisher"] = {"fps": args.fps, "published": publisher.published, "late": publisher.late}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def read_process_stats(pid):
+    """Return (cpu_seconds, rss_bytes) of a process from /proc"""
+    with open(f"/proc/{pid}/stat") as f:
+        # The command name may contain spaces, the fields we need come after it
+        fields = f.read().rsplit(")", 1)[1].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    rss_pages = int(fields[21])
+    return (utime + stime) / CLOCK_TICKS, rss_pages * PAGE_SIZE
+
+
+class ProcessSampler:
+    """
+    Samples the CPU usage and RSS of the server process while a scenario runs
+    """
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.samples = []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="process-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        last_cpu, _ = read_process_stats(self.pid)
+        last_time = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            cpu, rss = read_process_stats(self.pid)
+            now = time.perf_counter()
+            self.samples.append({
+                "cpu_percent": 100.0 * (cpu - last_cpu) / (now - last_time),
+                "rss_bytes": rss,
+            })
+            last_cpu, last_time = cpu, now
+
+    def summary(self):
+        if not self.samples:
+            return None
+        cpu = [sample["cpu_percent"] for sample in self.samples]
+        rss = [sample["rss_bytes"] for sample in self.samples]
+        return {
+            "cpu_percent_mean": round(sum(cpu) / len(cpu), 1),
+            "cpu_percent_max": round(max(cpu), 1),
+            "rss_mb_mean": round(sum(rss) / len(rss) / 2 ** 20, 1),
+            "rss_mb_max": round(max(rss) / 2 ** 20, 1),
+        }
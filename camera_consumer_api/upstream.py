@@ -0,0 +1,207 @@
+"""
+Shared upstream connections to MJPEG over HTTP cameras (the ESP32 CameraWebServer).
+
+Every camera in settings.HTTP_CAMERAS gets one HTTPCameraSource, created the first time
+the source is asked for (?source=<camera name>). While it is in use, a background thread
+keeps a single connection to the camera, reconnecting with exponential backoff, and
+splits the multipart stream into whole JPEG frames. The frames are published like the
+websocket ingest frames, so any number of viewers and the detection pipeline share that
+one connection. The thread disconnects and ends when nobody asked for frames for
+IDLE_TIMEOUT, and the next viewer starts it again.
+"""
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+from stream_api import metrics
+from stream_api.frames import FrameSource
+
+
+DEFAULTS = {
+    'URL': None,
+    'CONNECT_TIMEOUT': 3.0,
+    'READ_TIMEOUT': 5.0,  # A camera that sends nothing for this long is reconnected
+    'BACKOFF_INITIAL': 0.5,
+    'BACKOFF_MAX': 10.0,
+    'CHUNK_SIZE': 16384,
+    'MAX_FRAME_SIZE': 2 * 1024 * 1024,  # Larger parts are dropped, the parser resynchronizes on the next boundary
+    'IDLE_TIMEOUT': 10.0,  # Seconds without viewers before the connection is closed
+}
+
+DEFAULT_BOUNDARY = b'frame'
+
+
+def get_cameras():
+    """{name: config} of the configured HTTP cameras"""
+    cameras = {}
+    for name, camera in getattr(settings, 'HTTP_CAMERAS', {}).items():
+        config = dict(DEFAULTS)
+        config.update(camera)
+        cameras[name] = config
+    return cameras
+
+
+def parse_boundary(content_type):
+    """Boundary of a multipart Content-Type header, e.g. multipart/x-mixed-replace;boundary=frame"""
+    for parameter in (content_type or '').split(';')[1:]:
+        key, _, value = parameter.strip().partition('=')
+        if key.lower() == 'boundary' and value:
+            return value.strip('"').encode()
+    return DEFAULT_BOUNDARY
+
+
+class MultipartParser:
+    """
+    Splits a multipart/x-mixed-replace byte stream into the bodies of its parts.
+    Parts with a Content-Length are cut at that length, others at the next boundary.
+    """
+    def __init__(self, boundary=DEFAULT_BOUNDARY, max_part_size=DEFAULTS['MAX_FRAME_SIZE']):
+        self.delimiter = b'--' + boundary
+        self.max_part_size = max_part_size
+        self.buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data):
+        """Add received bytes, returns the list of parts they completed"""
+        self.buffer += data
+        parts = []
+        while True:
+            start = self.buffer.find(self.delimiter)
+            if start < 0:
+                # Garbage before the first boundary, keep only what may be the start of one
+                del self.buffer[:-len(self.delimiter)]
+                return parts
+            header_end = self.buffer.find(b'\r\n\r\n', start)
+            if header_end < 0:
+                if len(self.buffer) - start > self.max_part_size:
+                    self.resync(start)
+                    continue
+                del self.buffer[:start]
+                return parts
+            body_start = header_end + 4
+
+            length = self.content_length(self.buffer[start + len(self.delimiter):header_end])
+            if length is not None:
+                if length > self.max_part_size:
+                    self.resync(start)
+                    continue
+                if len(self.buffer) < body_start + length:
+                    del self.buffer[:start]
+                    return parts
+                body_end = next_start = body_start + length
+            else:
+                body_end = next_start = self.buffer.find(self.delimiter, body_start)
+                if body_end < 0:
+                    if len(self.buffer) - body_start > self.max_part_size:
+                        self.resync(start)
+                        continue
+                    del self.buffer[:start]
+                    return parts
+                # The CRLF before the boundary belongs to the boundary
+                if self.buffer[body_end - 2:body_end] == b'\r\n':
+                    body_end -= 2
+
+            parts.append(bytes(self.buffer[body_start:body_end]))
+            del self.buffer[:next_start]
+
+    @staticmethod
+    def content_length(headers):
+        for line in bytes(headers).split(b'\r\n'):
+            key, _, value = line.partition(b':')
+            if key.strip().lower() == b'content-length':
+                try:
+                    return int(value.strip())
+                except ValueError:
+                    return None
+        return None
+
+    def resync(self, start):
+        """Drop an oversized part and continue from the boundary after it"""
+        self.dropped += 1
+        del self.buffer[:start + len(self.delimiter)]
+
+
+class HTTPCameraSource(FrameSource):
+    """
+    Frame source reading an MJPEG over HTTP camera through one shared connection
+    """
+    def __init__(self, name, config):
+        super().__init__(name)
+        self.config = config
+        self.connected = False
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._last_demand = time.monotonic()
+
+    def start(self):
+        with self._thread_lock:
+            self._last_demand = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"camera-{self.name}", daemon=True)
+                self._thread.start()
+
+    def is_idle(self):
+        return time.monotonic() - self._last_demand > self.config['IDLE_TIMEOUT']
+
+    def stop_if_idle(self):
+        """Called by the reader thread, which ends when this returns True"""
+        with self._thread_lock:
+            if self.is_idle():
+                self._thread = None
+                return True
+            return False
+
+    def _run(self):
+        backoff = self.config['BACKOFF_INITIAL']
+        while True:
+            try:
+                if self.read_stream():
+                    # Frames arrived before the connection dropped, reconnect right away
+                    backoff = self.config['BACKOFF_INITIAL']
+            except Exception as e:
+                print(f"Camera {self.name} error: {e}")
+            self.set_connected(False)
+            if self.stop_if_idle():
+                # Nobody is watching, start() connects again on the next use
+                return
+            metrics.inc('upstream_reconnects_total', camera=self.name)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.config['BACKOFF_MAX'])
+
+    def read_stream(self):
+        """Read frames until the connection ends or the source is idle, returns whether any frame was published"""
+        published = False
+        with requests.get(self.config['URL'], stream=True,
+                          timeout=(self.config['CONNECT_TIMEOUT'], self.config['READ_TIMEOUT'])) as response:
+            response.raise_for_status()
+            self.set_connected(True)
+            parser = MultipartParser(parse_boundary(response.headers.get('Content-Type')), self.config['MAX_FRAME_SIZE'])
+            for chunk in response.iter_content(chunk_size=self.config['CHUNK_SIZE']):
+                for jpeg in parser.feed(chunk):
+                    if not jpeg.startswith(b'\xff\xd8'):
+                        metrics.inc('frames_dropped_total', path='upstream')
+                        continue
+                    self.publish(jpeg)
+                    metrics.mark_frame('upstream')
+                    published = True
+                if parser.dropped:
+                    metrics.inc('frames_dropped_total', parser.dropped, path='upstream')
+                    parser.dropped = 0
+                if self.is_idle():
+                    break
+        return published
+
+    def set_connected(self, connected):
+        if connected != self.connected:
+            self.connected = connected
+            metrics.set_gauge('connections', int(connected), path='upstream', camera=self.name)
+
+
+def create_camera_source(name):
+    """HTTPCameraSource of a configured camera, None when no camera has that name"""
+    config = get_cameras().get(name)
+    if config is None or not config['URL']:
+        return None
+    return HTTPCameraSource(name, config)
@@ -1,20 +1,49 @@
-import requests
-from django.http import StreamingHttpResponse
+from django.http import Http404, StreamingHttpResponse
+
+from stream_api import metrics
+from stream_api.frames import get_frame_source
+
+# Camera streamed when the request does not name one, see settings.HTTP_CAMERAS
+DEFAULT_CAMERA = 'esp32'
+# Send the placeholder frame when the camera sent nothing for this long
+FRAME_TIMEOUT = 2.0
+
+
+def placeholder_part():
+    try:
+        with open("placeholder.jpg", "rb") as f:
+            jpeg = f.read()
+    except OSError:
+        jpeg = b''
+    return b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'
+
 
-# Create your views here.
 def stream_camera(request):
-    """Minimal Django view to stream ESP32 camera"""
-    
+    """Relay an ESP32 camera, every viewer shares the one upstream connection of the camera"""
+    try:
+        source = get_frame_source(request.GET.get('camera', DEFAULT_CAMERA))
+    except KeyError:
+        raise Http404("Unknown camera")
+
     def generate():
-        try:
-            response = requests.get('http://172.29.9.200:81/stream', stream=True)
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    yield chunk
-        except:
-            yield b"Camera offline"
-    
+        last_seq = 0
+        placeholder = None
+        with metrics.track_viewer('camera-stream'):
+            while True:
+                frame = source.wait_for_frame(last_seq, timeout=FRAME_TIMEOUT)
+                if frame is None:
+                    # Camera offline or reconnecting
+                    if placeholder is None:
+                        placeholder = placeholder_part()
+                    yield placeholder
+                    continue
+                if last_seq and frame.seq > last_seq + 1:
+                    metrics.inc('frames_dropped_total', frame.seq - last_seq - 1, path='camera-stream')
+                last_seq = frame.seq
+                yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(frame.jpeg)).encode() + b'\r\n\r\n' + frame.jpeg + b'\r\n'
+                metrics.mark_frame('camera-stream')
+
     return StreamingHttpResponse(
         generate(),
         content_type='multipart/x-mixed-replace; boundary=frame'
-    )
\ No newline at end of file
+    )
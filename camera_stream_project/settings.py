@@ -106,14 +106,143 @@ WSGI_APPLICATION = 'camera_stream_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# DATABASE_PATH points the server at another database, e.g. a disposable one for benchmarks
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.environ.get('DATABASE_PATH', BASE_DIR / 'db.sqlite3'),
     }
 }
 
 
+# Person detection inference
+# The .pt weights are exported to ONNX and cached, PyTorch is used when that fails
+
+INFERENCE_BACKEND = {
+    'BACKEND': os.environ.get('INFERENCE_BACKEND', 'onnx'),  # 'onnx' or 'pytorch'
+    'INT8': False,
+    'IMGSZ': 640,
+    'INTRA_OP_THREADS': 0,  # 0 lets ONNX Runtime decide
+    'INTER_OP_THREADS': 0,
+    'PROVIDERS': ['CPUExecutionProvider'],  # e.g. ['OpenVINOExecutionProvider', 'CPUExecutionProvider']
+    'CACHE_DIR': BASE_DIR / 'ai_models' / 'onnx_cache',
+    # Socket of `manage.py run_inference_workers`, None runs inference inside the Django process
+    'WORKER_SOCKET': os.environ.get('INFERENCE_WORKER_SOCKET'),
+    'MODEL_DIR': BASE_DIR / 'ai_models',  # The service only loads models and reads frames below these
+    'FRAME_DIR': MEDIA_ROOT,
+    'WORKER_TIMEOUT': 30.0,
+}
+
+# Detection snapshots, see stream_api/snapshot_storage.py
+SNAPSHOT_STORAGE = {
+    'BACKEND': os.environ.get('SNAPSHOT_STORAGE', 'local'),  # 'local' (MEDIA_ROOT) or 's3'
+    'SHARD_DEPTH': 2,
+    'QUEUE_SIZE': 256,
+    # S3 compatible object store, e.g. a local MinIO
+    'BUCKET': os.environ.get('SNAPSHOT_BUCKET', 'ahon-snapshots'),
+    'ENDPOINT_URL': os.environ.get('SNAPSHOT_ENDPOINT_URL'),
+    'ACCESS_KEY': os.environ.get('SNAPSHOT_ACCESS_KEY'),
+    'SECRET_KEY': os.environ.get('SNAPSHOT_SECRET_KEY'),
+}
+
+# Defaults of `manage.py apply_retention` for missions without a RetentionPolicy, see stream_api/retention.py
+RETENTION = {
+    'FULL_RESOLUTION_DAYS': 30,
+    'THUMBNAIL_SIZE': 320,
+    'DELETE_AFTER_DAYS': None,  # None keeps detections forever
+    'CHUNK_SIZE': 200,
+    'VACUUM_THRESHOLD': 1000,
+}
+
+# Keypoints and posture classification of captured victims, see stream_api/pose.py
+POSE_ESTIMATION = {
+    'ENABLED': os.environ.get('POSE_ESTIMATION', '0') == '1',
+    'MODEL_PATH': BASE_DIR / 'ai_models' / 'pose' / 'best.pt',  # a YOLO pose model, e.g. yolov8n-pose.pt
+    'BATCH_SIZE': 16,
+    'QUEUE_SIZE': 32,
+}
+
+# H.264 output of the streams with ?format=mp4, see stream_api/video.py (needs PyAV)
+VIDEO_STREAM = {
+    'BITRATE': 150_000,  # Bits per second
+    'KEYFRAME_INTERVAL': 15,  # Frames, new viewers start at the next keyframe
+    'PRESET': 'veryfast',
+}
+
+# JPEG decoding and encoding of every stream, capture and snapshot, see stream_api/jpeg.py.
+# TurboJPEG needs PyTurboJPEG and libturbojpeg, 'auto' falls back to OpenCV without them
+JPEG_CODEC = {
+    'BACKEND': os.environ.get('JPEG_CODEC', 'auto'),  # 'auto', 'turbojpeg' or 'opencv'
+    'QUALITY': 80,
+    'SUBSAMPLING': '420',  # '444', '422' or '420'
+}
+
+# Detection results kept per frame source for captures of earlier frames, see stream_api/ring_buffer.py
+PRETRIGGER_BUFFER = {
+    'SECONDS': 10.0,
+    'MAX_BYTES': 32 * 1024 * 1024,
+    'MAX_BURST_FRAMES': 10,
+}
+
+# Captures of the new people the shared detection pipeline finds, see stream_api/auto_capture.py
+AUTO_CAPTURE = {
+    'MAX_PER_MINUTE': 12,
+    'BURST': 3,
+    'DEDUP_SECONDS': 10.0,
+    'BATCH_SIZE': 50,
+    'FLUSH_INTERVAL': 1.0,
+}
+
+# On-demand stack sampling and allocation tracing through the admin-only /api/profile/, see stream_api/profiling.py
+PROFILING = {
+    'MAX_DURATION': 60.0,
+    'INTERVAL': 0.01,
+}
+
+# Concurrency limits of captures and streams, see stream_api/admission.py
+ADMISSION = {
+    'MAX_CONCURRENT': 12,
+    'QUEUE_SIZE': 16,
+    'QUEUE_TIMEOUT': 5.0,
+    'RAW_LIMIT': 32,
+    'METADATA_LIMIT': 32,
+    'OPERATOR_GROUP': 'operators',
+    'CLASSES': {
+        'capture': {'PRIORITY': 0, 'LIMIT': 4},
+        'operator': {'PRIORITY': 1, 'LIMIT': 4},
+        'viewer': {'PRIORITY': 2, 'LIMIT': 8},
+    },
+}
+
+# MJPEG over HTTP cameras, each read through one shared connection, see camera_consumer_api/upstream.py.
+# Viewers use /camera/stream/?camera=<name>, detection runs on them with ?source=<name>
+HTTP_CAMERAS = {
+    'esp32': {
+        'URL': os.environ.get('ESP32_CAMERA_URL', 'http://172.29.9.200:81/stream'),
+        'BACKOFF_MAX': 10.0,
+    },
+}
+
+
+# Cache of the polled API responses, see stream_api/response_cache.py.
+# The local memory cache evicts the least recently used entries, Redis shares the cache between processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['RESPONSE_CACHE_REDIS_URL'],  # e.g. redis://127.0.0.1:6379/1
+        'TIMEOUT': 300,
+    } if os.environ.get('RESPONSE_CACHE_REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'responses',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
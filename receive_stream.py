@@ -1,36 +1,50 @@
 import asyncio
+import time
 import websockets
 import binascii
-from io import BytesIO
 
-from PIL import Image, UnidentifiedImageError
+from stream_api import metrics
+from stream_api.jpeg import jpeg_size
+
+# Prometheus scrapes the ingest metrics from this port
+METRICS_PORT = 3002
 
 def is_valid_image(image_bytes):
     try:
-        Image.open(BytesIO(image_bytes))
+        jpeg_size(image_bytes)
         # print("image OK")
         return True
-    except UnidentifiedImageError:
+    except ValueError:
         print("image invalid")
         return False
 
 async def handle_connection(websocket):
-    while True:
-        try:
-            message = await websocket.recv()
-            print(len(message))
-            if len(message) > 5000:
-                  if is_valid_image(message):
-                          #print(message)
-                          with open("image.jpg", "wb") as f:
-                                f.write(message)
-
-            print()
-        except websockets.exceptions.ConnectionClosed:
-            break
+    metrics.add_gauge('connections', 1, path='ingest')
+    try:
+        while True:
+            try:
+                started = time.perf_counter()
+                message = await websocket.recv()
+                metrics.observe('stage_latency_seconds', time.perf_counter() - started, path='ingest', stage='frame_interval')
+                if len(message) > 5000:
+                      with metrics.span('ingest', 'validate'):
+                            valid = is_valid_image(message)
+                      if valid:
+                              #print(message)
+                              with metrics.span('ingest', 'write'):
+                                    with open("image.jpg", "wb") as f:
+                                          f.write(message)
+                              metrics.mark_frame('ingest')
+                      else:
+                              metrics.inc('frames_dropped_total', path='ingest')
+            except websockets.exceptions.ConnectionClosed:
+                break
+    finally:
+        metrics.add_gauge('connections', -1, path='ingest')
 
 async def main():
+    metrics.start_metrics_server(METRICS_PORT)
     server = await websockets.serve(handle_connection, '0.0.0.0', 3001)
     await server.wait_closed()
 
-asyncio.run(main())
\ No newline at end of file
+asyncio.run(main())
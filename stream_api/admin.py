@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from stream_api.models import Detection, Mission, PersonDetectionModel, PostureClassification, Victim
+from stream_api.models import Detection, Mission, PersonDetectionModel, PostureClassification, RetentionPolicy, Victim
 
 # Register your models here.
 
@@ -8,4 +8,5 @@ admin.site.register(Mission)
 admin.site.register(PersonDetectionModel)
 admin.site.register(Detection)
 admin.site.register(Victim)
-admin.site.register(PostureClassification)
\ No newline at end of file
+admin.site.register(PostureClassification)
+admin.site.register(RetentionPolicy)
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+Admission control for the expensive endpoints.
+
+The vision gate admits captures and detection stream viewers up to MAX_CONCURRENT at once,
+each class of request up to its own LIMIT. When the gate is full, captures and operator
+streams wait in a bounded queue, in the order of their PRIORITY (lower first), and get a
+503 with Retry-After when the queue is full or QUEUE_TIMEOUT passes. Passive viewers never
+wait: they are degraded to the raw stream, which has its own RAW_LIMIT of viewers.
+Operators are the staff users and the members of OPERATOR_GROUP, everyone else is a viewer.
+Viewers of the detection metadata (SSE) stream share the METADATA_LIMIT of the metadata gate.
+
+Streams hold their slot until the client disconnects. Load, queue length, shed and degraded
+requests are exported through stream_api.metrics.
+"""
+import itertools
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+
+from stream_api import metrics
+
+
+DEFAULTS = {
+    'MAX_CONCURRENT': 12,  # Captures and detection streams served at once
+    'QUEUE_SIZE': 16,
+    'QUEUE_TIMEOUT': 5.0,  # Seconds a request waits for a slot before it is shed
+    'RETRY_AFTER': 5,  # Seconds sent in the Retry-After header of shed requests
+    'RAW_LIMIT': 32,  # Viewers of the raw stream, including degraded ones
+    'METADATA_LIMIT': 32,  # Viewers of the detection metadata stream
+    'OPERATOR_GROUP': 'operators',
+    'CLASSES': {
+        'capture': {'PRIORITY': 0, 'LIMIT': 4},
+        'operator': {'PRIORITY': 1, 'LIMIT': 4},  # Detection stream viewers who are operators
+        'viewer': {'PRIORITY': 2, 'LIMIT': 8},
+    },
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'ADMISSION', {}))
+    return config
+
+
+class Ticket:
+    """
+    A slot of a gate, released once however often release() is called
+    """
+    def __init__(self, gate, request_class):
+        self.gate = gate
+        self.request_class = request_class
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.gate.release(self.request_class)
+
+
+class Gate:
+    """
+    Concurrency limits per request class and in total, with a bounded priority queue
+    """
+    def __init__(self, name, max_concurrent, classes, queue_size=0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.classes = classes
+        self.queue_size = queue_size
+        self._condition = threading.Condition()
+        self._active = {request_class: 0 for request_class in classes}
+        self._waiting = []  # (priority, arrival, class) of the queued requests
+        self._arrivals = itertools.count()
+        for request_class in classes:
+            metrics.register_gauge('admission_active', lambda request_class=request_class: self._active[request_class],
+                                   gate=name, request_class=request_class)
+        metrics.register_gauge('admission_queued', lambda: len(self._waiting), gate=name)
+
+    def has_room(self, request_class):
+        return (self._active[request_class] < self.classes[request_class]['LIMIT']
+                and sum(self._active.values()) < self.max_concurrent)
+
+    def is_next(self, entry):
+        """Whether entry may take a slot now, no request ahead of it in the queue could take one"""
+        if not self.has_room(entry[2]):
+            return False
+        return not any(other < entry and self.has_room(other[2]) for other in self._waiting)
+
+    def acquire(self, request_class, timeout=0.0):
+        """Return a Ticket, or None when the request is shed"""
+        entry = (self.classes[request_class]['PRIORITY'], next(self._arrivals), request_class)
+        started = time.monotonic()
+        with self._condition:
+            if self.is_next(entry):
+                return self.admit(request_class)
+            if timeout <= 0 or len(self._waiting) >= self.queue_size:
+                return None
+            self._waiting.append(entry)
+            try:
+                deadline = started + timeout
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+                    if self.is_next(entry):
+                        metrics.observe('stage_latency_seconds', time.monotonic() - started, path='admission', stage=request_class)
+                        return self.admit(request_class)
+            finally:
+                self._waiting.remove(entry)
+                # Requests behind this one may be next now
+                self._condition.notify_all()
+
+    def admit(self, request_class):
+        self._active[request_class] += 1
+        return Ticket(self, request_class)
+
+    def release(self, request_class):
+        with self._condition:
+            self._active[request_class] -= 1
+            self._condition.notify_all()
+
+
+class AdmittedStream:
+    """
+    Streaming content that holds a ticket until the response is closed
+    """
+    def __init__(self, content, ticket):
+        self.content = content
+        self.ticket = ticket
+
+    def __iter__(self):
+        return iter(self.content)
+
+    def close(self):
+        try:
+            close = getattr(self.content, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.ticket.release()
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def get_gate(name):
+    """
+    The 'vision' gate of captures and detection streams, the 'raw' gate of raw stream viewers
+    or the 'metadata' gate of detection metadata stream viewers
+    """
+    with _gates_lock:
+        gate = _gates.get(name)
+        if gate is None:
+            config = get_config()
+            if name in ('raw', 'metadata'):
+                limit = config[f"{name.upper()}_LIMIT"]
+                gate = Gate(name, limit, {name: {'PRIORITY': 0, 'LIMIT': limit}})
+            else:
+                gate = Gate(name, config['MAX_CONCURRENT'], config['CLASSES'], config['QUEUE_SIZE'])
+            _gates[name] = gate
+        return gate
+
+
+def stream_class(user):
+    """Request class of a detection stream viewer, 'operator' for staff and OPERATOR_GROUP members"""
+    if not user.is_authenticated:
+        return 'viewer'
+    if user.is_staff or user.groups.filter(name=get_config()['OPERATOR_GROUP']).exists():
+        return 'operator'
+    return 'viewer'
+
+
+def shed(gate, request_class):
+    """503 response of a request that was not admitted"""
+    metrics.inc('admission_shed_total', gate=gate.name, request_class=request_class)
+    response = Response({"error": "Server busy, retry later"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(get_config()['RETRY_AFTER'])
+    return response
+
+
+def admit_stream(response, ticket):
+    """Hold ticket for as long as the streaming response is sent"""
+    # Django closes the content with the response, also when the client leaves before the first frame
+    response.streaming_content = AdmittedStream(response.streaming_content, ticket)
+    return response
+
+
+def admitted(request_class, gate_name='vision'):
+    """Run an APIView method only with a slot of the gate, waiting in the queue up to QUEUE_TIMEOUT"""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            gate = get_gate(gate_name)
+            ticket = gate.acquire(request_class, timeout=get_config()['QUEUE_TIMEOUT'])
+            if ticket is None:
+                return shed(gate, request_class)
+            try:
+                return method(view, request, *args, **kwargs)
+            finally:
+                ticket.release()
+        return wrapper
+    return decorator
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class StreamApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'stream_api'
+
+    def ready(self):
+        # Connects the signals that release the snapshots of deleted detections, keep the mission
+        # counters and invalidate the cached responses
+        from stream_api import mission_statistics, response_cache, snapshot_storage  # noqa: F401
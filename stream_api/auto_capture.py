@@ -0,0 +1,348 @@
+"""
+Automatic capture of the people the shared detection pipeline of a source finds.
+
+While auto-capture is on for a source, every result of its pipeline is checked for new
+people: boxes above the selected model's confidence that overlap none of the people this
+session already captured. Captured people are followed from frame to frame by their
+overlap, so someone who stays in view is saved once, and again only after they were out
+of view for DEDUP_SECONDS. A token bucket per mission limits how many detections are
+saved, new people that had to wait are saved once it refills if they are still in view.
+
+The pipeline thread only queues the result. A writer thread saves what queued up within
+FLUSH_INTERVAL (at most BATCH_SIZE captures) in one transaction with bulk_create, so
+10 fps of detections do not become a stream of single inserts. bulk_create sends no
+signals, the writer counts the mission statistics and invalidates the cached responses
+itself, once per batch.
+"""
+import datetime
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+import numpy as np
+
+from stream_api import metrics
+from stream_api.mission_statistics import apply, detection_keys, victim_keys
+from stream_api.models import Detection, Mission, PersonDetectionModel, Victim
+from stream_api.response_cache import invalidate
+from stream_api.snapshot_storage import get_snapshot_storage
+
+
+DEFAULTS = {
+    'MAX_PER_MINUTE': 12,  # Detections saved per mission, on average
+    'BURST': 3,  # Detections saved at once before the per minute rate applies
+    'DEDUP_SECONDS': 10.0,  # A captured person out of view this long is captured again
+    'DEDUP_IOU': 0.3,  # Overlap of a box with a captured person's last box to be that person
+    'BATCH_SIZE': 50,  # Captures saved per transaction
+    'FLUSH_INTERVAL': 1.0,  # Seconds a capture waits in the queue for others to join its batch
+    'QUEUE_SIZE': 200,  # Pending captures, newer ones are dropped when the writer is this far behind
+}
+
+# Victim fields of automatic captures, like the manual ones until an operator reviews them
+MOVEMENT_CATEGORY = 'unknown'
+CONDITION = 'unknown'
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'AUTO_CAPTURE', {}))
+    return config
+
+
+def box_iou(boxes, others):
+    """(len(boxes), len(others)) matrix of the intersection over union of two box arrays"""
+    x1 = np.maximum(boxes[:, None, 0], others[None, :, 0])
+    y1 = np.maximum(boxes[:, None, 1], others[None, :, 1])
+    x2 = np.minimum(boxes[:, None, 2], others[None, :, 2])
+    y2 = np.minimum(boxes[:, None, 3], others[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    other_areas = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+    return intersection / np.maximum(areas[:, None] + other_areas[None, :] - intersection, 1e-9)
+
+
+class TokenBucket:
+    """
+    Allows burst events at once and rate events per second on average
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Capture:
+    """
+    A result waiting for the writer, with the indices of its new boxes
+    """
+    __slots__ = ('mission_id', 'result', 'indices', 'latitude', 'longitude')
+
+    def __init__(self, mission_id, result, indices, latitude, longitude):
+        self.mission_id = mission_id
+        self.result = result
+        self.indices = indices
+        self.latitude = latitude
+        self.longitude = longitude
+
+
+class AutoCaptureSession:
+    """
+    Auto-capture of the results of one source into one mission
+    """
+    def __init__(self, source_name, mission_id, latitude=0.0, longitude=0.0, config=None):
+        self.config = config or get_config()
+        self.source_name = source_name
+        self.mission_id = mission_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.started_at = time.time()
+        self.captured = 0
+        self.people = 0
+        self.rate_limited = 0
+        # Last box and time seen of every captured person
+        self.tracks = np.zeros((0, 4), dtype=np.float32)
+        self.last_seen = np.zeros((0,), dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def new_boxes(self, result):
+        """Indices of the confident boxes of a result that are no captured person, the tracks follow the others"""
+        confident = np.flatnonzero(result.confidences >= result.confidence_threshold)
+        boxes = result.boxes[confident]
+
+        # Forget the people that were out of view for too long
+        recent = self.last_seen >= result.timestamp - self.config['DEDUP_SECONDS']
+        self.tracks, self.last_seen = self.tracks[recent], self.last_seen[recent]
+        if not len(boxes) or not len(self.tracks):
+            return confident
+
+        overlaps = box_iou(boxes, self.tracks)
+        matched = overlaps >= self.config['DEDUP_IOU']
+        # Every track moves to the box that overlaps it the most
+        followed = matched.any(axis=0)
+        closest = overlaps.argmax(axis=0)
+        self.tracks[followed] = boxes[closest[followed]]
+        self.last_seen[followed] = result.timestamp
+        return confident[~matched.any(axis=1)]
+
+    def handle(self, result):
+        """Queue the result when it shows new people and the mission's rate allows it"""
+        with self._lock:
+            indices = self.new_boxes(result)
+            if not len(indices):
+                return False
+            if not get_bucket(self.mission_id, self.config).take():
+                # The people stay untracked, so they are captured once the bucket refills
+                self.rate_limited += 1
+                metrics.inc('auto_capture_total', outcome='rate_limited')
+                return False
+            if not get_writer().submit(Capture(self.mission_id, result, indices, self.latitude, self.longitude)):
+                metrics.inc('auto_capture_total', outcome='queue_full')
+                return False
+            self.tracks = np.concatenate([self.tracks, result.boxes[indices]])
+            self.last_seen = np.concatenate([self.last_seen, np.full(len(indices), result.timestamp)])
+            self.captured += 1
+            self.people += len(indices)
+        metrics.inc('auto_capture_total', outcome='queued')
+        return True
+
+    def to_dict(self):
+        return {
+            'source': self.source_name,
+            'mission_id': self.mission_id,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'started_at': self.started_at,
+            'captured': self.captured,
+            'people': self.people,
+            'rate_limited': self.rate_limited,
+            'tracked': len(self.tracks),
+        }
+
+
+class CaptureWriter:
+    """
+    Write-behind queue of the captures, saved in batches by a background thread
+    """
+    def __init__(self, config):
+        self.config = config
+        self._queue = queue.Queue(maxsize=config['QUEUE_SIZE'])
+        self._thread = threading.Thread(target=self._run, name='auto-capture-writer', daemon=True)
+        self._thread.start()
+        metrics.register_gauge('queue_depth', self._queue.qsize, path='auto-capture', source='writer')
+
+    def submit(self, capture):
+        """Queue a capture, returns False when the queue is full"""
+        try:
+            self._queue.put_nowait(capture)
+            return True
+        except queue.Full:
+            return False
+
+    def flush(self):
+        """Wait until every queued capture is saved"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.config['FLUSH_INTERVAL']
+            while len(batch) < self.config['BATCH_SIZE']:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                print(f"Auto-capture writer error: {e}")
+                metrics.inc('auto_capture_total', len(batch), outcome='failed')
+            finally:
+                close_old_connections()
+                for _ in batch:
+                    self._queue.task_done()
+
+    def write(self, batch):
+        """Save a Detection per capture with a Victim per new person, in one transaction"""
+        from stream_api.pose import get_pose_stage
+
+        started = time.perf_counter()
+        # Captures of missions or models deleted meanwhile are dropped, instead of failing the whole batch
+        missions = set(Mission.objects.filter(id__in={capture.mission_id for capture in batch}).values_list('id', flat=True))
+        models = set(PersonDetectionModel.objects.filter(id__in={capture.result.model_id for capture in batch}).values_list('id', flat=True))
+        batch = [capture for capture in batch if capture.mission_id in missions and capture.result.model_id in models]
+        if not batch:
+            return
+
+        with metrics.span('auto-capture', 'render'):
+            jpegs = [capture.result.annotated_jpeg() for capture in batch]
+
+        storage = get_snapshot_storage()
+        with metrics.span('auto-capture', 'write'):
+            with transaction.atomic():
+                detections = [
+                    Detection(
+                        mission_id=capture.mission_id,
+                        person_detection_model_id=capture.result.model_id,
+                        latitude=capture.latitude,
+                        longitude=capture.longitude,
+                        timestamp=datetime.datetime.fromtimestamp(capture.result.timestamp, tz=datetime.timezone.utc),
+                        is_live=True,
+                        snapshot=storage.store(jpeg),
+                    )
+                    for capture, jpeg in zip(batch, jpegs)
+                ]
+                detections = Detection.objects.bulk_create(detections)
+
+                victims = []
+                deltas = {}
+                for capture, detection in zip(batch, detections):
+                    mission_deltas = deltas.setdefault(capture.mission_id, {})
+                    for key in detection_keys(detection.timestamp):
+                        mission_deltas[key] = mission_deltas.get(key, 0) + 1
+                    for i in capture.indices.tolist():
+                        x1, y1, x2, y2 = capture.result.boxes[i].tolist()
+                        confidence = float(capture.result.confidences[i])
+                        victims.append(Victim(
+                            detection=detection,
+                            person_id=f"person_{detection.id}_{i + 1}",
+                            person_recognition_confidence=confidence,
+                            bounding_box={'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2},
+                            coco_keypoints={},
+                            movement_category=MOVEMENT_CATEGORY,
+                            condition=CONDITION,
+                            is_found=False,
+                            estimated_latitude=capture.latitude,
+                            estimated_longitude=capture.longitude,
+                        ))
+                        for key in victim_keys(CONDITION, MOVEMENT_CATEGORY, False, confidence):
+                            mission_deltas[key] = mission_deltas.get(key, 0) + 1
+                victims = Victim.objects.bulk_create(victims)
+
+                for mission_id, mission_deltas in deltas.items():
+                    apply(mission_id, mission_deltas)
+                invalidate('detection', 'victim')
+
+        # Keypoints and postures are filled in by the pose stage in the background
+        pose_stage = get_pose_stage()
+        if pose_stage is not None:
+            victims_by_detection = {}
+            for victim in victims:
+                victims_by_detection.setdefault(victim.detection_id, []).append(victim)
+            for capture, detection in zip(batch, detections):
+                boxes = capture.result.boxes[capture.indices]
+                pose_stage.submit(capture.result.frame.jpeg,
+                                  [(victim.id, box) for victim, box in zip(victims_by_detection.get(detection.id, []), boxes)])
+
+        metrics.inc('auto_capture_total', len(batch), outcome='saved')
+        metrics.observe('stage_latency_seconds', time.perf_counter() - started, path='auto-capture', stage='total')
+        metrics.mark_frame('auto-capture', len(batch))
+
+
+_writer = None
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = CaptureWriter(get_config())
+        return _writer
+
+
+def get_bucket(mission_id, config):
+    """Rate limit of a mission, shared by every source capturing into it"""
+    with _lock:
+        bucket = _buckets.get(mission_id)
+        if bucket is None:
+            bucket = _buckets[mission_id] = TokenBucket(config['MAX_PER_MINUTE'] / 60, config['BURST'])
+        return bucket
+
+
+def start(source_name, mission_id, latitude=0.0, longitude=0.0):
+    """
+    Auto-capture the results of a source into a mission, raises KeyError for unknown sources.
+    Starting it again for the same mission only updates the location.
+    """
+    from stream_api.detection_pipeline import get_detection_pipeline
+
+    pipeline = get_detection_pipeline(source_name)
+    session = pipeline.auto_capture
+    if session is not None and session.mission_id == mission_id:
+        session.latitude, session.longitude = latitude, longitude
+    else:
+        session = pipeline.auto_capture = AutoCaptureSession(source_name, mission_id, latitude, longitude)
+    # Runs inference while nobody watches the source
+    pipeline.start()
+    return session
+
+
+def stop(source_name):
+    """Stop auto-capture of a source, returns the stopped session or None"""
+    from stream_api.detection_pipeline import get_detection_pipeline
+
+    pipeline = get_detection_pipeline(source_name)
+    session, pipeline.auto_capture = pipeline.auto_capture, None
+    return session
+
+
+def get_session(source_name):
+    from stream_api.detection_pipeline import get_detection_pipeline
+
+    return get_detection_pipeline(source_name).auto_capture
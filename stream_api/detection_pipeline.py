@@ -0,0 +1,266 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from stream_api import metrics
+from stream_api.frames import DEFAULT_SOURCE, get_frame_source
+from stream_api.inference_backends import load_backend
+from stream_api.models import PersonDetectionModel
+from stream_api.ring_buffer import ResultRingBuffer, get_config as get_buffer_config
+
+
+# Stop running inference when nobody asked for a result for this long
+IDLE_TIMEOUT = 5.0
+
+
+class DetectionResult:
+    """
+    Boxes and confidences the selected model found in one frame
+    """
+    def __init__(self, frame, detections, model_id, confidence_threshold):
+        self.frame = frame
+        self.seq = frame.seq
+        self.timestamp = frame.timestamp
+        self.model_id = model_id
+        self.confidence_threshold = confidence_threshold
+        self.height, self.width = detections.orig_shape
+        self.boxes = detections.boxes
+        self.confidences = detections.confidences
+        self.tiles = getattr(detections, 'tiles', 1)
+
+        self._detections = detections
+        self._annotated_jpegs = {}  # {scale: bytes}
+        self._lock = threading.Lock()
+
+    def annotated_jpeg(self, scale=1):
+        """Draw and encode the annotated frame once per scale, every MJPEG viewer shares the bytes"""
+        with self._lock:
+            jpeg = self._annotated_jpegs.get(scale)
+            if jpeg is None and scale == 1 and self._detections.annotated_jpeg is not None:
+                # Already annotated by the inference service
+                jpeg = self._detections.annotated_jpeg
+            if jpeg is None:
+                with metrics.span('detection', 'render'):
+                    jpeg = self._detections.render_jpeg(scale, jpeg=self.frame.jpeg)
+            self._annotated_jpegs[scale] = jpeg
+            return jpeg
+
+    def compact(self):
+        """Keep only the JPEG frame and the boxes, the annotated frame is drawn again when it is asked for"""
+        with self._lock:
+            self._detections.image = None
+            self._detections.annotated_jpeg = None
+            self._annotated_jpegs = {}
+
+    def nbytes(self):
+        return len(self.frame.jpeg) + self.boxes.nbytes + self.confidences.nbytes + self._detections.class_ids.nbytes
+
+    def best_confidence(self):
+        return float(self.confidences.max()) if len(self.confidences) else 0.0
+
+    def to_dict(self):
+        """Box metadata for clients that draw the overlay themselves"""
+        return {
+            'seq': self.seq,
+            'timestamp': self.timestamp,
+            'model_id': self.model_id,
+            'confidence_threshold': self.confidence_threshold,
+            'width': self.width,
+            'height': self.height,
+            'boxes': self.boxes.astype(np.float64).round(1).tolist(),
+            'confidences': self.confidences.astype(np.float64).round(4).tolist(),
+            'tiles': self.tiles,
+        }
+
+
+class DetectionPipeline:
+    """
+    Runs the selected detection model once per new frame of a source and shares the
+    result with every viewer, instead of running inference per viewer
+    """
+    def __init__(self, source):
+        self.source = source
+        self.current_model = None
+        self.current_model_id = None
+        self.current_confidence = 0.5
+        self.current_tiling = None
+        self._model_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._latest = None
+        config = get_buffer_config()
+        self.buffer = ResultRingBuffer(source.name, config['SECONDS'], config['MAX_BYTES'])
+        self.auto_capture = None  # AutoCaptureSession, see stream_api/auto_capture.py
+        self._last_demand = 0.0
+        self._last_annotated_demand = 0.0
+        self._last_seq = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        metrics.register_gauge('queue_depth', self.queue_depth, path='detection', source=source.name)
+
+    def get_selected_model(self):
+        """Get the currently selected model from database"""
+        selected_model = PersonDetectionModel.objects.filter(is_selected=True).first()
+        if selected_model is not None:
+            return selected_model
+
+        # If no model is selected, return default (ID=2)
+        return PersonDetectionModel.objects.get(id=2)
+
+    def get_model_path(self, model_type):
+        """Map model type to file path"""
+        model_paths = {
+            'Top View': 'ai_models/top_view/best.pt',
+            'Front/Side View': 'ai_models/front_side_view/best.pt',
+            'Angled View': 'ai_models/angled_view/best.pt'
+        }
+        return model_paths.get(model_type, 'ai_models/front_side_view/best.pt')
+
+    def load_detection_model(self):
+        """
+        Load the selected detection model, returns (model, confidence, model id, tiling).
+        Captures run this from request threads too, the lock keeps the four values of one selection together.
+        """
+        with self._model_lock:
+            selected_model = self.get_selected_model()
+
+            # Check if we need to reload the model
+            if (self.current_model is None or self.current_model_id != selected_model.id):
+                model_path = self.get_model_path(selected_model.model_type)
+
+                if os.path.exists(model_path):
+                    print(f"Loading model: {selected_model.model_type} from {model_path}")
+                    self.current_model = load_backend(model_path)
+                    self.current_model_id = selected_model.id
+                    self.current_confidence = selected_model.confidence
+                    print(f"Model loaded successfully with confidence: {self.current_confidence}")
+                else:
+                    print(f"Model file not found: {model_path}")
+                    # Fallback to default model
+                    fallback_path = 'ai_models/front_side_view/best.pt'
+                    if os.path.exists(fallback_path):
+                        self.current_model = load_backend(fallback_path)
+                        self.current_model_id = selected_model.id
+                        self.current_confidence = selected_model.confidence
+                    else:
+                        raise FileNotFoundError("No valid model files found")
+
+            # Update confidence if it changed
+            if self.current_confidence != selected_model.confidence:
+                self.current_confidence = selected_model.confidence
+                print(f"Updated confidence to: {self.current_confidence}")
+
+            # Tiled inference settings can change without reloading the model
+            self.current_tiling = selected_model.get_tiling()
+
+            return self.current_model, self.current_confidence, self.current_model_id, self.current_tiling
+
+    def start(self):
+        """Start the inference thread on first use"""
+        self._last_demand = time.monotonic()
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"detection-{self.source.name}", daemon=True)
+                self._thread.start()
+
+    def is_idle(self):
+        # Auto-capture keeps inference running without viewers
+        return self.auto_capture is None and time.monotonic() - self._last_demand > IDLE_TIMEOUT
+
+    def wants_annotation(self):
+        """Whether MJPEG viewers are watching, so the annotated frame is worth rendering eagerly"""
+        return time.monotonic() - self._last_annotated_demand < IDLE_TIMEOUT
+
+    def queue_depth(self):
+        """Frames the source published that inference has not caught up with yet"""
+        frame = self.source._latest
+        return max(0, frame.seq - self._last_seq) if frame is not None else 0
+
+    def _run(self):
+        while True:
+            if self.is_idle():
+                # Nobody is watching, don't burn CPU on inference or keep the source reading
+                time.sleep(0.1)
+                continue
+            frame = self.source.wait_for_frame(self._last_seq, timeout=1.0)
+            if frame is None:
+                continue
+
+            if self._last_seq and frame.seq > self._last_seq + 1:
+                metrics.inc('frames_dropped_total', frame.seq - self._last_seq - 1, path='detection')
+            self._last_seq = frame.seq
+            try:
+                with metrics.span('detection', 'total'):
+                    result = self.process(frame)
+            except Exception as e:
+                print(f"Error running detection: {e}")
+                time.sleep(0.1)
+                continue
+
+            metrics.mark_frame('detection')
+            with self._condition:
+                if self._latest is not None:
+                    # Viewers moved on to the new result, the buffer keeps the JPEG and boxes
+                    self._latest.compact()
+                self.buffer.append(result)
+                self._latest = result
+                self._condition.notify_all()
+
+            auto_capture = self.auto_capture
+            if auto_capture is not None:
+                try:
+                    auto_capture.handle(result)
+                except Exception as e:
+                    print(f"Error auto-capturing detection: {e}")
+
+    def process(self, frame):
+        """Run the selected model on a frame"""
+        with metrics.span('detection', 'load_model'):
+            detection_model, confidence, model_id, tiling = self.load_detection_model()
+
+        # Use dynamic confidence from database
+        with metrics.span('detection', 'inference'):
+            detections = detection_model.predict_jpeg(frame.jpeg, conf=confidence, annotate=self.wants_annotation(),
+                                                      tiling=tiling)
+        return DetectionResult(frame, detections, model_id, confidence)
+
+    def latest(self):
+        """Return the latest result, or None if nothing was detected yet"""
+        self.start()
+        return self._latest
+
+    def get_result(self, seq):
+        """Return the result of the frame with this seq, or None when it was not detected or is too old"""
+        return self.buffer.get(seq)
+
+    def wait_for_result(self, after_seq=0, timeout=1.0, annotated=False):
+        """
+        Block until a result for a frame newer than after_seq is ready, returns None on timeout.
+        Viewers that will ask for the annotated frame pass annotated=True.
+        """
+        if annotated:
+            self._last_annotated_demand = time.monotonic()
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._latest is None or self._latest.seq <= after_seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+                self._last_demand = time.monotonic()
+            return self._latest
+
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+
+def get_detection_pipeline(source_name=DEFAULT_SOURCE):
+    """Return the shared detection pipeline of a frame source"""
+    with _pipelines_lock:
+        pipeline = _pipelines.get(source_name)
+        if pipeline is None:
+            pipeline = _pipelines[source_name] = DetectionPipeline(get_frame_source(source_name))
+        return pipeline
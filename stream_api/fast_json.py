@@ -0,0 +1,128 @@
+"""
+Fast JSON for the large list endpoints.
+
+Rows are read as flat tuples with values_list and turned into the same dicts the
+DetectionSerializer and VictimSerializer produce, without a serializer instance per
+object, then rendered with orjson (the stdlib json module when it is not installed).
+
+stream_list() sends the JSON array while the rows are fetched with
+iterator(chunk_size), so memory stays flat however many rows a mission has.
+"""
+import json
+
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, StreamingHttpResponse
+
+from rest_framework import serializers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+CHUNK_SIZE = 2000  # Rows fetched per query when streaming
+
+# The serializers' own field, so timestamps are rendered exactly the same way
+datetime_text = serializers.DateTimeField().to_representation
+
+VICTIM_COLUMNS = (
+    'id', 'detection_id', 'detection__mission_id', 'person_id', 'person_recognition_confidence', 'bounding_box',
+    'coco_keypoints', 'movement_category', 'condition', 'is_found', 'estimated_longitude', 'estimated_latitude',
+)
+
+DETECTION_COLUMNS = (
+    'id', 'mission_id', 'mission__date_time_started', 'mission__date_time_ended', 'latitude', 'longitude', 'timestamp',
+    'is_live', 'snapshot', 'person_detection_model_id',
+)
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    # Same output as DRF's JSONRenderer
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def optional_datetime(value):
+    return None if value is None else datetime_text(value)
+
+
+#========== ROWS ===============================================================================================================
+def victim_rows(queryset, chunk_size=None):
+    """Yield VictimSerializer compatible dicts"""
+    rows = queryset.values_list(*VICTIM_COLUMNS)
+    if chunk_size:
+        rows = rows.iterator(chunk_size=chunk_size)
+    for (pk, detection_id, mission_id, person_id, confidence, bounding_box, coco_keypoints, movement_category, condition,
+         is_found, longitude, latitude) in rows:
+        yield {
+            'id': pk,
+            'detection_id': detection_id,
+            'mission_id': mission_id,
+            'person_id': person_id,
+            'person_recognition_confidence': confidence,
+            'bounding_box': bounding_box,
+            'coco_keypoints': coco_keypoints,
+            'movement_category': movement_category,
+            'condition': condition,
+            'is_found': is_found,
+            'estimated_longitude': longitude,
+            'estimated_latitude': latitude,
+            'detection': detection_id,
+        }
+
+
+def detection_rows(queryset, request, chunk_size=None):
+    """Yield DetectionSerializer compatible dicts with the image_url the detection views add"""
+    rows = queryset.values_list(*DETECTION_COLUMNS)
+    if chunk_size:
+        rows = rows.iterator(chunk_size=chunk_size)
+    image_base = request.build_absolute_uri('/api/detection/')
+    # Detections of a mission share it, render its timestamps once
+    missions = {}
+    for (pk, mission_id, started, ended, latitude, longitude, timestamp, is_live, snapshot,
+         person_detection_model_id) in rows:
+        mission = missions.get(mission_id)
+        if mission is None:
+            mission = missions[mission_id] = {
+                'id': mission_id,
+                'date_time_started': optional_datetime(started),
+                'date_time_ended': optional_datetime(ended),
+            }
+        yield {
+            'id': pk,
+            'mission': mission,
+            'image_url': f'{image_base}{pk}/image/' if snapshot else None,
+            'latitude': latitude,
+            'longitude': longitude,
+            'timestamp': optional_datetime(timestamp),
+            'is_live': is_live,
+            'snapshot': default_storage.url(snapshot) if snapshot else None,
+            'person_detection_model': person_detection_model_id,
+        }
+
+
+#========== RESPONSES ==========================================================================================================
+def json_response(data, status=200):
+    return HttpResponse(dumps(data), content_type='application/json', status=status)
+
+
+def stream_list(header, key, rows):
+    """
+    Stream {**header, key: [*rows]} as one JSON object, the array is sent as rows are produced
+    """
+    def chunks():
+        yield dumps(header)[:-1] + (b',' if header else b'') + dumps(key) + b':['
+        batch = []
+        first = True
+        for row in rows:
+            batch.append(dumps(row))
+            if len(batch) == CHUNK_SIZE:
+                yield (b'' if first else b',') + b','.join(batch)
+                batch, first = [], False
+        if batch:
+            yield (b'' if first else b',') + b','.join(batch)
+        yield b']}'
+
+    return StreamingHttpResponse(chunks(), content_type='application/json')
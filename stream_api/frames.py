@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+
+from stream_api import metrics
+from stream_api.jpeg import jpeg_size
+
+
+# receive_stream.py overwrites this file with every frame it gets from the drone
+DEFAULT_IMAGE_PATH = "image.jpg"
+DEFAULT_SOURCE = "default"
+
+# A source is stale when no frame arrived for this long, the watchdog checks every WATCHDOG_INTERVAL
+STALE_AFTER = 3.0
+WATCHDOG_INTERVAL = 0.5
+
+
+class Frame:
+    """
+    A single JPEG frame published by a frame source
+    """
+    __slots__ = ('source', 'seq', 'jpeg', 'timestamp')
+
+    def __init__(self, source, seq, jpeg, timestamp):
+        self.source = source
+        self.seq = seq
+        self.jpeg = jpeg
+        self.timestamp = timestamp
+
+
+class FrameSource:
+    """
+    Holds the latest frame of a camera and wakes up everyone waiting for a newer one.
+    The size, dimensions and rate of the frames are recorded as they are published, so the
+    status of a source is read from memory.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.stale = False
+        self.state_version = 0  # Changes whenever the source goes stale or live again
+        self._condition = threading.Condition()
+        self._latest = None
+        self._seq = 0
+        self._dimensions = None
+        self._published_at = None
+        self._rate = metrics.RateMeter()
+
+    def start(self):
+        """Start the background reader, if the source has one"""
+        pass
+
+    def publish(self, jpeg):
+        """Publish a new JPEG frame and return it"""
+        try:
+            dimensions = jpeg_size(jpeg)
+        except ValueError:
+            dimensions = None
+        with self._condition:
+            self._seq += 1
+            self._latest = Frame(self.name, self._seq, jpeg, time.time())
+            self._dimensions = dimensions
+            self._published_at = time.monotonic()
+            self._rate.mark()
+            if self.stale:
+                self.set_stale(False)
+            self._condition.notify_all()
+            return self._latest
+
+    def latest(self):
+        """Return the latest frame, or None if nothing arrived yet"""
+        self.start()
+        return self._latest
+
+    def wait_for_frame(self, after_seq=0, timeout=1.0, state_version=None):
+        """
+        Block until a frame newer than after_seq arrives, returns None on timeout.
+        With state_version, also returns None as soon as the source goes stale or live again.
+        """
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._latest is None or self._latest.seq <= after_seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (state_version is not None and state_version != self.state_version):
+                    return None
+                self._condition.wait(remaining)
+            return self._latest
+
+    def set_stale(self, stale):
+        """Called with the condition held, wakes up the waiters so they see the new state"""
+        self.stale = stale
+        self.state_version += 1
+        metrics.set_gauge('source_stale', int(stale), source=self.name)
+        if stale:
+            metrics.inc('source_stale_total', source=self.name)
+        self._condition.notify_all()
+
+    def check_stale(self, now):
+        """Mark the source stale when its last frame is older than STALE_AFTER"""
+        with self._condition:
+            if not self.stale and self._published_at is not None and now - self._published_at > STALE_AFTER:
+                self.set_stale(True)
+
+    def status(self):
+        """Metadata of the latest frame, without touching the frame itself"""
+        self.start()
+        frame = self._latest
+        if frame is None:
+            return {'source': self.name, 'status': 'not_found'}
+        width, height = self._dimensions or (None, None)
+        return {
+            'source': self.name,
+            'status': 'stale' if self.stale else 'available',
+            'file_size': len(frame.jpeg),
+            'dimensions': {'width': width, 'height': height},
+            'seq': frame.seq,
+            'timestamp': frame.timestamp,
+            'age_seconds': round(time.monotonic() - self._published_at, 3),
+            'fps': round(self._rate.rate(), 2),
+        }
+
+
+class FileFrameSource(FrameSource):
+    """
+    Frame source fed through a file on disk (image.jpg written by receive_stream.py).
+    The file is only read again when its mtime or size changes.
+    """
+    def __init__(self, name, path=DEFAULT_IMAGE_PATH, poll_interval=0.02):
+        super().__init__(name)
+        self.path = path
+        self.poll_interval = poll_interval
+        self._last_stat = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"frame-source-{self.name}", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error reading frame from {self.path}: {e}")
+            time.sleep(self.poll_interval)
+
+    def poll(self):
+        """Publish the file content if it changed since the last poll"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._last_stat:
+            return None
+
+        with metrics.span('source', 'file_read'):
+            with open(self.path, "rb") as f:
+                jpeg = f.read()
+
+        # The writer overwrites the file in place, skip it until the JPEG is complete
+        if not (jpeg.startswith(b'\xff\xd8') and jpeg.rstrip(b'\x00').endswith(b'\xff\xd9')):
+            return None
+
+        self._last_stat = stamp
+        metrics.mark_frame('source')
+        return self.publish(jpeg)
+
+
+_sources = {}
+_sources_lock = threading.Lock()
+_watchdog = None
+
+
+def watch_sources():
+    while True:
+        now = time.monotonic()
+        for source in list(_sources.values()):
+            source.check_stale(now)
+        time.sleep(WATCHDOG_INTERVAL)
+
+
+def start_watchdog():
+    """Start the thread that marks sources stale, called with _sources_lock held"""
+    global _watchdog
+    if _watchdog is None:
+        _watchdog = threading.Thread(target=watch_sources, name="frame-source-watchdog", daemon=True)
+        _watchdog.start()
+
+
+def register_frame_source(source):
+    """Make a frame source available by name"""
+    with _sources_lock:
+        _sources[source.name] = source
+        start_watchdog()
+    return source
+
+
+def get_frame_source(name=DEFAULT_SOURCE):
+    """
+    Return the frame source with the given name, created on first use: the default one reads
+    image.jpg, the others are the HTTP cameras of settings.HTTP_CAMERAS
+    """
+    with _sources_lock:
+        source = _sources.get(name)
+        if source is None:
+            if name == DEFAULT_SOURCE:
+                source = FileFrameSource(name)
+            else:
+                # camera_consumer_api builds on this module, import it only when a camera is asked for
+                from camera_consumer_api.upstream import create_camera_source
+
+                source = create_camera_source(name)
+                if source is None:
+                    raise KeyError(f"Unknown frame source: {name}")
+            _sources[name] = source
+            start_watchdog()
+        return source
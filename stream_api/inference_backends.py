@@ -0,0 +1,335 @@
+"""
+Inference backends for the person detection models.
+
+The .pt weights are exported once to ONNX (optionally INT8 quantized), cached, and run
+with ONNX Runtime. Whenever that is not possible the ultralytics/PyTorch model is used.
+When WORKER_SOCKET is set, inference runs in the separate inference service instead
+(see stream_api.inference_service).
+"""
+import ast
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+import cv2
+import numpy as np
+
+from stream_api import jpeg as jpeg_codec
+from stream_api import metrics
+from stream_api.overlay import get_renderer
+
+
+DEFAULTS = {
+    'BACKEND': 'onnx',  # 'onnx' or 'pytorch'
+    'INT8': False,
+    'IMGSZ': 640,
+    'IOU': 0.7,
+    'MAX_DET': 300,
+    'INTRA_OP_THREADS': 0,  # 0 lets ONNX Runtime decide
+    'INTER_OP_THREADS': 0,
+    'PROVIDERS': ['CPUExecutionProvider'],
+    'CACHE_DIR': os.path.join('ai_models', 'onnx_cache'),
+    'WORKER_SOCKET': None,  # Unix socket of the inference service, None runs inference in-process
+    'MODEL_DIR': 'ai_models',  # The inference service only loads models below this directory
+    'FRAME_DIR': None,  # and only reads frame files below this one, MEDIA_ROOT when None
+    'WORKER_TIMEOUT': 30.0,  # Seconds to wait for the service to answer, including the wait for a free worker
+    'SCALED_DECODE': True,  # Decode frames larger than the model input at 1/2, 1/4 or 1/8 scale
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'INFERENCE_BACKEND', {}))
+    return config
+
+
+class Detections:
+    """
+    Boxes found in one image, in original image pixel coordinates.
+    Results of the inference service carry no image, only its shape and, when it was
+    asked for, the annotated JPEG.
+    """
+    def __init__(self, image, boxes, confidences, class_ids, names, orig_shape=None, annotated_jpeg=None):
+        self.image = image
+        self.orig_shape = tuple(orig_shape) if orig_shape is not None else image.shape[:2]
+        self.annotated_jpeg = annotated_jpeg
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.confidences = np.asarray(confidences, dtype=np.float32).reshape(-1)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32).reshape(-1)
+        self.names = names
+        self._jpeg = None
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def plot(self):
+        """Return a copy of the image with the boxes drawn on it"""
+        if self.image is None and self._jpeg is not None:
+            self.image = decode_jpeg(self._jpeg)
+        return get_renderer().render(self.image, self.boxes, self.confidences, self.class_ids, self.names).copy()
+
+    def render_jpeg(self, scale=1, jpeg=None):
+        """
+        Draw the boxes at 1/scale of the original resolution and encode the frame.
+        Without a decoded image, jpeg (the frame the boxes were found on) is decoded at that scale.
+        """
+        height, width = self.orig_shape
+        size = (-(-width // scale), -(-height // scale))
+        renderer = get_renderer()
+        image = self.image
+        if image is not None and image.shape[:2] == self.orig_shape:
+            frame = renderer.render(image, self.boxes, self.confidences, self.class_ids, self.names, size=size)
+        else:
+            jpeg = jpeg or self._jpeg
+            if jpeg is None:
+                raise ValueError("No image to draw the detections on")
+            # The decoded frame is not kept, draw straight into it
+            frame = renderer.draw(decode_jpeg(jpeg, scale), self.boxes, self.confidences, self.class_ids, self.names,
+                                  self.orig_shape)
+        return jpeg_codec.encode(frame)
+
+    def restore_scale(self, jpeg):
+        """
+        Map boxes found on a reduced decode of jpeg back to its full resolution.
+        The full resolution image is only decoded if the detections are plotted.
+        """
+        width, height = jpeg_codec.jpeg_size(jpeg)
+        reduced_height, reduced_width = self.orig_shape
+        self.boxes = self.boxes * np.array([width / reduced_width, height / reduced_height] * 2, dtype=np.float32)
+        self.orig_shape = (height, width)
+        self.image = None
+        self._jpeg = jpeg
+
+
+def decode_jpeg(jpeg, scale=1):
+    return jpeg_codec.decode(jpeg, scale)
+
+
+class InferenceBackend:
+    """
+    Base class of the backends, predict() takes a decoded BGR image
+    """
+    name = None
+    input_size = None  # Side of the square model input, frames are never decoded smaller than this
+
+    def predict(self, image, conf):
+        raise NotImplementedError
+
+    def predict_batch(self, images, conf, parallelism=1):
+        """Run several images, concurrently when parallelism > 1 (inference releases the GIL)"""
+        if parallelism <= 1 or len(images) <= 1:
+            return [self.predict(image, conf) for image in images]
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            return list(executor.map(lambda image: self.predict(image, conf), images))
+
+    def predict_tiled(self, image, conf, tiling):
+        from stream_api.tiling import predict_tiled
+        return predict_tiled(self, image, conf, **tiling)
+
+    def predict_jpeg(self, jpeg, conf, annotate=False, tiling=None):
+        """
+        Decode and run a JPEG frame, local backends plot lazily so annotate is only a hint.
+        tiling holds the tile_size, overlap and parallelism of tiled inference.
+        """
+        with metrics.span('inference', 'decode'):
+            image, scale = self.decode_for_inference(jpeg, tiling)
+        if tiling:
+            return self.predict_tiled(image, conf, tiling)
+        detections = self.predict(image, conf)
+        if scale > 1:
+            detections.restore_scale(jpeg)
+        return detections
+
+    def decode_for_inference(self, jpeg, tiling=None):
+        """
+        Decode a frame at the smallest DCT scale that still fills the model input, returns (image, scale).
+        Tiled inference needs every pixel, those frames are decoded at full size.
+        """
+        scale = 1
+        if self.input_size and not tiling and get_config()['SCALED_DECODE']:
+            try:
+                scale = jpeg_codec.scale_for(jpeg_codec.jpeg_size(jpeg), self.input_size)
+            except ValueError:
+                pass
+        return decode_jpeg(jpeg, scale), scale
+
+    def predict_file(self, path, conf, annotate=False, tiling=None):
+        with open(path, 'rb') as f:
+            return self.predict_jpeg(f.read(), conf, annotate=annotate, tiling=tiling)
+
+
+class PyTorchBackend(InferenceBackend):
+    """
+    Runs the .pt weights through ultralytics
+    """
+    name = 'pytorch'
+
+    def __init__(self, model_path):
+        from ultralytics import YOLO
+
+        self.model_path = model_path
+        self.model = YOLO(model_path)
+        self.input_size = get_config()['IMGSZ']
+
+    def predict(self, image, conf):
+        return self.predict_batch([image], conf)[0]
+
+    def predict_batch(self, images, conf, parallelism=1):
+        """ultralytics runs a list of images as one batch"""
+        results = self.model(list(images), conf=conf, verbose=False)
+        return [self.to_detections(image, result) for image, result in zip(images, results)]
+
+    def to_detections(self, image, result):
+        boxes = result.boxes
+        if boxes is None or len(boxes) == 0:
+            return Detections(image, [], [], [], result.names)
+        return Detections(
+            image,
+            boxes.xyxy.cpu().numpy(),
+            boxes.conf.cpu().numpy(),
+            boxes.cls.cpu().numpy(),
+            result.names,
+        )
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    Runs an exported YOLO model with ONNX Runtime
+    """
+    name = 'onnx'
+
+    def __init__(self, onnx_path, config):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = config['INTRA_OP_THREADS']
+        options.inter_op_num_threads = config['INTER_OP_THREADS']
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        available = onnxruntime.get_available_providers()
+        providers = [provider for provider in config['PROVIDERS'] if provider in available] or ['CPUExecutionProvider']
+
+        self.model_path = onnx_path
+        self.session = onnxruntime.InferenceSession(onnx_path, sess_options=options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        input_size = self.session.get_inputs()[0].shape[2]
+        self.imgsz = self.input_size = input_size if isinstance(input_size, int) else config['IMGSZ']
+        self.iou = config['IOU']
+        self.max_det = config['MAX_DET']
+
+        # ultralytics stores the class names in the model metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata['names']) if 'names' in metadata else {0: 'person'}
+
+    def letterbox(self, image):
+        """Resize keeping the aspect ratio and pad to a square, like ultralytics does"""
+        height, width = image.shape[:2]
+        scale = min(self.imgsz / height, self.imgsz / width)
+        new_width, new_height = round(width * scale), round(height * scale)
+        pad_x = (self.imgsz - new_width) / 2
+        pad_y = (self.imgsz - new_height) / 2
+        left, top = round(pad_x - 0.1), round(pad_y - 0.1)
+
+        canvas = np.full((self.imgsz, self.imgsz, 3), 114, dtype=np.uint8)
+        canvas[top:top + new_height, left:left + new_width] = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+        return canvas, scale, left, top
+
+    def predict(self, image, conf):
+        canvas, scale, left, top = self.letterbox(image)
+        blob = np.ascontiguousarray(canvas[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+
+        # (1, 4 + classes, anchors) -> (anchors, 4 + classes)
+        predictions = self.session.run(None, {self.input_name: blob})[0][0].T
+        scores = predictions[:, 4:]
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+
+        keep = confidences >= conf
+        predictions, class_ids, confidences = predictions[keep], class_ids[keep], confidences[keep]
+
+        centers, sizes = predictions[:, :2], predictions[:, 2:4]
+        boxes = np.concatenate([centers - sizes / 2, centers + sizes / 2], axis=1)
+        boxes -= np.array([left, top, left, top], dtype=np.float32)
+        boxes /= scale
+        height, width = image.shape[:2]
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+
+        if len(boxes):
+            # Offset the boxes per class so NMS never merges boxes of different classes
+            offset_boxes = boxes + class_ids[:, None] * 4096.0
+            xywh = np.concatenate([offset_boxes[:, :2], offset_boxes[:, 2:] - offset_boxes[:, :2]], axis=1)
+            indices = cv2.dnn.NMSBoxes(xywh.tolist(), confidences.tolist(), conf, self.iou, top_k=self.max_det)
+            indices = np.asarray(indices, dtype=np.int64).reshape(-1)[:self.max_det]
+            boxes, confidences, class_ids = boxes[indices], confidences[indices], class_ids[indices]
+
+        return Detections(image, boxes, confidences, class_ids, self.names)
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def export_onnx(model_path, config):
+    """Export .pt weights to ONNX once and return the cached artifact"""
+    folder = os.path.basename(os.path.dirname(os.path.abspath(model_path)))
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    suffix = '-int8' if config['INT8'] else ''
+    name = f"{folder}-{stem}-{file_digest(model_path)}-{config['IMGSZ']}{suffix}.onnx"
+    cached_path = os.path.join(config['CACHE_DIR'], name)
+    if os.path.exists(cached_path):
+        return cached_path
+
+    from ultralytics import YOLO
+
+    print(f"Exporting {model_path} to ONNX")
+    os.makedirs(config['CACHE_DIR'], exist_ok=True)
+    exported_path = YOLO(model_path).export(format='onnx', imgsz=config['IMGSZ'], dynamic=False, simplify=False)
+
+    temp_path = cached_path + '.tmp'
+    if config['INT8']:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(exported_path, temp_path, weight_type=QuantType.QUInt8)
+        os.remove(exported_path)
+    else:
+        shutil.move(exported_path, temp_path)
+    os.replace(temp_path, cached_path)
+    print(f"Cached ONNX model at {cached_path}")
+    return cached_path
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def load_backend(model_path, allow_remote=True):
+    """Load a model with the configured backend, falling back to PyTorch when it fails"""
+    config = get_config()
+    remote = bool(allow_remote and config['WORKER_SOCKET'])
+    key = (os.path.abspath(model_path), config['BACKEND'], config['INT8'], remote)
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is not None:
+            return backend
+
+        if remote:
+            from stream_api.inference_service import RemoteBackend
+            backend = RemoteBackend(model_path, config['WORKER_SOCKET'], config['WORKER_TIMEOUT'])
+        elif config['BACKEND'] == 'onnx':
+            try:
+                backend = OnnxBackend(export_onnx(model_path, config), config)
+            except Exception as e:
+                print(f"ONNX Runtime backend unavailable for {model_path}, falling back to PyTorch: {e}")
+        if backend is None:
+            backend = PyTorchBackend(model_path)
+
+        _backends[key] = backend
+        return backend
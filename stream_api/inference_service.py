@@ -0,0 +1,312 @@
+"""
+Inference service: a pool of worker processes, each pinned to a CPU core, that run the
+person detection models for the Django processes over a local Unix socket.
+
+Run it with `python manage.py run_inference_workers` and point
+INFERENCE_BACKEND['WORKER_SOCKET'] at its socket. Django then only sends frame
+references (a file path or the JPEG bytes) and gets the boxes back, so the web
+workers never load a model and inference scales with the number of cores.
+
+Every message is a length prefixed JSON header followed by a length prefixed payload.
+Clients open a connection per request and a worker answers one request per connection,
+so a worker is free again after every frame however many client threads there are.
+Requests wait in the listen backlog while all workers are busy.
+
+The socket is only accessible to the user running the service, and workers only load
+models below INFERENCE_BACKEND['MODEL_DIR'] and read frames below FRAME_DIR, so a
+request cannot make them unpickle or read arbitrary files.
+"""
+import json
+import os
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from stream_api import metrics
+
+
+LENGTH = struct.Struct('!I')
+
+# Try the service again this long after it failed
+RETRY_INTERVAL = 10.0
+# Seconds a client may take to connect, and a connected client to send its request
+CONNECT_TIMEOUT = 1.0
+
+# In a directory only its owner can enter
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f"ahon-inference-{os.getuid()}", 'inference.sock')
+
+
+def send_message(sock, header, payload=b''):
+    header_bytes = json.dumps(header, separators=(',', ':')).encode()
+    sock.sendall(LENGTH.pack(len(header_bytes)) + header_bytes + LENGTH.pack(len(payload)) + payload)
+
+
+def recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Connection closed")
+        received += count
+    return bytes(buffer)
+
+
+def recv_message(sock):
+    header = json.loads(recv_exactly(sock, LENGTH.unpack(recv_exactly(sock, LENGTH.size))[0]))
+    payload = recv_exactly(sock, LENGTH.unpack(recv_exactly(sock, LENGTH.size))[0])
+    return header, payload
+
+
+def resolve_within(path, directory):
+    """Real path of path, raises PermissionError when it is not below directory"""
+    real_path, real_directory = os.path.realpath(path), os.path.realpath(directory)
+    if os.path.commonpath([real_path, real_directory]) != real_directory:
+        raise PermissionError(f"{path} is outside {directory}")
+    return real_path
+
+
+#========== WORKERS ============================================================================================================
+class InferenceWorker:
+    """
+    Worker process that accepts connections on the shared listening socket and answers
+    the one inference request of each
+    """
+    def __init__(self, index, listener, core=None):
+        self.index = index
+        self.listener = listener
+        self.core = core
+
+    def run(self):
+        if self.core is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, {self.core})
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        print(f"Inference worker {self.index} (pid {os.getpid()}) ready on core {self.core}")
+
+        while True:
+            connection, _ = self.listener.accept()
+            try:
+                self.serve(connection)
+            except ConnectionError:
+                pass
+            except Exception as e:
+                print(f"Inference worker {self.index} error: {e}")
+            finally:
+                connection.close()
+
+    def serve(self, connection):
+        # A client that connects and sends nothing must not hold the worker
+        connection.settimeout(CONNECT_TIMEOUT)
+        header, payload = recv_message(connection)
+        connection.settimeout(None)
+        try:
+            response, response_payload = self.handle(header, payload)
+        except Exception as e:
+            response, response_payload = {'error': str(e)}, b''
+        send_message(connection, response, response_payload)
+
+    def handle(self, header, payload):
+        from django.conf import settings
+        from stream_api.inference_backends import get_config, load_backend
+
+        config = get_config()
+        timings = {}
+        started = time.perf_counter()
+        backend = load_backend(resolve_within(header['model_path'], config['MODEL_DIR']), allow_remote=False)
+        timings['load_model'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        frame = header.get('frame', {})
+        if 'path' in frame:
+            with open(resolve_within(frame['path'], config['FRAME_DIR'] or settings.MEDIA_ROOT), 'rb') as f:
+                payload = f.read()
+        image, scale = backend.decode_for_inference(payload, header.get('tiling'))
+        timings['decode'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if header.get('tiling'):
+            detections = backend.predict_tiled(image, header['conf'], header['tiling'])
+        else:
+            detections = backend.predict(image, conf=header['conf'])
+            if scale > 1:
+                detections.restore_scale(payload)
+        timings['inference'] = time.perf_counter() - started
+
+        annotated_jpeg = b''
+        if header.get('annotate'):
+            started = time.perf_counter()
+            annotated_jpeg = detections.render_jpeg(jpeg=payload)
+            timings['annotate'] = time.perf_counter() - started
+
+        return {
+            'boxes': detections.boxes.tolist(),
+            'confidences': detections.confidences.tolist(),
+            'class_ids': detections.class_ids.tolist(),
+            'names': {str(k): v for k, v in detections.names.items()},
+            'shape': list(detections.orig_shape),
+            'tiles': getattr(detections, 'tiles', 1),
+            'backend': backend.name,
+            'worker': self.index,
+            'timings': timings,
+        }, annotated_jpeg
+
+
+def bind_socket(socket_path):
+    """Listening socket that only the current user can connect to"""
+    directory = os.path.dirname(socket_path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Created with mode 0600, there is no moment in which others could connect
+    umask = os.umask(0o177)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    return listener
+
+
+def run_service(socket_path, workers=None, cores=None):
+    """Bind the socket, fork the workers and restart any worker that dies"""
+    cores = list(cores) if cores else sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else [None]
+    workers = workers or len(cores)
+
+    listener = bind_socket(socket_path)
+
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                InferenceWorker(index, listener, cores[index % len(cores)]).run()
+            finally:
+                os._exit(1)
+        children[pid] = index
+
+    for index in range(workers):
+        spawn(index)
+    print(f"Inference service listening on {socket_path} with {workers} workers")
+
+    try:
+        while True:
+            pid, _ = os.wait()
+            index = children.pop(pid, None)
+            if index is not None:
+                print(f"Inference worker {index} exited, restarting it")
+                spawn(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        listener.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+#========== CLIENT =============================================================================================================
+class RemoteBackend:
+    """
+    Backend that sends frames to the inference service. While the service is
+    unreachable the model is run in-process instead. A service that is reachable but
+    slow to answer raises, the model is not loaded into the Django process for it.
+    """
+    name = 'remote'
+
+    def __init__(self, model_path, socket_path, timeout=30.0):
+        self.model_path = os.path.abspath(model_path)
+        self.socket_path = socket_path
+        self.timeout = timeout  # Seconds to wait for the answer, including the wait for a free worker
+        self._fallback = None
+        self._fallback_lock = threading.Lock()
+        self._failed_at = None
+
+    def _request(self, header, payload=b''):
+        """Send one request on its own connection, only errors while connecting raise OSError"""
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(CONNECT_TIMEOUT)
+            connection.connect(self.socket_path)
+            try:
+                connection.settimeout(self.timeout)
+                send_message(connection, header, payload)
+                return recv_message(connection)
+            except OSError as e:
+                raise RuntimeError(f"Inference service did not answer: {e}") from e
+        finally:
+            connection.close()
+
+    def _use_fallback(self, error):
+        with self._fallback_lock:
+            if self._fallback is None:
+                from stream_api.inference_backends import load_backend
+                print(f"Inference service unavailable ({error}), running {self.model_path} in-process")
+                self._fallback = load_backend(self.model_path, allow_remote=False)
+        self._failed_at = time.monotonic()
+        return self._fallback
+
+    def _predict(self, frame, payload, conf, annotate, tiling):
+        if self._failed_at is not None and time.monotonic() - self._failed_at < RETRY_INTERVAL:
+            return None
+
+        header = {'model_path': self.model_path, 'conf': conf, 'annotate': annotate, 'tiling': tiling, 'frame': frame}
+        started = time.perf_counter()
+        response, annotated_jpeg = self._request(header, payload)
+        metrics.observe('stage_latency_seconds', time.perf_counter() - started, path='inference', stage='remote')
+        if 'error' in response:
+            raise Exception(response['error'])
+        for stage, seconds in response['timings'].items():
+            metrics.observe('stage_latency_seconds', seconds, path='worker', stage=stage)
+
+        from stream_api.inference_backends import Detections
+        detections = Detections(
+            None,
+            np.array(response['boxes'], dtype=np.float32),
+            response['confidences'],
+            response['class_ids'],
+            {int(k): v for k, v in response['names'].items()},
+            orig_shape=response['shape'],
+            annotated_jpeg=annotated_jpeg or None,
+        )
+        detections.tiles = response.get('tiles', 1)
+        return detections
+
+    def predict_jpeg(self, jpeg, conf, annotate=False, tiling=None):
+        try:
+            detections = self._predict({}, jpeg, conf, annotate, tiling)
+        except OSError as e:
+            detections = None
+            self._use_fallback(e)
+        if detections is None:
+            return self._fallback.predict_jpeg(jpeg, conf, annotate=annotate, tiling=tiling)
+        self._failed_at = None
+        return detections
+
+    def predict_file(self, path, conf, annotate=False, tiling=None):
+        try:
+            detections = self._predict({'path': os.path.abspath(path)}, b'', conf, annotate, tiling)
+        except OSError as e:
+            detections = None
+            self._use_fallback(e)
+        if detections is None:
+            return self._fallback.predict_file(path, conf, annotate=annotate, tiling=tiling)
+        self._failed_at = None
+        return detections
+
+    def predict(self, image, conf):
+        from stream_api import jpeg as jpeg_codec
+
+        detections = self.predict_jpeg(jpeg_codec.encode(image), conf)
+        if detections.image is None:
+            detections.image = image
+        return detections
@@ -0,0 +1,186 @@
+"""
+JPEG codec of the stream, capture, inference and snapshot paths.
+
+TurboJPEG (PyTurboJPEG and libturbojpeg) is used when it is installed, OpenCV otherwise,
+which is built on libjpeg-turbo as well. Both can decode at 1/2, 1/4 or 1/8 scale in the
+DCT domain, which skips most of the decoding work when only a smaller image is needed,
+and encode with the quality and chroma subsampling of settings.JPEG_CODEC.
+
+jpeg_size() reads the dimensions from the JPEG header without decoding anything.
+"""
+import threading
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    'BACKEND': 'auto',  # 'auto' (TurboJPEG when installed), 'turbojpeg' or 'opencv'
+    'QUALITY': 80,
+    'SUBSAMPLING': '420',  # Chroma subsampling of encoded frames: '444', '422' or '420'
+}
+
+SCALES = (1, 2, 4, 8)
+
+# Start of frame markers, they hold the image dimensions (DHT, JPG and DAC share the range)
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'JPEG_CODEC', {}))
+    return config
+
+
+def jpeg_size(data):
+    """(width, height) read from the JPEG header, raises ValueError when data is not a JPEG"""
+    if data[:2] != b'\xff\xd8':
+        raise ValueError("Not a JPEG image")
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            raise ValueError("Corrupt JPEG header")
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Fill byte
+            position += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length
+            position += 2
+            continue
+        if marker in SOF_MARKERS:
+            if position + 9 > len(data):
+                break
+            height = int.from_bytes(data[position + 5:position + 7], 'big')
+            width = int.from_bytes(data[position + 7:position + 9], 'big')
+            return width, height
+        if marker == 0xDA:
+            break
+        position += 2 + int.from_bytes(data[position + 2:position + 4], 'big')
+    raise ValueError("No JPEG frame header found")
+
+
+def scale_for(size, min_side):
+    """Largest DCT scale denominator that keeps the longest side of size at min_side or more"""
+    longest = max(size)
+    for denominator in reversed(SCALES[1:]):
+        if -(-longest // denominator) >= min_side:
+            return denominator
+    return 1
+
+
+#========== BACKENDS ===========================================================================================================
+class OpenCVCodec:
+    """
+    cv2.imdecode with IMREAD_REDUCED_COLOR_* and cv2.imencode
+    """
+    name = 'opencv'
+
+    def __init__(self):
+        import cv2
+
+        self.cv2 = cv2
+        self.flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                      8: cv2.IMREAD_REDUCED_COLOR_8}
+        self.subsampling = {'444': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444, '422': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+                            '420': cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420}
+
+    def decode(self, jpeg, scale=1):
+        import numpy as np
+
+        return self.cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), self.flags[scale])
+
+    def encode(self, image, quality, subsampling):
+        ret, jpeg = self.cv2.imencode('.jpg', image, [self.cv2.IMWRITE_JPEG_QUALITY, quality,
+                                                      self.cv2.IMWRITE_JPEG_SAMPLING_FACTOR, self.subsampling[subsampling]])
+        return jpeg.tobytes() if ret else None
+
+
+class TurboJPEGCodec:
+    """
+    libturbojpeg through PyTurboJPEG
+    """
+    name = 'turbojpeg'
+
+    def __init__(self):
+        import turbojpeg
+
+        self.turbo = turbojpeg.TurboJPEG()
+        self.subsampling = {'444': turbojpeg.TJSAMP_444, '422': turbojpeg.TJSAMP_422, '420': turbojpeg.TJSAMP_420}
+
+    def decode(self, jpeg, scale=1):
+        try:
+            return self.turbo.decode(jpeg, scaling_factor=(1, scale) if scale > 1 else None)
+        except OSError:
+            return None
+
+    def encode(self, image, quality, subsampling):
+        return self.turbo.encode(image, quality=quality, jpeg_subsample=self.subsampling[subsampling])
+
+
+def create_backend(name):
+    if name == 'turbojpeg':
+        return TurboJPEGCodec()
+    if name == 'opencv':
+        return OpenCVCodec()
+    try:
+        return TurboJPEGCodec()
+    except (ImportError, RuntimeError, OSError):
+        # PyTurboJPEG or the libturbojpeg library is missing
+        return OpenCVCodec()
+
+
+#========== CODEC ==============================================================================================================
+class Codec:
+    """
+    Decodes to and encodes from BGR numpy images, like cv2 does
+    """
+    def __init__(self, backend, config):
+        self.backend = backend
+        self.config = config
+
+    def decode(self, jpeg, scale=1):
+        """Decode at 1/scale of the full size, raises ValueError when the JPEG cannot be decoded"""
+        image = self.backend.decode(jpeg, scale)
+        if image is None:
+            raise ValueError("Failed to decode image")
+        return image
+
+    def encode(self, image, quality=None, subsampling=None):
+        jpeg = self.backend.encode(image, quality or self.config['QUALITY'], subsampling or self.config['SUBSAMPLING'])
+        if jpeg is None:
+            raise ValueError("Failed to encode image")
+        return jpeg
+
+    def resize(self, jpeg, max_side, quality=None):
+        """Re-encode jpeg with its longest side at most max_side, decoding no more than needed"""
+        import cv2
+
+        width, height = jpeg_size(jpeg)
+        image = self.decode(jpeg, scale_for((width, height), max_side))
+        height, width = image.shape[:2]
+        if max(width, height) > max_side:
+            factor = max_side / max(width, height)
+            image = cv2.resize(image, (max(round(width * factor), 1), max(round(height * factor), 1)), interpolation=cv2.INTER_AREA)
+        return self.encode(image, quality)
+
+
+_codec = None
+_codec_lock = threading.Lock()
+
+
+def get_codec():
+    global _codec
+    with _codec_lock:
+        if _codec is None:
+            config = get_config()
+            _codec = Codec(create_backend(config['BACKEND']), config)
+        return _codec
+
+
+def decode(jpeg, scale=1):
+    return get_codec().decode(jpeg, scale)
+
+
+def encode(image, quality=None, subsampling=None):
+    return get_codec().encode(image, quality, subsampling)
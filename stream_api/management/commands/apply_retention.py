@@ -0,0 +1,28 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from stream_api.retention import RetentionJob, get_config
+
+
+class Command(BaseCommand):
+    help = "Downsample and delete old mission snapshots following the retention policies, and delete orphaned files"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mission', type=int, action='append', help="only apply the policy of this mission, repeatable")
+        parser.add_argument('--chunk-size', type=int, help="detections per transaction, defaults to RETENTION['CHUNK_SIZE']")
+        parser.add_argument('--pause', type=float, default=0.0, help="seconds to sleep between chunks")
+        parser.add_argument('--skip-orphans', action='store_true', help="don't look for orphaned files")
+        parser.add_argument('--no-vacuum', action='store_true')
+        parser.add_argument('--dry-run', action='store_true', help="only count what would be changed")
+
+    def handle(self, *args, **options):
+        config = get_config()
+        if options['chunk_size']:
+            config['CHUNK_SIZE'] = options['chunk_size']
+
+        job = RetentionJob(config, dry_run=options['dry_run'], pause=options['pause'], stdout=self.stdout)
+        report = job.run(mission_ids=options['mission'], orphans=not options['skip_orphans'], vacuum=not options['no_vacuum'])
+
+        self.stdout.write(json.dumps(report, indent=2))
+        self.stdout.write(self.style.SUCCESS(f"Reclaimed {report['bytes_reclaimed'] / 1024 / 1024:.1f} MiB"))
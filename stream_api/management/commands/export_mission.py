@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stream_api.mission_archive import CHUNK_SIZE, FORMATS, export_mission
+from stream_api.models import Mission
+
+
+class Command(BaseCommand):
+    help = "Export a mission with its detections, victims, postures and snapshots to a tar archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument('mission_id', type=int)
+        parser.add_argument('--output', help="archive path, defaults to stdout")
+        parser.add_argument('--format', choices=FORMATS, default='npz')
+        parser.add_argument('--no-snapshots', action='store_true')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            mission = Mission.objects.get(id=options['mission_id'])
+        except Mission.DoesNotExist:
+            raise CommandError(f"Mission {options['mission_id']} not found")
+
+        chunks = export_mission(mission, fmt=options['format'], snapshots=not options['no_snapshots'],
+                                chunk_size=options['chunk_size'])
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
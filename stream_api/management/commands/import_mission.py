@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from stream_api.mission_archive import import_mission
+
+
+class Command(BaseCommand):
+    help = "Import a mission archive created by export_mission as a new mission"
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with open(options['archive'], 'rb') as f:
+            mission, counts = import_mission(f, batch_size=options['batch_size'], stdout=self.stdout)
+        summary = ', '.join(f"{count} {name}" for name, count in counts.items())
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported mission {mission.id} ({summary}) in {time.perf_counter() - started:.1f}s"
+        ))
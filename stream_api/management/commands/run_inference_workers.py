@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from stream_api.inference_backends import get_config
+from stream_api.inference_service import DEFAULT_SOCKET, run_service
+
+
+class Command(BaseCommand):
+    help = "Run the person detection inference service, one worker process per CPU core"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', help="Unix socket path, defaults to INFERENCE_BACKEND['WORKER_SOCKET']")
+        parser.add_argument('--workers', type=int, help="number of worker processes, defaults to one per core")
+        parser.add_argument('--cores', help="comma separated cores to pin the workers to, e.g. 2,3")
+
+    def handle(self, *args, **options):
+        socket_path = options['socket'] or get_config()['WORKER_SOCKET'] or DEFAULT_SOCKET
+        cores = [int(core) for core in options['cores'].split(',')] if options['cores'] else None
+        run_service(socket_path, workers=options['workers'], cores=cores)
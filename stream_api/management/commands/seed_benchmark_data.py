@@ -0,0 +1,91 @@
+import datetime
+import os
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from stream_api.mission_statistics import rebuild_statistics
+from stream_api.models import Detection, Mission, PersonDetectionModel, PostureClassification, Victim
+
+
+class Command(BaseCommand):
+    help = "Seed the database with large missions for the benchmark suite"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--missions', type=int, default=3)
+        parser.add_argument('--detections', type=int, default=1000, help="detections per mission")
+        parser.add_argument('--victims-per-detection', type=int, default=5)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        person_detection_model = PersonDetectionModel.objects.filter(is_selected=True).first() or PersonDetectionModel.objects.first()
+        if person_detection_model is None:
+            raise CommandError("Create at least one PersonDetectionModel first")
+
+        # Point the detections at snapshots that exist so image URLs resolve
+        snapshots_dir = os.path.join(settings.MEDIA_ROOT, 'snapshots')
+        snapshots = sorted(os.listdir(snapshots_dir)) if os.path.isdir(snapshots_dir) else []
+
+        for _ in range(options['missions']):
+            started = timezone.now() - datetime.timedelta(hours=1)
+            mission = Mission.objects.create(date_time_started=started)
+
+            for batch_start in range(0, options['detections'], batch_size):
+                count = min(batch_size, options['detections'] - batch_start)
+                with transaction.atomic():
+                    detections = Detection.objects.bulk_create([
+                        Detection(
+                            mission=mission,
+                            person_detection_model=person_detection_model,
+                            latitude=10.3 + rng.random() / 100,
+                            longitude=123.9 + rng.random() / 100,
+                            is_live=True,
+                            snapshot=f"snapshots/{snapshots[(batch_start + i) % len(snapshots)]}" if snapshots else None,
+                        )
+                        for i in range(count)
+                    ])
+                    # Older SQLite versions don't return the ids of bulk inserted rows
+                    if detections[0].pk is None:
+                        detections = list(Detection.objects.filter(mission=mission).order_by('-id')[:count])
+
+                    victims = Victim.objects.bulk_create([
+                        Victim(
+                            detection=detection,
+                            person_id=f"bench_{mission.id}_{detection.id}_{i + 1}",
+                            person_recognition_confidence=round(rng.uniform(0.5, 1.0), 4),
+                            bounding_box=self.random_box(rng),
+                            coco_keypoints={},
+                            movement_category=rng.choice(['Mobile', 'Immobile', 'unknown']),
+                            condition=rng.choice(['Unknown', 'Injured', 'Stable', 'unknown']),
+                            is_found=rng.random() < 0.3,
+                            estimated_latitude=detection.latitude,
+                            estimated_longitude=detection.longitude,
+                        )
+                        for detection in detections
+                        for i in range(options['victims_per_detection'])
+                    ], batch_size=batch_size)
+                    if victims and victims[0].pk is not None:
+                        PostureClassification.objects.bulk_create([
+                            PostureClassification(
+                                victim=victim,
+                                posture_class=rng.choice(['standing', 'sitting', 'lying']),
+                                confidence=round(rng.uniform(0.3, 1.0), 4),
+                            )
+                            for victim in victims
+                        ], batch_size=batch_size)
+
+            rebuild_statistics(mission.id)
+            self.stdout.write(f"Seeded mission {mission.id} with {options['detections']} detections")
+
+        self.stdout.write(self.style.SUCCESS("Benchmark data seeded"))
+
+    def random_box(self, rng):
+        x1, y1 = rng.uniform(0, 600), rng.uniform(0, 440)
+        return {'x1': x1, 'y1': y1, 'x2': x1 + rng.uniform(10, 40), 'y2': y1 + rng.uniform(20, 40)}
@@ -0,0 +1,265 @@
+"""
+In-process metrics for the vision pipeline, exposed in the Prometheus text format.
+
+Only uses the standard library so receive_stream.py can record its own metrics
+without loading Django.
+"""
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+PREFIX = 'ahon_'
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Percentiles are computed over the most recent samples only
+WINDOW_SIZE = 1024
+# fps is averaged over this many seconds
+RATE_WINDOW = 5.0
+
+HELP = {
+    'stage_latency_seconds': 'Latency of each stage of the vision pipeline',
+    'stage_latency_recent_seconds': 'Latency percentiles of the most recent samples of each stage',
+    'frames_total': 'Frames handled by each path',
+    'fps': 'Frames per second handled by each path',
+    'frames_dropped_total': 'Frames that were skipped or discarded before being delivered',
+    'viewers': 'Connected stream viewers',
+    'admission_active': 'Requests holding a slot of an admission gate',
+    'admission_queued': 'Requests waiting for a slot of an admission gate',
+    'admission_shed_total': 'Requests answered with 503 because no slot was free',
+    'admission_degraded_total': 'Detection stream viewers switched to the raw stream because no slot was free',
+    'stream_bytes_total': 'Bytes sent to stream viewers',
+    'connections': 'Connected camera uploaders and upstream camera connections',
+    'source_stale': 'Whether no frame arrived from a frame source for a while',
+    'source_stale_total': 'Times a frame source went stale',
+    'upstream_reconnects_total': 'Times an upstream camera connection was lost or could not be opened',
+    'queue_depth': 'Frames waiting to be processed',
+    'ring_buffer_bytes': 'JPEG and box bytes held by the pre-trigger buffer of each source',
+    'ring_buffer_frames': 'Detection results held by the pre-trigger buffer of each source',
+    'capture_frames_total': 'Captured frames by whether the stream result was reused, inferred again or had expired',
+    'auto_capture_total': 'Auto-captured frames by outcome (queued, rate_limited, queue_full, saved, failed)',
+    'snapshots_deduplicated_total': 'Captured snapshots that were already stored',
+    'response_cache_total': 'Requests to cached endpoints by result (hit, miss, not_modified)',
+    'snapshot_write_errors_total': 'Failed snapshot writes, by whether they were retried or the blob was marked missing',
+    'snapshot_writes_inline_total': 'Snapshots written by the request because the background writer was behind',
+}
+
+
+class Histogram:
+    """
+    Cumulative latency histogram plus a window of recent samples for percentiles
+    """
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=WINDOW_SIZE)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.recent.append(value)
+
+    def quantiles(self):
+        with self._lock:
+            samples = sorted(self.recent)
+        if not samples:
+            return {}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in QUANTILES}
+
+
+class RateMeter:
+    """
+    Counts events and reports their rate over the last RATE_WINDOW seconds
+    """
+    def __init__(self):
+        self.total = 0
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    def mark(self, count=1):
+        now = time.monotonic()
+        with self._lock:
+            self.total += count
+            self._times.append((now, count))
+            self._trim(now)
+
+    def rate(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            return sum(count for _, count in self._times) / RATE_WINDOW
+
+    def _trim(self, now):
+        while self._times and now - self._times[0][0] > RATE_WINDOW:
+            self._times.popleft()
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_gauge_callbacks = {}
+_rates = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """Record a latency sample in seconds"""
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    histogram.observe(value)
+
+
+@contextmanager
+def span(path, stage):
+    """Time a stage of a path, e.g. with span('detection', 'inference'): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('stage_latency_seconds', time.perf_counter() - start, path=path, stage=stage)
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def add_gauge(name, delta, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+
+def register_gauge(name, callback, **labels):
+    """Register a gauge whose value is read from callback() on every scrape"""
+    with _lock:
+        _gauge_callbacks[_key(name, labels)] = callback
+
+
+def mark_frame(path, count=1):
+    """Count frames handled by a path, feeds both frames_total and fps"""
+    key = _key('frames', {'path': path})
+    meter = _rates.get(key)
+    if meter is None:
+        with _lock:
+            meter = _rates.setdefault(key, RateMeter())
+    meter.mark(count)
+
+
+@contextmanager
+def track_viewer(path):
+    """Count a connected viewer for as long as the block runs"""
+    add_gauge('viewers', 1, path=path)
+    try:
+        yield
+    finally:
+        add_gauge('viewers', -1, path=path)
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format"""
+    with _lock:
+        histograms = list(_histograms.items())
+        counters = list(_counters.items())
+        gauges = list(_gauges.items())
+        callbacks = list(_gauge_callbacks.items())
+        rates = list(_rates.items())
+
+    families = {}
+
+    def add(name, kind, line):
+        family = families.setdefault(name, (kind, []))
+        family[1].append(line)
+
+    for (name, labels), histogram in sorted(histograms):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), histogram.bucket_counts):
+            cumulative += count
+            add(name, 'histogram', f'{PREFIX}{name}_bucket{_format_labels(labels, le=_format_value(bound))} {cumulative}')
+        add(name, 'histogram', f'{PREFIX}{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}')
+        add(name, 'histogram', f'{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}')
+
+        recent_name = name.replace('_seconds', '_recent_seconds')
+        for q, value in histogram.quantiles().items():
+            add(recent_name, 'gauge', f'{PREFIX}{recent_name}{_format_labels(labels, quantile=q)} {_format_value(value)}')
+
+    for (name, labels), meter in sorted(rates):
+        add(f'{name}_total', 'counter', f'{PREFIX}{name}_total{_format_labels(labels)} {meter.total}')
+        add('fps', 'gauge', f'{PREFIX}fps{_format_labels(labels)} {_format_value(meter.rate())}')
+
+    for (name, labels), value in sorted(counters):
+        add(name, 'counter', f'{PREFIX}{name}{_format_labels(labels)} {_format_value(value)}')
+
+    for (name, labels), value in sorted(gauges):
+        add(name, 'gauge', f'{PREFIX}{name}{_format_labels(labels)} {_format_value(value)}')
+
+    for (name, labels), callback in sorted(callbacks, key=lambda item: item[0]):
+        try:
+            value = callback()
+        except Exception:
+            continue
+        add(name, 'gauge', f'{PREFIX}{name}{_format_labels(labels)} {_format_value(value)}')
+
+    lines = []
+    for name, (kind, samples) in families.items():
+        if name in HELP:
+            lines.append(f'# HELP {PREFIX}{name} {HELP[name]}')
+        lines.append(f'# TYPE {PREFIX}{name} {kind}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """Serve /metrics from a background thread, for processes that don't run Django"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
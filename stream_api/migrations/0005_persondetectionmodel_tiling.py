@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-19 13:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stream_api', '0004_persondetectionmodel_confidence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='persondetectionmodel',
+            name='tile_overlap',
+            field=models.FloatField(default=0.2),
+        ),
+        migrations.AddField(
+            model_name='persondetectionmodel',
+            name='tile_parallelism',
+            field=models.PositiveIntegerField(default=2),
+        ),
+        migrations.AddField(
+            model_name='persondetectionmodel',
+            name='tile_size',
+            field=models.PositiveIntegerField(default=640),
+        ),
+        migrations.AddField(
+            model_name='persondetectionmodel',
+            name='tiled_inference',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-19 13:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stream_api', '0006_snapshotblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetentionPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('full_resolution_days', models.PositiveIntegerField(default=30)),
+                ('thumbnail_size', models.PositiveIntegerField(default=320)),
+                ('delete_after_days', models.PositiveIntegerField(blank=True, null=True)),
+                ('mission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='retention_policy', to='stream_api.mission')),
+            ],
+        ),
+    ]
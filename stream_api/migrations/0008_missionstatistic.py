@@ -0,0 +1,83 @@
+# Generated by Django 4.2.30 on 2026-10-19 13:54
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import Count, FloatField
+from django.db.models.functions import Cast, Floor, TruncMinute
+import django.db.models.deletion
+
+
+# A copy of the counting in stream_api/mission_statistics.py as it was when the counters were added,
+# so later changes to that module or to the models do not change what this migration does
+CONFIDENCE_BUCKETS = 10
+
+
+def time_key(timestamp):
+    return timestamp.astimezone(datetime.timezone.utc).replace(second=0, microsecond=0).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def confidence_key(confidence):
+    bucket = min(max(int(float(confidence or 0) * CONFIDENCE_BUCKETS), 0), CONFIDENCE_BUCKETS - 1)
+    return f"{bucket / CONFIDENCE_BUCKETS:.1f}"
+
+
+def compute_statistics(mission_id, Detection, Victim):
+    counts = {}
+
+    detections = Detection.objects.filter(mission_id=mission_id)
+    counts[('detections', 'total')] = detections.count()
+    for minute, count in detections.annotate(minute=TruncMinute('timestamp')).values('minute').annotate(count=Count('id')).values_list('minute', 'count'):
+        counts[('detections_over_time', time_key(minute))] = count
+
+    victims = Victim.objects.filter(detection__mission_id=mission_id)
+    counts[('victims', 'total')] = victims.count()
+    for field in ('condition', 'movement_category'):
+        for value, count in victims.values(field).annotate(count=Count('id')).values_list(field, 'count'):
+            counts[(field, str(value))] = count
+    for is_found, count in victims.values('is_found').annotate(count=Count('id')).values_list('is_found', 'count'):
+        counts[('found', 'found' if is_found else 'not_found')] = count
+
+    buckets = victims.annotate(bucket=Floor(Cast('person_recognition_confidence', FloatField()) * CONFIDENCE_BUCKETS))
+    for bucket, count in buckets.values('bucket').annotate(count=Count('id')).values_list('bucket', 'count'):
+        key = confidence_key((bucket or 0) / CONFIDENCE_BUCKETS)
+        counts[('confidence', key)] = counts.get(('confidence', key), 0) + count
+
+    return {key: count for key, count in counts.items() if count}
+
+
+def count_existing_missions(apps, schema_editor):
+    Mission = apps.get_model('stream_api', 'Mission')
+    Detection = apps.get_model('stream_api', 'Detection')
+    Victim = apps.get_model('stream_api', 'Victim')
+    MissionStatistic = apps.get_model('stream_api', 'MissionStatistic')
+    for mission_id in Mission.objects.values_list('id', flat=True):
+        MissionStatistic.objects.bulk_create([
+            MissionStatistic(mission_id=mission_id, kind=kind, key=key, count=count)
+            for (kind, key), count in compute_statistics(mission_id, Detection, Victim).items()
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stream_api', '0007_retentionpolicy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MissionStatistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=100)),
+                ('count', models.BigIntegerField(default=0)),
+                ('mission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='stream_api.mission')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='missionstatistic',
+            constraint=models.UniqueConstraint(fields=('mission', 'kind', 'key'), name='unique_mission_statistic'),
+        ),
+        migrations.RunPython(count_existing_missions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:30
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stream_api', '0008_missionstatistic'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='detection',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stream_api', '0009_detection_timestamp_frame_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snapshotblob',
+            name='missing',
+            field=models.BooleanField(default=False),
+        ),
+    ]
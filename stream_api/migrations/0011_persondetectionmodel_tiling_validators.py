@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:36
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stream_api', '0010_snapshotblob_missing'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='persondetectionmodel',
+            name='tile_overlap',
+            field=models.FloatField(default=0.2, validators=[django.core.validators.MinValueValidator(0.0), django.core.validators.MaxValueValidator(0.75)]),
+        ),
+        migrations.AlterField(
+            model_name='persondetectionmodel',
+            name='tile_parallelism',
+            field=models.PositiveIntegerField(default=2, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(16)]),
+        ),
+        migrations.AlterField(
+            model_name='persondetectionmodel',
+            name='tile_size',
+            field=models.PositiveIntegerField(default=640, validators=[django.core.validators.MinValueValidator(160)]),
+        ),
+    ]
@@ -0,0 +1,413 @@
+"""
+Export and import of whole missions as a tar archive of columnar chunks.
+
+    manifest.json                   mission, format and chunk size
+    files/snapshots/...             snapshot files, each stored once, before the detections that use them
+    detections-00000.npz            columns of up to CHUNK_SIZE detections
+    victims-00000.npz               bounding boxes as an (n, 4) array, keypoints as (n, 51)
+    postures-00000.npz
+
+With format 'parquet' (needs pyarrow) the chunks are Parquet files instead of NPZ.
+export_mission() is a generator of tar bytes, so only one chunk is in memory at a time,
+and import_mission() reads the archive as a stream and inserts each chunk with bulk_create.
+"""
+import datetime
+import io
+import json
+import tarfile
+import time
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+import numpy as np
+
+from stream_api.mission_statistics import rebuild_statistics
+from stream_api.models import Detection, Mission, PersonDetectionModel, PostureClassification, SnapshotBlob, Victim
+from stream_api.response_cache import invalidate
+from stream_api.snapshot_storage import get_snapshot_storage
+
+
+ARCHIVE_VERSION = 1
+CHUNK_SIZE = 5000
+FORMATS = ('npz', 'parquet')
+
+# COCO keypoints: 17 keypoints of x, y, score
+KEYPOINT_VALUES = 51
+
+
+#========== COLUMNS ============================================================================================================
+def to_microseconds(value):
+    return int(round(value.timestamp() * 1_000_000)) if value is not None else -1
+
+
+def from_microseconds(value):
+    if value < 0:
+        return None
+    return datetime.datetime.fromtimestamp(value / 1_000_000, tz=datetime.timezone.utc)
+
+
+def text_column(values):
+    return np.array(['' if value is None else value for value in values], dtype=str)
+
+
+def optional_text(value):
+    return None if value == '' else str(value)
+
+
+def optional_float(value):
+    return None if np.isnan(value) else float(value)
+
+
+def box_array(boxes):
+    """Bounding box dicts to an (n, 4) array, missing coordinates and boxes that are not dicts are NaN"""
+    array = np.full((len(boxes), 4), np.nan, dtype=np.float64)
+    for i, box in enumerate(boxes):
+        if isinstance(box, dict):
+            array[i] = [box.get('x1', np.nan), box.get('y1', np.nan), box.get('x2', np.nan), box.get('y2', np.nan)]
+    return array
+
+
+def box_dict(row):
+    """Row of box_array() back to a bounding box dict, without the coordinates that are NaN"""
+    return {key: float(value) for key, value in zip(('x1', 'y1', 'x2', 'y2'), row) if not np.isnan(value)}
+
+
+def keypoint_arrays(keypoints):
+    """COCO keypoint dicts to an (n, 51) array, rows without keypoints are NaN with num_keypoints -1"""
+    array = np.full((len(keypoints), KEYPOINT_VALUES), np.nan, dtype=np.float32)
+    counts = np.full(len(keypoints), -1, dtype=np.int16)
+    for i, value in enumerate(keypoints):
+        if isinstance(value, dict) and len(value.get('keypoints', ())) == KEYPOINT_VALUES:
+            array[i] = value['keypoints']
+            counts[i] = value.get('num_keypoints', 0)
+    return array, counts
+
+
+def write_columns(columns, fmt):
+    buffer = io.BytesIO()
+    if fmt == 'npz':
+        np.savez_compressed(buffer, **columns)
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrays = {
+            name: pa.FixedSizeListArray.from_arrays(pa.array(column.reshape(-1)), column.shape[1]) if column.ndim == 2 else pa.array(column)
+            for name, column in columns.items()
+        }
+        pq.write_table(pa.table(arrays), buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+def read_columns(data, fmt):
+    if fmt == 'npz':
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(io.BytesIO(data))
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name).combine_chunks()
+        if pa.types.is_fixed_size_list(column.type):
+            columns[name] = column.flatten().to_numpy(zero_copy_only=False).reshape(-1, column.type.list_size)
+        else:
+            columns[name] = column.to_numpy(zero_copy_only=False)
+    return columns
+
+
+#========== EXPORT =============================================================================================================
+class StreamWriter:
+    """File object for tarfile that hands the written bytes back to the generator"""
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def chunked(queryset, fields, chunk_size):
+    """Yield lists of value tuples by ascending id, id has to be the first field"""
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_id).order_by('pk').values_list(*fields)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def export_mission(mission, fmt='npz', snapshots=True, chunk_size=CHUNK_SIZE):
+    """Generate the tar archive of a mission chunk by chunk"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt == 'parquet':
+        import pyarrow  # noqa: F401, fail before anything is sent
+
+    writer = StreamWriter()
+    tar = tarfile.open(fileobj=writer, mode='w|')
+    storage = get_snapshot_storage()
+    now = time.time()
+
+    def add(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = now
+        tar.addfile(info, io.BytesIO(data))
+        return writer.drain()
+
+    manifest = {
+        'version': ARCHIVE_VERSION,
+        'format': fmt,
+        'chunk_size': chunk_size,
+        'mission': {
+            'id': mission.id,
+            'date_time_started': mission.date_time_started.isoformat(),
+            'date_time_ended': mission.date_time_ended.isoformat() if mission.date_time_ended else None,
+        },
+        'exported_at': timezone.now().isoformat(),
+    }
+    yield add('manifest.json', json.dumps(manifest, indent=2).encode())
+
+    model_types = dict(PersonDetectionModel.objects.values_list('id', 'model_type'))
+    exported_snapshots = set()
+    detection_fields = ('id', 'person_detection_model_id', 'latitude', 'longitude', 'timestamp', 'is_live', 'snapshot')
+    for index, rows in enumerate(chunked(Detection.objects.filter(mission=mission), detection_fields, chunk_size)):
+        ids, model_ids, latitudes, longitudes, timestamps, is_live, snapshot_names = zip(*rows)
+
+        if snapshots:
+            for name in set(snapshot_names) - exported_snapshots - {None, ''}:
+                exported_snapshots.add(name)
+                try:
+                    data = storage.read(name)
+                except FileNotFoundError:
+                    continue
+                yield add(f'files/{name}', data)
+
+        yield add(f'detections-{index:05d}.{fmt}', write_columns({
+            'id': np.array(ids, dtype=np.int64),
+            'person_detection_model': text_column(model_types.get(model_id) for model_id in model_ids),
+            'latitude': np.array(latitudes, dtype=np.float64),
+            'longitude': np.array(longitudes, dtype=np.float64),
+            'timestamp': np.array([to_microseconds(value) for value in timestamps], dtype=np.int64),
+            'is_live': np.array(is_live, dtype=bool),
+            'snapshot': text_column(snapshot_names),
+        }, fmt))
+
+    victim_fields = ('id', 'detection_id', 'person_id', 'person_recognition_confidence', 'bounding_box', 'coco_keypoints',
+                     'movement_category', 'condition', 'is_found', 'estimated_latitude', 'estimated_longitude')
+    victims = Victim.objects.filter(detection__mission=mission)
+    for index, rows in enumerate(chunked(victims, victim_fields, chunk_size)):
+        (ids, detection_ids, person_ids, confidences, boxes, keypoints,
+         movement_categories, conditions, is_found, latitudes, longitudes) = zip(*rows)
+        keypoint_array, keypoint_counts = keypoint_arrays(keypoints)
+        yield add(f'victims-{index:05d}.{fmt}', write_columns({
+            'id': np.array(ids, dtype=np.int64),
+            'detection_id': np.array(detection_ids, dtype=np.int64),
+            'person_id': text_column(person_ids),
+            'person_recognition_confidence': np.array(confidences, dtype=np.float64),
+            'bounding_box': box_array(boxes),
+            'keypoints': keypoint_array,
+            'num_keypoints': keypoint_counts,
+            'movement_category': text_column(movement_categories),
+            'condition': text_column(conditions),
+            'is_found': np.array(is_found, dtype=bool),
+            'estimated_latitude': np.array(latitudes, dtype=np.float64),
+            'estimated_longitude': np.array(longitudes, dtype=np.float64),
+        }, fmt))
+
+    postures = PostureClassification.objects.filter(victim__detection__mission=mission)
+    for index, rows in enumerate(chunked(postures, ('id', 'victim_id', 'posture_class', 'confidence'), chunk_size)):
+        ids, victim_ids, posture_classes, confidences = zip(*rows)
+        yield add(f'postures-{index:05d}.{fmt}', write_columns({
+            'id': np.array(ids, dtype=np.int64),
+            'victim_id': np.array(victim_ids, dtype=np.int64),
+            'posture_class': text_column(posture_classes),
+            'confidence': np.array(confidences, dtype=np.float64),
+        }, fmt))
+
+    tar.close()
+    yield writer.drain()
+
+
+#========== IMPORT =============================================================================================================
+class MissionImporter:
+    """
+    Loads an archive into a new mission. Rows get new ids, the old ids are only
+    kept in memory to link victims to detections and postures to victims.
+    """
+    def __init__(self, batch_size=1000, stdout=None):
+        self.batch_size = batch_size
+        self.stdout = stdout
+        self.storage = get_snapshot_storage()
+        self.mission = None
+        self.format = None
+        self.detection_ids = {}
+        self.victim_ids = {}
+        self.snapshot_names = {}
+        self.unused_snapshots = set()
+        self.model_ids = dict(PersonDetectionModel.objects.values_list('model_type', 'id'))
+        self.default_model_id = (PersonDetectionModel.objects.filter(is_selected=True).values_list('id', flat=True).first()
+                                 or Detection._meta.get_field('person_detection_model').default)
+        self.counts = {'detections': 0, 'victims': 0, 'postures': 0, 'snapshots': 0}
+
+    def run(self, fileobj):
+        try:
+            with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    data = tar.extractfile(member).read()
+                    self.handle(member.name, data)
+        except BaseException:
+            self.abort()
+            raise
+
+        # A snapshot keeps one reference for each detection that uses it
+        for name in self.unused_snapshots:
+            self.storage.release(name)
+        # bulk_create sends no signals, count the summary once at the end
+        if self.mission is not None:
+            rebuild_statistics(self.mission.id)
+            invalidate('detection', 'victim')
+        return self.mission
+
+    def abort(self):
+        """
+        Undo a failed import. Chunks are committed one by one, so the mission and the rows
+        imported so far are deleted, which releases the snapshots of their detections,
+        and the snapshots no detection took over yet are released here.
+        """
+        if self.mission is not None:
+            self.mission.delete()
+            self.mission = None
+        for name in self.unused_snapshots:
+            self.storage.release(name)
+        self.unused_snapshots = set()
+
+    def handle(self, name, data):
+        if name == 'manifest.json':
+            self.create_mission(json.loads(data))
+            return
+        if self.mission is None:
+            raise ValueError("The archive has to start with manifest.json")
+
+        if name.startswith('files/'):
+            extension = '.thumb.jpg' if name.endswith('.thumb.jpg') else '.' + name.rsplit('.', 1)[-1]
+            new_name = self.storage.store(data, extension=extension)
+            self.snapshot_names[name[len('files/'):]] = new_name
+            self.unused_snapshots.add(new_name)
+            self.counts['snapshots'] += 1
+            return
+
+        table = name.split('-', 1)[0]
+        columns = read_columns(data, self.format)
+        with transaction.atomic():
+            if table == 'detections':
+                self.import_detections(columns)
+            elif table == 'victims':
+                self.import_victims(columns)
+            elif table == 'postures':
+                self.import_postures(columns)
+        if self.stdout is not None:
+            self.stdout.write(f"Imported {name}")
+
+    def create_mission(self, manifest):
+        if manifest['version'] != ARCHIVE_VERSION:
+            raise ValueError(f"Unsupported archive version: {manifest['version']}")
+        self.format = manifest['format']
+        self.mission = Mission.objects.create(
+            date_time_started=datetime.datetime.fromisoformat(manifest['mission']['date_time_started']),
+            date_time_ended=(datetime.datetime.fromisoformat(manifest['mission']['date_time_ended'])
+                             if manifest['mission']['date_time_ended'] else None),
+        )
+
+    def import_detections(self, columns):
+        references = {}
+        detections = []
+        for i in range(len(columns['id'])):
+            snapshot = self.snapshot_names.get(str(columns['snapshot'][i]))
+            if snapshot is not None:
+                references[snapshot] = references.get(snapshot, 0) + 1
+            detections.append(Detection(
+                mission=self.mission,
+                timestamp=from_microseconds(int(columns['timestamp'][i])) or timezone.now(),
+                person_detection_model_id=self.model_ids.get(str(columns['person_detection_model'][i]), self.default_model_id),
+                latitude=float(columns['latitude'][i]),
+                longitude=float(columns['longitude'][i]),
+                is_live=bool(columns['is_live'][i]),
+                snapshot=snapshot,
+            ))
+        detections = self.bulk_create(Detection, detections)
+        self.detection_ids.update(zip(columns['id'].tolist(), (detection.pk for detection in detections)))
+
+        # Storing the file counted one reference, count one for every other detection using it
+        for name, count in references.items():
+            if name in self.unused_snapshots:
+                self.unused_snapshots.discard(name)
+                count -= 1
+            if count:
+                SnapshotBlob.objects.filter(name=name).update(ref_count=F('ref_count') + count)
+        self.counts['detections'] += len(detections)
+
+    def import_victims(self, columns):
+        person_ids = [str(person_id) for person_id in columns['person_id']]
+        # person_id is unique, keep the ids unless this instance already has them
+        taken = set(Victim.objects.filter(person_id__in=person_ids).values_list('person_id', flat=True))
+
+        victims = []
+        for i, person_id in enumerate(person_ids):
+            num_keypoints = int(columns['num_keypoints'][i])
+            keypoints = {}
+            if num_keypoints >= 0:
+                keypoints = {'keypoints': columns['keypoints'][i].astype(np.float64).round(3).tolist(), 'num_keypoints': num_keypoints}
+            victims.append(Victim(
+                detection_id=self.detection_ids[int(columns['detection_id'][i])],
+                person_id=f"{person_id}_mission_{self.mission.id}" if person_id in taken else person_id,
+                person_recognition_confidence=float(columns['person_recognition_confidence'][i]),
+                bounding_box=box_dict(columns['bounding_box'][i]),
+                coco_keypoints=keypoints,
+                movement_category=optional_text(columns['movement_category'][i]),
+                condition=optional_text(columns['condition'][i]),
+                is_found=bool(columns['is_found'][i]),
+                estimated_latitude=optional_float(columns['estimated_latitude'][i]),
+                estimated_longitude=optional_float(columns['estimated_longitude'][i]),
+            ))
+        victims = self.bulk_create(Victim, victims)
+        self.victim_ids.update(zip(columns['id'].tolist(), (victim.pk for victim in victims)))
+        self.counts['victims'] += len(victims)
+
+    def import_postures(self, columns):
+        postures = [
+            PostureClassification(
+                victim_id=self.victim_ids[int(victim_id)],
+                posture_class=str(posture_class),
+                confidence=float(confidence),
+            )
+            for victim_id, posture_class, confidence in zip(columns['victim_id'], columns['posture_class'], columns['confidence'])
+        ]
+        self.bulk_create(PostureClassification, postures)
+        self.counts['postures'] += len(postures)
+
+    def bulk_create(self, model, objects):
+        objects = model.objects.bulk_create(objects, batch_size=self.batch_size)
+        if objects and objects[0].pk is None:
+            raise RuntimeError("The database did not return the ids of the inserted rows, SQLite 3.35 or newer is needed")
+        return objects
+
+
+def import_mission(fileobj, batch_size=1000, stdout=None):
+    """Load a mission archive, returns the new mission and the imported row counts"""
+    importer = MissionImporter(batch_size=batch_size, stdout=stdout)
+    mission = importer.run(fileobj)
+    return mission, importer.counts
@@ -0,0 +1,232 @@
+"""
+Mission summary counters.
+
+Every Detection and Victim write adjusts a few MissionStatistic rows of its mission in
+the same transaction, so reading a mission summary costs one small query however large
+the mission is. Bulk writes (bulk_create, QuerySet.update) send no signals, code that
+uses them calls rebuild_statistics() afterwards.
+"""
+import datetime
+from functools import lru_cache
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, FloatField, QuerySet
+from django.db.models.functions import Cast, Floor, TruncMinute
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+from django.dispatch import receiver
+
+from stream_api.models import Detection, Mission, MissionStatistic, Victim
+
+
+# Detections over time are counted per minute and merged into larger intervals on read
+TIME_BUCKET = datetime.timedelta(minutes=1)
+CONFIDENCE_BUCKETS = 10
+
+# Victim fields the counters depend on
+VICTIM_FIELDS = ('detection_id', 'condition', 'movement_category', 'is_found', 'person_recognition_confidence')
+
+
+def time_key(timestamp):
+    return timestamp.astimezone(datetime.timezone.utc).replace(second=0, microsecond=0).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def confidence_key(confidence):
+    bucket = min(max(int(float(confidence or 0) * CONFIDENCE_BUCKETS), 0), CONFIDENCE_BUCKETS - 1)
+    return f"{bucket / CONFIDENCE_BUCKETS:.1f}"
+
+
+def detection_keys(timestamp):
+    return [('detections', 'total'), ('detections_over_time', time_key(timestamp))]
+
+
+def victim_keys(condition, movement_category, is_found, confidence):
+    return [
+        ('victims', 'total'),
+        ('condition', str(condition)),
+        ('movement_category', str(movement_category)),
+        ('found', 'found' if is_found else 'not_found'),
+        ('confidence', confidence_key(confidence)),
+    ]
+
+
+def apply(mission_id, deltas):
+    """Add {(kind, key): delta} to the counters of a mission"""
+    for (kind, key), delta in deltas.items():
+        if not delta:
+            continue
+        counter = MissionStatistic.objects.filter(mission_id=mission_id, kind=kind, key=key)
+        if counter.update(count=F('count') + delta):
+            continue
+        try:
+            with transaction.atomic():
+                MissionStatistic.objects.create(mission_id=mission_id, kind=kind, key=key, count=delta)
+        except IntegrityError:
+            # Created by a concurrent write
+            counter.update(count=F('count') + delta)
+
+
+@lru_cache(maxsize=4096)
+def get_mission_id(detection_id):
+    # A detection never moves to another mission
+    return Detection.objects.filter(pk=detection_id).values_list('mission_id', flat=True).first()
+
+
+#========== SIGNALS ============================================================================================================
+def deleted_with_mission(origin):
+    """The counters of a deleted mission are deleted with it, nothing to adjust"""
+    return isinstance(origin, Mission) or (isinstance(origin, QuerySet) and origin.model is Mission)
+
+
+@receiver(post_save, sender=Detection, dispatch_uid='count_detection')
+def count_detection(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        apply(instance.mission_id, {key: 1 for key in detection_keys(instance.timestamp)})
+
+
+@receiver(post_delete, sender=Detection, dispatch_uid='uncount_detection')
+def uncount_detection(sender, instance, origin=None, **kwargs):
+    if not deleted_with_mission(origin):
+        apply(instance.mission_id, {key: -1 for key in detection_keys(instance.timestamp)})
+
+
+@receiver(post_init, sender=Victim, dispatch_uid='remember_victim_values')
+def remember_victim_values(sender, instance, **kwargs):
+    # Read from __dict__ so deferred fields are not loaded, the counters then query them on save
+    values = instance.__dict__
+    instance._statistics_values = tuple(values[field] for field in VICTIM_FIELDS) if all(field in values for field in VICTIM_FIELDS) else None
+
+
+@receiver(pre_save, sender=Victim, dispatch_uid='load_victim_values')
+def load_victim_values(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding or instance._statistics_values is not None:
+        return
+    instance._statistics_values = Victim.objects.filter(pk=instance.pk).values_list(*VICTIM_FIELDS).first()
+
+
+def victim_mission_id(instance, detection_id):
+    if Victim.detection.is_cached(instance) and instance.detection.pk == detection_id:
+        return instance.detection.mission_id
+    return get_mission_id(detection_id)
+
+
+@receiver(post_save, sender=Victim, dispatch_uid='count_victim')
+def count_victim(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    current = tuple(getattr(instance, field) for field in VICTIM_FIELDS)
+    previous = None if created else instance._statistics_values
+    instance._statistics_values = current
+    if previous == current:
+        return
+
+    changes = {}
+    if previous is not None:
+        changes[previous[0]] = {key: -1 for key in victim_keys(*previous[1:])}
+    for key in victim_keys(*current[1:]):
+        deltas = changes.setdefault(current[0], {})
+        deltas[key] = deltas.get(key, 0) + 1
+
+    for detection_id, deltas in changes.items():
+        apply(victim_mission_id(instance, detection_id), deltas)
+
+
+@receiver(post_delete, sender=Victim, dispatch_uid='uncount_victim')
+def uncount_victim(sender, instance, origin=None, **kwargs):
+    if deleted_with_mission(origin):
+        return
+    values = instance._statistics_values or tuple(getattr(instance, field) for field in VICTIM_FIELDS)
+    apply(victim_mission_id(instance, values[0]), {key: -1 for key in victim_keys(*values[1:])})
+
+
+def count_victim_updates(rows):
+    """
+    Adjust the counters after a QuerySet.update() of victims, which sends no signals.
+    rows are (mission_id, previous, current) with the VICTIM_FIELDS values before and after
+    """
+    changes = {}
+    for mission_id, previous, current in rows:
+        if previous == current:
+            continue
+        deltas = changes.setdefault(mission_id, {})
+        for key in victim_keys(*previous[1:]):
+            deltas[key] = deltas.get(key, 0) - 1
+        for key in victim_keys(*current[1:]):
+            deltas[key] = deltas.get(key, 0) + 1
+
+    for mission_id, deltas in changes.items():
+        apply(mission_id, deltas)
+
+
+#========== ROLLUPS ============================================================================================================
+def compute_statistics(mission_id):
+    """Count everything from scratch with aggregate queries, returns {(kind, key): count}"""
+    counts = {}
+
+    detections = Detection.objects.filter(mission_id=mission_id)
+    counts[('detections', 'total')] = detections.count()
+    for minute, count in detections.annotate(minute=TruncMinute('timestamp')).values('minute').annotate(count=Count('id')).values_list('minute', 'count'):
+        counts[('detections_over_time', time_key(minute))] = count
+
+    victims = Victim.objects.filter(detection__mission_id=mission_id)
+    counts[('victims', 'total')] = victims.count()
+    for field in ('condition', 'movement_category'):
+        for value, count in victims.values(field).annotate(count=Count('id')).values_list(field, 'count'):
+            counts[(field, str(value))] = count
+    for is_found, count in victims.values('is_found').annotate(count=Count('id')).values_list('is_found', 'count'):
+        counts[('found', 'found' if is_found else 'not_found')] = count
+
+    buckets = victims.annotate(bucket=Floor(Cast('person_recognition_confidence', FloatField()) * CONFIDENCE_BUCKETS))
+    for bucket, count in buckets.values('bucket').annotate(count=Count('id')).values_list('bucket', 'count'):
+        key = confidence_key((bucket or 0) / CONFIDENCE_BUCKETS)
+        counts[('confidence', key)] = counts.get(('confidence', key), 0) + count
+
+    return {key: count for key, count in counts.items() if count}
+
+
+def rebuild_statistics(mission_id):
+    """Replace the counters of a mission with freshly computed ones"""
+    with transaction.atomic():
+        MissionStatistic.objects.filter(mission_id=mission_id).delete()
+        MissionStatistic.objects.bulk_create([
+            MissionStatistic(mission_id=mission_id, kind=kind, key=key, count=count)
+            for (kind, key), count in compute_statistics(mission_id).items()
+        ])
+
+
+def get_summary(mission_id, interval=None):
+    """Mission summary from the counters, detections over time are merged into interval buckets"""
+    interval = interval or TIME_BUCKET
+    counters = {}
+    for kind, key, count in MissionStatistic.objects.filter(mission_id=mission_id).values_list('kind', 'key', 'count'):
+        if count:
+            counters.setdefault(kind, {})[key] = count
+
+    seconds = max(int(interval.total_seconds()), 60)
+    over_time = {}
+    for key, count in counters.get('detections_over_time', {}).items():
+        start = datetime.datetime.strptime(key, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+        bucket = datetime.datetime.fromtimestamp(int(start.timestamp()) // seconds * seconds, tz=datetime.timezone.utc)
+        over_time[bucket] = over_time.get(bucket, 0) + count
+
+    found = counters.get('found', {})
+    confidence = counters.get('confidence', {})
+    return {
+        'mission_id': mission_id,
+        'detections_count': counters.get('detections', {}).get('total', 0),
+        'victims_count': counters.get('victims', {}).get('total', 0),
+        'interval_seconds': seconds,
+        'detections_over_time': [
+            {'start': bucket.strftime('%Y-%m-%dT%H:%M:%SZ'), 'count': count} for bucket, count in sorted(over_time.items())
+        ],
+        'victims_by_condition': counters.get('condition', {}),
+        'victims_by_movement_category': counters.get('movement_category', {}),
+        'found': {'found': found.get('found', 0), 'not_found': found.get('not_found', 0)},
+        'confidence_distribution': [
+            {
+                'min': bucket / CONFIDENCE_BUCKETS,
+                'max': (bucket + 1) / CONFIDENCE_BUCKETS,
+                'count': confidence.get(confidence_key(bucket / CONFIDENCE_BUCKETS), 0),
+            }
+            for bucket in range(CONFIDENCE_BUCKETS)
+        ],
+    }
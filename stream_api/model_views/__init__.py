@@ -1,11 +1,11 @@
-from .detection_views import DetectionList, CaptureDetectionView, DetectionImageView, DetectionDetail, DetectionsByMissionView
-from .mission_views import MissionList, MissionDetail
+from .detection_views import DetectionList, CaptureDetectionView, AutoCaptureView, DetectionImageView, DetectionDetail, DetectionsByMissionView
+from .mission_views import MissionList, MissionDetail, MissionExportView, MissionSummaryView
 from .victim_views import AllVictimsView, VictimDetailView, VictimsByDetectionView
 from .person_detection_model_views import PersonDetectionModelDetail, PersonDetectionModelList
 
 __all__ = [
-    DetectionList, CaptureDetectionView, DetectionImageView, DetectionDetail, DetectionsByMissionView,
-    MissionList, MissionDetail,
+    DetectionList, CaptureDetectionView, AutoCaptureView, DetectionImageView, DetectionDetail, DetectionsByMissionView,
+    MissionList, MissionDetail, MissionExportView, MissionSummaryView,
     AllVictimsView, VictimDetailView, VictimsByDetectionView,
     PersonDetectionModelDetail, PersonDetectionModelList,
 ]
\ No newline at end of file
@@ -1,26 +1,22 @@
 from django.http import Http404
 from django.http import HttpResponse, StreamingHttpResponse
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
+from django.db import transaction
 
 from rest_framework.decorators import api_view
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-import os
 import datetime
 import mimetypes
+import time
 
-from ultralytics import YOLO
-import cv2
-
+from stream_api import metrics
+from stream_api.admission import admitted
+from stream_api.fast_json import CHUNK_SIZE, detection_rows, json_response, stream_list
 from stream_api.models import Detection, Mission, PersonDetectionModel, Victim
 from stream_api.serializers import DetectionSerializer
-
-
-# Load the model once
-detection_model = YOLO("best.pt")
+from stream_api.snapshot_storage import get_snapshot_storage
 
 
 #========== DETECTION VIEWS ====================================================================================================
@@ -69,7 +65,7 @@ class DetectionDetail(APIView):
 
 class DetectionsByMissionView(APIView):
     """
-    Get all detections for a specific mission
+    Get all detections for a specific mission, ?stream=1 sends the list while it is read
     """
     def get(self, request, mission_id):
         try:
@@ -78,25 +74,16 @@ class DetectionsByMissionView(APIView):
             
             # Get all detections for this mission
             detections = Detection.objects.filter(mission=mission).order_by('-timestamp')
-            
-            # Serialize the detections
-            serializer = DetectionSerializer(detections, many=True)
-            
-            # Add image URLs to each detection
-            detections_data = []
-            for detection in detections:
-                detection_data = DetectionSerializer(detection).data
-                if detection.snapshot:
-                    image_url = request.build_absolute_uri(f'/api/detection/{detection.id}/image/')
-                    detection_data['image_url'] = image_url
-                else:
-                    detection_data['image_url'] = None
-                detections_data.append(detection_data)
-            
-            return Response({
+            if request.query_params.get('stream') == '1':
+                header = {'mission_id': mission_id, 'detections_count': detections.count()}
+                return stream_list(header, 'detections', detection_rows(detections, request, CHUNK_SIZE))
+
+            # Flat rows in the DetectionSerializer format, image URLs included
+            rows = list(detection_rows(detections, request))
+            return json_response({
                 'mission_id': mission_id,
-                'detections_count': len(detections),
-                'detections': detections_data
+                'detections_count': len(rows),
+                'detections': rows
             })
             
         except Mission.DoesNotExist:
@@ -114,106 +101,243 @@ class DetectionsByMissionView(APIView):
 
 class CaptureDetectionView(APIView):
     """
-    API View to capture current detection and save to database
+    API View to capture a detection and save it to database.
+    With seq (the X-Frame-Seq of a detection stream frame, or the seq of a metadata event) and
+    source, the boxes and annotated frame the stream showed for that frame are saved as they are.
+    Without seq the latest frame is captured, with the result the selected model found on it.
+    With burst_seconds, the burst_frames most confident frames of the seconds up to the captured
+    one are saved from the pre-trigger buffer instead, each as its own Detection.
+    Detections record the model that found the boxes, person_detection_model_id is ignored.
     """
+    @admitted('capture')
     def post(self, request):
+        # Imported here so the rest of the API does not load the vision stack
+        from stream_api.detection_pipeline import get_detection_pipeline
+        from stream_api.frames import DEFAULT_SOURCE
+        from stream_api.ring_buffer import get_config as get_buffer_config
+
+        started = time.perf_counter()
         try:
             # 1. Get required parameters
             mission_id = request.data.get('mission_id')
-            person_detection_model_id = request.data.get('person_detection_model_id', 2)
+            seq = request.data.get('seq')
+            source_name = request.data.get('source', DEFAULT_SOURCE)
             latitude = request.data.get('latitude', 0.0)
             longitude = request.data.get('longitude', 0.0)
             is_live = request.data.get('is_live', False)
+            burst_seconds = request.data.get('burst_seconds')
+            burst_frames = request.data.get('burst_frames', 1)
+
+            if burst_seconds is not None:
+                buffer_config = get_buffer_config()
+                try:
+                    burst_seconds = float(burst_seconds)
+                    burst_frames = int(burst_frames)
+                except (TypeError, ValueError):
+                    return Response({"error": "burst_seconds and burst_frames must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+                if not 0 < burst_seconds <= buffer_config['SECONDS'] or not 1 <= burst_frames <= buffer_config['MAX_BURST_FRAMES']:
+                    return Response(
+                        {"error": f"burst_seconds must be within 0-{buffer_config['SECONDS']} and burst_frames "
+                                  f"within 1-{buffer_config['MAX_BURST_FRAMES']}"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
 
-            # 2. Get Mission & PersonDetectionModel objects
+            # 2. Get Mission object
             mission = Mission.objects.get(id=mission_id)
-            person_detection_model = PersonDetectionModel.objects.get(id=person_detection_model_id)
-            
-            # 3.1. Check if image exists
-            if not os.path.exists("image.jpg"):
-                return Response({"error": "No image available to capture"}, status=status.HTTP_400_BAD_REQUEST)
-            
-            # 3.2. Load and process the image
-            image = cv2.imread("image.jpg")
-            if image is None:
-                return Response({"error": "Failed to load image"}, status=status.HTTP_400_BAD_REQUEST)
-            
-            # 3.3. Run YOLO detection
-            results = detection_model(image, conf=0.5)
-            
-            # 3.4. Create annotated frame for saving
-            annotated_frame = results[0].plot()
-            
-            # 3.5. Convert annotated frame to bytes for saving
-            ret, jpeg_buffer = cv2.imencode('.jpg', annotated_frame)
-            if not ret:
+            try:
+                pipeline = get_detection_pipeline(source_name)
+            except KeyError:
+                return Response({"error": f"Unknown source: {source_name}"}, status=status.HTTP_404_NOT_FOUND)
+
+            # 3.1. Find the result of the frame the operator saw, it is only kept for a few seconds
+            if seq is not None:
+                try:
+                    result = pipeline.get_result(int(seq))
+                except (TypeError, ValueError):
+                    return Response({"error": "seq must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+                if result is None:
+                    metrics.inc('capture_frames_total', outcome='expired')
+                    return Response({"error": "Frame is no longer available, capture the current frame instead"},
+                                    status=status.HTTP_410_GONE)
+                metrics.inc('capture_frames_total', outcome='cached')
+
+            # 3.2. Otherwise the latest frame, detected with the selected model unless the stream already did
+            else:
+                frame = pipeline.source.wait_for_frame(0, timeout=1.0)
+                if frame is None:
+                    return Response({"error": "No image available to capture"}, status=status.HTTP_400_BAD_REQUEST)
+                result = pipeline.get_result(frame.seq)
+                if result is not None:
+                    metrics.inc('capture_frames_total', outcome='cached')
+                else:
+                    try:
+                        with metrics.span('capture', 'inference'):
+                            result = pipeline.process(frame)
+                    except ValueError:
+                        return Response({"error": "Failed to load image"}, status=status.HTTP_400_BAD_REQUEST)
+                    metrics.inc('capture_frames_total', outcome='inferred')
+
+            # 3.3. A burst takes the most confident frames of the buffer, the captured frame included
+            results = [result]
+            if burst_seconds is not None:
+                results = pipeline.buffer.best(result.timestamp - burst_seconds, result.timestamp, burst_frames, include=result)
+
+            # 4. Save every frame with its victims
+            model_ids = {result.model_id for result in results}
+            if PersonDetectionModel.objects.filter(id__in=model_ids).count() != len(model_ids):
+                return Response({"error": "The model that detected the frame was deleted, capture the current frame instead"},
+                                status=status.HTTP_409_CONFLICT)
+            try:
+                saved = [self.save_result(result, mission, latitude, longitude, is_live) for result in results]
+            except PersonDetectionModel.DoesNotExist:
+                return Response({"error": "The model that detected the frame was deleted, capture the current frame instead"},
+                                status=status.HTTP_409_CONFLICT)
+            except ValueError:
                 return Response(
                     {"error": "Failed to encode annotated image"}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
             
-            # 4. Create Detection object
+            metrics.observe('stage_latency_seconds', time.perf_counter() - started, path='capture', stage='total')
+            metrics.mark_frame('capture', len(saved))
+
+            # The most confident frame answers like a single capture, a burst lists all of them
+            best = max(range(len(results)), key=lambda i: results[i].best_confidence())
+            data = dict(saved[best])
+            if burst_seconds is not None:
+                data['burst'] = saved
+            return Response(data, status=status.HTTP_201_CREATED)
+        except Exception as e:
+            return Response({"error": f"An error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def save_result(self, result, mission, latitude, longitude, is_live):
+        """Save the annotated frame of a detection result with a Victim per box, returns the response data"""
+        from stream_api.pose import get_pose_stage
+
+        person_detection_model = PersonDetectionModel.objects.get(id=result.model_id)
+
+        # The annotated frame the stream sent, or drawn and encoded here once
+        with metrics.span('capture', 'render'):
+            jpeg_bytes = result.annotated_jpeg()
+
+        # Store the annotated image and create the Detection object with its final path,
+        # the snapshot file itself is written in the background
+        with transaction.atomic():
+            with metrics.span('capture', 'save_snapshot'):
+                snapshot_name = get_snapshot_storage().store(jpeg_bytes)
             detection = Detection.objects.create(
                 mission=mission,
                 person_detection_model=person_detection_model,
                 latitude=latitude,
                 longitude=longitude,
-                timestamp=datetime.datetime.now(),
-                is_live=is_live
+                timestamp=datetime.datetime.fromtimestamp(result.timestamp, tz=datetime.timezone.utc),
+                is_live=is_live,
+                snapshot=snapshot_name
             )
-            
-            # 5. Save the annotated image in the detection object
-            image_name = f"detection_id_{detection.id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-            detection.snapshot.save(image_name, ContentFile(jpeg_buffer.tobytes()), save=True)
-            
-            # 6. Process detections and create Victim objects
-            victims_created = []
-
-            boxes = results[0].boxes if results[0].boxes is not None else []
-
-            if len(boxes) > 0:
-                for i, box in enumerate(boxes):
-                    # Extract bounding box coordinates
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                    confidence = float(box.conf[0].cpu().numpy())
-                    
-                    # Create bounding box dict
-                    bounding_box = {
-                        'x1': float(x1),
-                        'y1': float(y1),
-                        'x2': float(x2),
-                        'y2': float(y2)
-                    }
-                    
-                    # Generate unique person ID
-                    person_id = f"person_{detection.id}_{i+1}"
-                    
-                    # Create Victim record/object
-                    victim = Victim.objects.create(
-                        detection=detection,
-                        person_id=person_id,
-                        person_recognition_confidence=confidence,
-                        bounding_box=bounding_box,
-                        coco_keypoints={},  # You can add keypoint detection if needed
-                        movement_category='unknown',
-                        condition='unknown',
-                        is_found=False,
-                        estimated_latitude=latitude,
-                        estimated_longitude=longitude
-                    )
-                    
-                    victims_created.append({
-                        'id': victim.id,
-                        'person_id': person_id,
-                        'confidence': confidence,
-                        'bounding_box': bounding_box
-                    })
-            
-            # Serialize the detection for response
-            detection_serializer = DetectionSerializer(detection)
-            return Response({"victims": victims_created , "data": detection_serializer.data}, status=status.HTTP_201_CREATED)
-        except Exception as e:
-            return Response({"error": f"An error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        
+        # Process detections and create Victim objects
+        victims_created = []
+
+        if len(result.boxes) > 0:
+            for i, (box, box_confidence) in enumerate(zip(result.boxes, result.confidences)):
+                # Extract bounding box coordinates
+                x1, y1, x2, y2 = box
+                confidence = float(box_confidence)
+                
+                # Create bounding box dict
+                bounding_box = {
+                    'x1': float(x1),
+                    'y1': float(y1),
+                    'x2': float(x2),
+                    'y2': float(y2)
+                }
+                
+                # Generate unique person ID
+                person_id = f"person_{detection.id}_{i+1}"
+                
+                # Create Victim record/object
+                victim = Victim.objects.create(
+                    detection=detection,
+                    person_id=person_id,
+                    person_recognition_confidence=confidence,
+                    bounding_box=bounding_box,
+                    coco_keypoints={},  # You can add keypoint detection if needed
+                    movement_category='unknown',
+                    condition='unknown',
+                    is_found=False,
+                    estimated_latitude=latitude,
+                    estimated_longitude=longitude
+                )
+                
+                victims_created.append({
+                    'id': victim.id,
+                    'person_id': person_id,
+                    'confidence': confidence,
+                    'bounding_box': bounding_box
+                })
+
+        # Keypoints and postures are filled in by the pose stage in the background
+        pose_stage = get_pose_stage()
+        if pose_stage is not None:
+            pose_stage.submit(result.frame.jpeg, [(victim['id'], box) for victim, box in zip(victims_created, result.boxes)])
+
+        # Serialize the detection for response
+        detection_serializer = DetectionSerializer(detection)
+        return {"victims": victims_created , "data": detection_serializer.data}
+
+
+class AutoCaptureView(APIView):
+    """
+    Auto-capture of a frame source (?source= or "source", the default source otherwise).
+    POST {mission_id, latitude, longitude} saves every new person the shared detection pipeline
+    finds into the mission, posting again for the same mission updates the location.
+    GET returns the running session, DELETE stops it.
+    """
+    def get_source_name(self, request):
+        from stream_api.frames import DEFAULT_SOURCE
+
+        return request.query_params.get('source') or request.data.get('source') or DEFAULT_SOURCE
+
+    def get(self, request):
+        from stream_api import auto_capture
+
+        source_name = self.get_source_name(request)
+        try:
+            session = auto_capture.get_session(source_name)
+        except KeyError:
+            return Response({"error": f"Unknown source: {source_name}"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'source': source_name, 'enabled': session is not None,
+                         'session': session.to_dict() if session is not None else None})
+
+    def post(self, request):
+        from stream_api import auto_capture
+
+        source_name = self.get_source_name(request)
+        try:
+            latitude = float(request.data.get('latitude', 0.0))
+            longitude = float(request.data.get('longitude', 0.0))
+        except (TypeError, ValueError):
+            return Response({"error": "latitude and longitude must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            mission = Mission.objects.get(id=request.data.get('mission_id'))
+        except (Mission.DoesNotExist, TypeError, ValueError):
+            return Response({"error": "Mission not found"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            session = auto_capture.start(source_name, mission.id, latitude, longitude)
+        except KeyError:
+            return Response({"error": f"Unknown source: {source_name}"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'source': source_name, 'enabled': True, 'session': session.to_dict()})
+
+    def delete(self, request):
+        from stream_api import auto_capture
+
+        source_name = self.get_source_name(request)
+        try:
+            session = auto_capture.stop(source_name)
+        except KeyError:
+            return Response({"error": f"Unknown source: {source_name}"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'source': source_name, 'enabled': False,
+                         'session': session.to_dict() if session is not None else None})
 
 
 class DetectionImageView(APIView):
@@ -229,22 +353,17 @@ class DetectionImageView(APIView):
             if not detection.snapshot:
                 return Response({"error": "No snapshot available for this detection"}, status=status.HTTP_404_NOT_FOUND)
             
-            # Get the file path
-            image_path = detection.snapshot.path
-            
-            # Check if file exists on disk
-            if not os.path.exists(image_path):
+            # Read the image, it may still be waiting for the background writer
+            try:
+                image_data = get_snapshot_storage().read(detection.snapshot.name)
+            except FileNotFoundError:
                 return Response({"error": "Snapshot file not found on disk"}, status=status.HTTP_404_NOT_FOUND)
             
             # Determine content type
-            content_type, _ = mimetypes.guess_type(image_path)
+            content_type, _ = mimetypes.guess_type(detection.snapshot.name)
             if content_type is None:
                 content_type = 'image/jpeg'
             
-            # Read and return the image
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-            
             response = HttpResponse(image_data, content_type=content_type)
             response['Content-Disposition'] = f'inline; filename="detection_{detection_id}.jpg"'
             return response
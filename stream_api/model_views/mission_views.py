@@ -1,4 +1,4 @@
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 
 from rest_framework.decorators import api_view
 from rest_framework.views import APIView
@@ -7,7 +7,10 @@ from rest_framework import status
 
 import datetime
 
+from stream_api.mission_archive import FORMATS, export_mission
+from stream_api.mission_statistics import get_summary
 from stream_api.models import Mission
+from stream_api.response_cache import cached_response
 from stream_api.serializers import MissionSerializer
 
 
@@ -15,6 +18,7 @@ class MissionList(APIView):
     """
     List all missions, or create a new mission.
     """
+    @cached_response('mission')
     def get(self, request, format=None):
         mission = Mission.objects.all()
         serializer = MissionSerializer(mission, many=True)
@@ -49,6 +53,7 @@ class MissionDetail(APIView):
         except Mission.DoesNotExist:
             raise Http404
 
+    @cached_response('mission')
     def get(self, request, pk, format=None):
         mission = self.get_object(pk)
         serializer = MissionSerializer(mission)
@@ -78,3 +83,49 @@ class MissionDetail(APIView):
         mission.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
     
+
+
+class MissionExportView(APIView):
+    """
+    Download a mission as a tar archive of columnar chunks, see stream_api/mission_archive.py
+    """
+    def get(self, request, pk, format=None):
+        try:
+            mission = Mission.objects.get(pk=pk)
+        except Mission.DoesNotExist:
+            return Response({"error": "Mission not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        export_format = request.query_params.get('format', 'npz')
+        if export_format not in FORMATS:
+            return Response({"error": f"format must be one of {', '.join(FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        snapshots = request.query_params.get('snapshots', '1') != '0'
+
+        try:
+            chunks = export_mission(mission, fmt=export_format, snapshots=snapshots)
+            # Start the generator here so a missing pyarrow is reported as an error response
+            first_chunk = next(chunks)
+        except ImportError:
+            return Response({"error": "Parquet export needs pyarrow"}, status=status.HTTP_400_BAD_REQUEST)
+
+        def stream():
+            yield first_chunk
+            yield from chunks
+
+        response = StreamingHttpResponse(stream(), content_type='application/x-tar')
+        response['Content-Disposition'] = f'attachment; filename="mission_{mission.id}_{export_format}.tar"'
+        return response
+
+
+class MissionSummaryView(APIView):
+    """
+    Mission statistics read from the incrementally maintained counters.
+    ?interval=<seconds> sets the bucket size of detections_over_time (default 60)
+    """
+    def get(self, request, pk, format=None):
+        if not Mission.objects.filter(pk=pk).exists():
+            return Response({"error": "Mission not found"}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            interval = datetime.timedelta(seconds=int(request.query_params.get('interval', 60)))
+        except ValueError:
+            return Response({"error": "interval must be a number of seconds"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(get_summary(pk, interval))
@@ -6,6 +6,7 @@ from rest_framework.response import Response
 from rest_framework import status
 
 from stream_api.models import PersonDetectionModel
+from stream_api.response_cache import cached_response, invalidate
 from stream_api.serializers import PersonDetectionModelSerializer
 
 
@@ -13,6 +14,7 @@ class PersonDetectionModelList(APIView):
     """
     List all Person Detection Models, or create a new Person Detection Model.
     """
+    @cached_response('person_detection_model')
     def get(self, request, format=None):
         person_detection_models = PersonDetectionModel.objects.all()
         serializer = PersonDetectionModelSerializer(person_detection_models, many=True)
@@ -64,6 +66,9 @@ class PersonDetectionModelDetail(APIView):
             # 3.2. Set confidence threshold for all models
             PersonDetectionModel.objects.all().update(confidence = conf)
 
+            # QuerySet.update() sends no signals
+            invalidate('person_detection_model')
+
             return Response(PersonDetectionModelSerializer(person_detection_model).data, status=status.HTTP_200_OK)
         except PersonDetectionModel.DoesNotExist:
             return Response({"error": "PersonDetectionModel not found"}, status=status.HTTP_404_NOT_FOUND)
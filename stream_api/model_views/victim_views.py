@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.http import Http404
 
 from rest_framework.decorators import api_view
@@ -5,8 +6,12 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
+from stream_api.fast_json import CHUNK_SIZE, json_response, stream_list, victim_rows
+from stream_api.mission_statistics import VICTIM_FIELDS, count_victim_updates
 from stream_api.models import Detection, Victim
-from stream_api.serializers import VictimSerializer
+from stream_api.response_cache import cached_response, invalidate
+from stream_api.serializers import VictimBulkUpdateSerializer, VictimSerializer
+from stream_api.signals import victims_updated
 
 
 class VictimDetailView(APIView):
@@ -36,7 +41,7 @@ class VictimDetailView(APIView):
             
             # Update fields that can be modified
             victim.movement_category = request.data.get('movement_category', victim.movement_category)
-            victim.risk_category = request.data.get('risk_category', victim.risk_category)
+            victim.condition = request.data.get('condition', victim.condition)
             victim.is_found = request.data.get('is_found', victim.is_found)
             victim.estimated_latitude = request.data.get('estimated_latitude', victim.estimated_latitude)
             victim.estimated_longitude = request.data.get('estimated_longitude', victim.estimated_longitude)
@@ -65,15 +70,19 @@ class VictimDetailView(APIView):
 
 class AllVictimsView(APIView):
     """
-    Get all victims across all detections
+    Get all victims across all detections, ?stream=1 sends the list while it is read.
+    PATCH {"ids": [...], "changes": {...}} updates many victims at once
     """
     def get(self, request):
         try:
             victims = Victim.objects.all().order_by('-detection__timestamp')
-            serializer = VictimSerializer(victims, many=True)
-            return Response({
-                'victims_count': len(victims),
-                'victims': serializer.data
+            if request.query_params.get('stream') == '1':
+                return stream_list({'victims_count': victims.count()}, 'victims', victim_rows(victims, CHUNK_SIZE))
+
+            rows = list(victim_rows(victims))
+            return json_response({
+                'victims_count': len(rows),
+                'victims': rows
             })
         except Exception as e:
             return Response(
@@ -81,11 +90,41 @@ class AllVictimsView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    def patch(self, request):
+        serializer = VictimBulkUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+        changes = serializer.validated_data['changes']
+
+        with transaction.atomic():
+            victims = Victim.objects.select_for_update().filter(id__in=ids)
+            previous = {row[0]: (row[1], row[2:]) for row in victims.values_list('id', 'detection__mission_id', *VICTIM_FIELDS)}
+            missing = [pk for pk in ids if pk not in previous]
+            if missing:
+                return Response({"error": "Victims not found", "ids": missing}, status=status.HTTP_404_NOT_FOUND)
+
+            # One UPDATE ... WHERE id IN (...), it sends no signals so the counters and caches are updated here
+            victims.update(**changes)
+            count_victim_updates(
+                (mission_id, values, tuple(changes.get(field, value) for field, value in zip(VICTIM_FIELDS, values)))
+                for mission_id, values in previous.values()
+            )
+            invalidate('victim')
+            transaction.on_commit(lambda: victims_updated.send(sender=Victim, ids=ids, changes=changes))
+
+        rows = list(victim_rows(Victim.objects.filter(id__in=ids).order_by('id')))
+        return json_response({
+            'victims_count': len(rows),
+            'victims': rows
+        })
+
 
 class VictimsByDetectionView(APIView):
     """
     Get all victims for a specific detection
     """
+    @cached_response('detection', 'victim')
     def get(self, request, detection_id):
         try:
             # Check if detection exists
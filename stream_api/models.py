@@ -1,4 +1,6 @@
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.utils import timezone
     
 
 class Mission(models.Model):
@@ -9,21 +11,56 @@ class Mission(models.Model):
         return f"Mission ID: {self.id}"
     
 
+class RetentionPolicy(models.Model):
+    """How long the snapshots of a mission are kept, missions without one use settings.RETENTION"""
+    mission = models.OneToOneField(Mission, on_delete=models.CASCADE, related_name='retention_policy')
+    full_resolution_days = models.PositiveIntegerField(default=30)  # Older snapshots are downsampled to thumbnails
+    thumbnail_size = models.PositiveIntegerField(default=320)  # Longest side of the thumbnails in pixels
+    delete_after_days = models.PositiveIntegerField(blank=True, null=True)  # Older detections are deleted, None keeps them
+
+    def __str__(self):
+        return f"Retention Policy for Mission ID: {self.mission.id}"
+
+
+# Smaller tiles or larger overlaps multiply the tiles per frame, an overlap near 1 makes one tile per pixel
+MIN_TILE_SIZE = 160
+MAX_TILE_OVERLAP = 0.75
+MAX_TILE_PARALLELISM = 16
+
+
 class PersonDetectionModel(models.Model):
     model_type = models.CharField(max_length=150, unique=True)
     is_selected = models.BooleanField(default=False)
     confidence = models.FloatField(default=0.5)
+    # Tiled inference splits high resolution frames into overlapping tiles so small people are found
+    tiled_inference = models.BooleanField(default=False)
+    tile_size = models.PositiveIntegerField(default=640, validators=[MinValueValidator(MIN_TILE_SIZE)])
+    # Fraction of the tile size shared with the next tile
+    tile_overlap = models.FloatField(default=0.2, validators=[MinValueValidator(0.0), MaxValueValidator(MAX_TILE_OVERLAP)])
+    # Tiles run concurrently when the backend can't batch
+    tile_parallelism = models.PositiveIntegerField(default=2, validators=[MinValueValidator(1), MaxValueValidator(MAX_TILE_PARALLELISM)])
 
     def __str__(self):
         return f"Model ID: {self.id} - Type: {self.model_type}"
 
+    def get_tiling(self):
+        """Tiling options for the inference backends, None when tiling is off"""
+        if not self.tiled_inference:
+            return None
+        # Rows saved before the validators existed are clamped into range
+        return {
+            'tile_size': max(self.tile_size, MIN_TILE_SIZE),
+            'overlap': min(max(self.tile_overlap, 0.0), MAX_TILE_OVERLAP),
+            'parallelism': min(max(self.tile_parallelism, 1), MAX_TILE_PARALLELISM),
+        }
+
 
 class Detection(models.Model):
     mission = models.ForeignKey(Mission, on_delete=models.CASCADE)
     person_detection_model = models.ForeignKey(PersonDetectionModel, on_delete=models.CASCADE, default=2)
     latitude = models.FloatField(default=0.0)
     longitude = models.FloatField(default=0.0)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)  # Frame time of captures, insert time otherwise
     is_live = models.BooleanField(default=False)
     snapshot = models.ImageField(upload_to = "snapshots/", blank=True, null=True)
 
@@ -53,4 +90,31 @@ class PostureClassification(models.Model):
     confidence = models.FloatField(default=0.0)
 
     def __str__(self):
-        return f"Posture Classification ID: {self.id} for Victim ID: {self.victim.id}"
\ No newline at end of file
+        return f"Posture Classification ID: {self.id} for Victim ID: {self.victim.id}"
+
+class SnapshotBlob(models.Model):
+    """Content addressed snapshot file, stored once however many detections use it"""
+    name = models.CharField(max_length=255, unique=True)  # Storage path, named after the SHA-256 of the content
+    size = models.PositiveIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    missing = models.BooleanField(default=False)  # The file could not be written, the next store of the content writes it
+
+    def __str__(self):
+        return f"Snapshot Blob: {self.name} ({self.ref_count} references)"
+
+
+class MissionStatistic(models.Model):
+    """Counter of a mission summary, kept up to date on Detection/Victim writes (see stream_api/mission_statistics.py)"""
+    mission = models.ForeignKey(Mission, on_delete=models.CASCADE, related_name='statistics')
+    kind = models.CharField(max_length=50)  # e.g. 'condition', 'confidence', 'detections_over_time'
+    key = models.CharField(max_length=100)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['mission', 'kind', 'key'], name='unique_mission_statistic'),
+        ]
+
+    def __str__(self):
+        return f"Mission ID: {self.mission_id} - {self.kind} {self.key}: {self.count}"
@@ -0,0 +1,135 @@
+"""
+Detection overlay renderer of the annotated streams, captures and the inference service.
+
+Box edges are copied from box colored strips and labels from patches composed of glyph
+masks rendered once per character, so drawing a frame costs a few array copies per box. The
+frame is drawn into a buffer the renderer keeps between frames, at the frame's own size
+or smaller, so viewers that ask for a reduced stream get it drawn and encoded at their
+resolution. Every thread has its own renderer, get_renderer(), whose buffer is only
+valid until that thread renders the next frame.
+"""
+import threading
+
+import cv2
+import numpy as np
+
+
+BOX_COLOR = (56, 56, 255)  # BGR
+TEXT_COLOR = (255, 255, 255)
+LINE_WIDTH = 2
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5
+LABEL_PADDING = 2
+LABEL_CACHE_SIZE = 1024
+
+
+class OverlayRenderer:
+    """
+    Draws boxes and "<class> <confidence>" labels into a reusable BGR frame buffer
+    """
+    def __init__(self, box_color=BOX_COLOR, text_color=TEXT_COLOR, line_width=LINE_WIDTH, font_scale=FONT_SCALE):
+        self.box_color = np.array(box_color, dtype=np.uint8)
+        self.text_color = np.array(text_color, dtype=np.uint8)
+        self.line_width = line_width
+        self.font_scale = font_scale
+        (_, text_height), baseline = cv2.getTextSize('Ag', FONT, font_scale, 1)
+        self.text_origin = LABEL_PADDING + text_height
+        self.label_height = text_height + baseline + 2 * LABEL_PADDING
+        self._glyphs = {}
+        self._labels = {}
+        self._buffer = None
+        self._rows = self._columns = None
+
+    def glyph(self, char):
+        """Mask of one character, as tall as a label"""
+        mask = self._glyphs.get(char)
+        if mask is None:
+            (width, _), _ = cv2.getTextSize(char, FONT, self.font_scale, 1)
+            canvas = np.zeros((self.label_height, max(width, 1)), dtype=np.uint8)
+            cv2.putText(canvas, char, (0, self.text_origin), FONT, self.font_scale, 255, 1, cv2.LINE_8)
+            mask = self._glyphs[char] = canvas > 0
+        return mask
+
+    def label(self, text):
+        """BGR patch of a label, composed from the cached glyphs"""
+        patch = self._labels.get(text)
+        if patch is None:
+            if len(self._labels) >= LABEL_CACHE_SIZE:
+                self._labels.clear()
+            padding = np.zeros((self.label_height, LABEL_PADDING), dtype=bool)
+            mask = np.hstack([padding] + [self.glyph(char) for char in text] + [padding])
+            patch = self._labels[text] = np.where(mask[:, :, None], self.text_color, self.box_color).astype(np.uint8)
+        return patch
+
+    def buffer(self, height, width):
+        if self._buffer is None or self._buffer.shape[:2] != (height, width):
+            self._buffer = np.empty((height, width, 3), dtype=np.uint8)
+        return self._buffer
+
+    def strips(self, height, width):
+        """Box colored rows and columns as long as the frame, box edges are copied from them"""
+        if self._rows is None or self._rows.shape[1] < width or self._columns.shape[0] < height:
+            self._rows = np.empty((self.line_width, width, 3), dtype=np.uint8)
+            self._rows[:] = self.box_color
+            self._columns = np.empty((height, self.line_width, 3), dtype=np.uint8)
+            self._columns[:] = self.box_color
+        return self._rows, self._columns
+
+    def render(self, image, boxes, confidences, class_ids, names, orig_shape=None, size=None):
+        """
+        Copy image into the buffer, resized to size (width, height) when given, and draw on it.
+        boxes are in the coordinates of an orig_shape (height, width) image, image.shape by default.
+        Returns the buffer, which is overwritten by the next render() of this renderer.
+        """
+        height, width = image.shape[:2]
+        if size is None or tuple(size) == (width, height):
+            frame = self.buffer(height, width)
+            np.copyto(frame, image)
+        else:
+            frame = self.buffer(size[1], size[0])
+            cv2.resize(image, tuple(size), dst=frame, interpolation=cv2.INTER_LINEAR)
+        return self.draw(frame, boxes, confidences, class_ids, names, orig_shape or image.shape[:2])
+
+    def draw(self, frame, boxes, confidences, class_ids, names, orig_shape=None):
+        """Draw onto frame in place, boxes are scaled from orig_shape to the frame size"""
+        height, width = frame.shape[:2]
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        if not len(boxes):
+            return frame
+        orig_height, orig_width = orig_shape or (height, width)
+        factors = np.array([width / orig_width, height / orig_height] * 2, dtype=np.float32)
+        corners = np.rint(boxes * factors).astype(np.int32)
+        np.clip(corners, 0, [width, height, width, height], out=corners)
+        rows, columns = self.strips(height, width)
+        line = self.line_width
+
+        # Python numbers, formatting numpy scalars costs more than drawing
+        confidences = np.asarray(confidences, dtype=np.float32).tolist()
+        class_ids = np.asarray(class_ids).tolist()
+        for (x1, y1, x2, y2), confidence, class_id in zip(corners.tolist(), confidences, class_ids):
+            if x2 <= x1 or y2 <= y1:
+                continue
+            top_edge, left_edge = min(line, y2 - y1), min(line, x2 - x1)
+            frame[y1:y1 + top_edge, x1:x2] = rows[:top_edge, :x2 - x1]
+            frame[y2 - top_edge:y2, x1:x2] = rows[:top_edge, :x2 - x1]
+            frame[y1:y2, x1:x1 + left_edge] = columns[:y2 - y1, :left_edge]
+            frame[y1:y2, x2 - left_edge:x2] = columns[:y2 - y1, :left_edge]
+
+            patch = self.label(f"{names.get(class_id, class_id)} {confidence:.2f}")
+            # Above the box, or inside it at the top edge of the frame
+            top = y1 - patch.shape[0] if y1 >= patch.shape[0] else y1
+            bottom = min(top + patch.shape[0], height)
+            right = min(x1 + patch.shape[1], width)
+            frame[top:bottom, x1:right] = patch[:bottom - top, :right - x1]
+        return frame
+
+
+_local = threading.local()
+
+
+def get_renderer():
+    """OverlayRenderer of the calling thread"""
+    renderer = getattr(_local, 'renderer', None)
+    if renderer is None:
+        renderer = _local.renderer = OverlayRenderer()
+    return renderer
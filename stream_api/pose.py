@@ -0,0 +1,243 @@
+"""
+Pose stage: runs after person detection and fills in the keypoints of the victims of a
+detection, then classifies their posture.
+
+Captures only queue the frame and the new victims, a background thread crops every
+victim of the frame, runs all crops through the pose model in one batch and writes
+the results with bulk queries, so capture latency does not depend on the pose model.
+"""
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+import numpy as np
+
+from stream_api import metrics
+from stream_api.models import PostureClassification, Victim
+from stream_api.response_cache import invalidate
+
+
+DEFAULTS = {
+    'ENABLED': False,
+    'MODEL_PATH': os.path.join('ai_models', 'pose', 'best.pt'),
+    'CONF': 0.25,
+    'BATCH_SIZE': 16,  # Crops per model call
+    'QUEUE_SIZE': 32,  # Detections waiting for the stage, newer ones are dropped when it is full
+    'CROP_PADDING': 0.1,  # Fraction of the box size added around each crop
+}
+
+# COCO keypoint indices
+LEFT_SHOULDER, RIGHT_SHOULDER = 5, 6
+LEFT_HIP, RIGHT_HIP = 11, 12
+LEFT_KNEE, RIGHT_KNEE = 13, 14
+LEFT_ANKLE, RIGHT_ANKLE = 15, 16
+
+# Keypoints below this score are treated as not visible
+KEYPOINT_THRESHOLD = 0.3
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'POSE_ESTIMATION', {}))
+    return config
+
+
+def crop_box(image, box, padding):
+    """
+    Crop a box with some context around it, clamped to the frame. Returns the crop and its
+    top left corner, the crop is empty when the box has no area inside the frame
+    """
+    height, width = image.shape[:2]
+    x1, y1, x2, y2 = box
+    pad_x, pad_y = (x2 - x1) * padding, (y2 - y1) * padding
+    x1, y1 = min(max(int(x1 - pad_x), 0), width), min(max(int(y1 - pad_y), 0), height)
+    x2, y2 = max(min(int(x2 + pad_x), width), x1), max(min(int(y2 + pad_y), height), y1)
+    return image[y1:y2, x1:x2], (x1, y1)
+
+
+def to_coco_keypoints(keypoints):
+    """(17, 3) array of x, y, score to the COCO keypoints layout"""
+    visible = keypoints[:, 2] >= KEYPOINT_THRESHOLD
+    keypoints = keypoints.astype(np.float64)
+    flat = np.column_stack([keypoints[:, :2].round(1), keypoints[:, 2].round(3)])
+    return {'keypoints': flat.reshape(-1).tolist(), 'num_keypoints': int(visible.sum())}
+
+
+def classify_posture(keypoints):
+    """
+    Classify the posture from the torso and leg angles of the keypoints.
+    Returns the posture class and a confidence, 'unknown' when the torso is not visible.
+    """
+    def midpoint(a, b):
+        if keypoints[a, 2] < KEYPOINT_THRESHOLD or keypoints[b, 2] < KEYPOINT_THRESHOLD:
+            return None
+        return (keypoints[a, :2] + keypoints[b, :2]) / 2
+
+    shoulders, hips = midpoint(LEFT_SHOULDER, RIGHT_SHOULDER), midpoint(LEFT_HIP, RIGHT_HIP)
+    if shoulders is None or hips is None:
+        return 'unknown', 0.0
+
+    used = [LEFT_SHOULDER, RIGHT_SHOULDER, LEFT_HIP, RIGHT_HIP]
+    torso = shoulders - hips
+    torso_length = np.hypot(*torso)
+    if torso_length == 0:
+        return 'unknown', 0.0
+
+    # Angle of the torso from vertical, 0 is upright and 90 is horizontal
+    torso_angle = np.degrees(np.arctan2(abs(torso[0]), abs(torso[1])))
+    if torso_angle > 60:
+        posture = 'lying'
+    else:
+        knees = midpoint(LEFT_KNEE, RIGHT_KNEE)
+        if knees is None:
+            posture = 'standing'
+        else:
+            used += [LEFT_KNEE, RIGHT_KNEE]
+            # Thighs point down when standing and sideways when sitting
+            thigh = knees - hips
+            thigh_drop = thigh[1] / (np.hypot(*thigh) + 1e-9)
+            posture = 'standing' if thigh_drop > 0.7 else 'sitting'
+
+    return posture, round(float(keypoints[used, 2].mean()), 4)
+
+
+class PoseModel:
+    """
+    ultralytics pose model, all crops of a frame go through it as one batch
+    """
+    def __init__(self, model_path, conf):
+        from ultralytics import YOLO
+
+        self.model = YOLO(str(model_path))
+        self.conf = conf
+
+    def predict_batch(self, crops):
+        """Return the (17, 3) keypoints of the most confident person of each crop, or None"""
+        results = self.model(list(crops), conf=self.conf, verbose=False)
+        keypoints = []
+        for result in results:
+            if result.keypoints is None or len(result.boxes) == 0:
+                keypoints.append(None)
+                continue
+            best = int(result.boxes.conf.argmax())
+            xy = result.keypoints.xy[best].cpu().numpy()
+            scores = result.keypoints.conf[best].cpu().numpy() if result.keypoints.conf is not None else np.ones(len(xy))
+            keypoints.append(np.column_stack([xy, scores]))
+        return keypoints
+
+
+class PoseStage:
+    """
+    Background stage that processes the victims of captured detections
+    """
+    def __init__(self, config):
+        self.config = config
+        self._queue = queue.Queue(maxsize=config['QUEUE_SIZE'])
+        self._model = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        metrics.register_gauge('queue_depth', self._queue.qsize, path='pose', source='capture')
+
+    def submit(self, jpeg, victims):
+        """
+        Queue a frame and its victims as (victim id, box) pairs.
+        Returns False when the stage is full and the victims were skipped.
+        """
+        if not victims:
+            return True
+        try:
+            self._queue.put_nowait((jpeg, victims))
+            return True
+        except queue.Full:
+            metrics.inc('frames_dropped_total', path='pose')
+            return False
+
+    def _run(self):
+        while True:
+            jpeg, victims = self._queue.get()
+            try:
+                self.process(jpeg, victims)
+            except Exception as e:
+                print(f"Pose stage error: {e}")
+            finally:
+                close_old_connections()
+
+    def load_model(self):
+        if self._model is None:
+            self._model = PoseModel(self.config['MODEL_PATH'], self.config['CONF'])
+        return self._model
+
+    def process(self, jpeg, victims):
+        from stream_api.inference_backends import decode_jpeg
+
+        started = time.perf_counter()
+        with metrics.span('pose', 'load_model'):
+            model = self.load_model()
+
+        with metrics.span('pose', 'crop'):
+            image = decode_jpeg(jpeg)
+            cropped = []
+            for victim_id, box in victims:
+                crop, corner = crop_box(image, box, self.config['CROP_PADDING'])
+                if crop.size == 0:
+                    # Zero-area or out of frame box, skip the victim instead of failing the batch
+                    metrics.inc('frames_dropped_total', path='pose-crop')
+                    continue
+                cropped.append((victim_id, corner, crop))
+        if not cropped:
+            return
+        victim_ids, corners, crops = zip(*cropped)
+
+        keypoints = []
+        batch_size = self.config['BATCH_SIZE']
+        with metrics.span('pose', 'inference'):
+            for start in range(0, len(crops), batch_size):
+                keypoints.extend(model.predict_batch(crops[start:start + batch_size]))
+
+        updated_victims = []
+        postures = []
+        for victim_id, (x, y), victim_keypoints in zip(victim_ids, corners, keypoints):
+            if victim_keypoints is None:
+                continue
+            # Back to frame coordinates
+            victim_keypoints[:, :2] += (x, y)
+            updated_victims.append(Victim(id=victim_id, coco_keypoints=to_coco_keypoints(victim_keypoints)))
+            posture_class, confidence = classify_posture(victim_keypoints)
+            postures.append(PostureClassification(victim_id=victim_id, posture_class=posture_class, confidence=confidence))
+
+        with metrics.span('pose', 'write'):
+            with transaction.atomic():
+                # Victims deleted since the capture would fail the whole batch on the foreign key
+                existing = set(Victim.objects.filter(id__in=victim_ids).values_list('id', flat=True))
+                updated_victims = [victim for victim in updated_victims if victim.id in existing]
+                postures = [posture for posture in postures if posture.victim_id in existing]
+                Victim.objects.bulk_update(updated_victims, ['coco_keypoints'])
+                PostureClassification.objects.bulk_create(postures)
+                invalidate('victim')
+
+        metrics.observe('stage_latency_seconds', time.perf_counter() - started, path='pose', stage='total')
+        # Throughput of the stage is counted in crops, not frames
+        metrics.mark_frame('pose', count=len(crops))
+
+
+_stage = None
+_stage_lock = threading.Lock()
+
+
+def get_pose_stage():
+    """Return the pose stage, or None when it is disabled or its model is missing"""
+    global _stage
+    config = get_config()
+    if not config['ENABLED']:
+        return None
+    with _stage_lock:
+        if _stage is None:
+            if not os.path.exists(config['MODEL_PATH']):
+                print(f"Pose model not found: {config['MODEL_PATH']}")
+                return None
+            _stage = PoseStage(config)
+        return _stage
@@ -0,0 +1,189 @@
+"""
+On-demand profiling of the running server process.
+
+A session samples the stacks of every thread (stream generators, detection pipelines,
+video encoders, inference) at a fixed interval for a bounded window, and optionally traces
+the memory allocated during the window with tracemalloc. The samples are kept as folded
+stacks ("thread;outer (file:line);inner (file:line) count" lines), which flamegraph.pl,
+speedscope and inferno read as they are.
+
+Nothing is installed while no session runs: no profile hook, no tracing, no thread, so
+profiling costs nothing when it is off. Sessions are started through the admin-only
+/api/profile/ endpoint, one at a time.
+"""
+import itertools
+import os
+import sys
+import sysconfig
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    'MAX_DURATION': 60.0,  # Seconds, longer sessions are refused
+    'INTERVAL': 0.01,  # Seconds between stack samples, 100 Hz
+    'MIN_INTERVAL': 0.001,
+    'TRACEMALLOC_FRAMES': 10,  # Frames kept per traced allocation
+    'TOP_ALLOCATIONS': 50,  # Allocation sites reported per session
+}
+
+_ids = itertools.count(1)
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PROFILING', {}))
+    return config
+
+
+def short_path(filename):
+    """Path of a source file relative to the project, site-packages or the standard library"""
+    roots = (str(settings.BASE_DIR), *(path for path in sys.path if path.endswith('site-packages')), sysconfig.get_paths()['stdlib'])
+    for root in roots:
+        if filename.startswith(root + os.sep):
+            return filename[len(root) + 1:]
+    return filename
+
+
+class ProfileSession:
+    """
+    Samples every thread's stack until duration passes or stop() is called
+    """
+    def __init__(self, duration, interval, trace_memory=False, config=None):
+        self.config = config or get_config()
+        self.id = next(_ids)
+        self.duration = duration
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.started_at = None
+        self.finished_at = None
+        self.samples = 0
+        self.stacks = Counter()
+        self.allocations = None
+        self.error = None
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name=f"profile-{self.id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        started_tracing = False
+        baseline = None
+        try:
+            if self.trace_memory:
+                started_tracing = not tracemalloc.is_tracing()
+                if started_tracing:
+                    tracemalloc.start(self.config['TRACEMALLOC_FRAMES'])
+                baseline = tracemalloc.take_snapshot()
+
+            deadline = time.monotonic() + self.duration
+            while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+                self.sample()
+
+            if self.trace_memory:
+                self.allocations = self.top_allocations(tracemalloc.take_snapshot(), baseline)
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            self.finished_at = time.time()
+
+    def label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def sample(self):
+        """Count the current stack of every other thread once"""
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def top_allocations(self, snapshot, baseline):
+        """Allocation sites that grew the most during the session"""
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        allocations = []
+        for stat in snapshot.compare_to(baseline, 'lineno')[:self.config['TOP_ALLOCATIONS']]:
+            frame = stat.traceback[0]
+            allocations.append({
+                'file': short_path(frame.filename),
+                'line': frame.lineno,
+                'size': stat.size,
+                'size_diff': stat.size_diff,
+                'count': stat.count,
+                'count_diff': stat.count_diff,
+            })
+        return allocations
+
+    def folded(self):
+        """Folded stacks, one "frames count" line per distinct stack"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'running': self.running,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'duration': self.duration,
+            'interval': self.interval,
+            'trace_memory': self.trace_memory,
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            'error': self.error,
+        }
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def start_session(duration, interval=None, trace_memory=False):
+    """Start a session, raises ValueError for out of range options and RuntimeError while one runs"""
+    global _session
+    config = get_config()
+    interval = config['INTERVAL'] if interval is None else interval
+    if not 0 < duration <= config['MAX_DURATION']:
+        raise ValueError(f"duration must be within 0-{config['MAX_DURATION']} seconds")
+    if not config['MIN_INTERVAL'] <= interval <= duration:
+        raise ValueError(f"interval must be within {config['MIN_INTERVAL']} seconds and the duration")
+    with _session_lock:
+        if _session is not None and _session.running:
+            raise RuntimeError("A profiling session is already running")
+        _session = ProfileSession(duration, interval, trace_memory, config)
+        _session.start()
+        return _session
+
+
+def get_session():
+    """The running or the last finished session, None before the first one"""
+    return _session
@@ -0,0 +1,124 @@
+"""
+Response cache for the read-heavy endpoints that clients poll.
+
+The rendered JSON bytes of a GET are cached under a key that contains the current
+version of every model ("scope") the response depends on. Saving or deleting one of
+those models stores a new version, so stale entries are never read again and age out
+of the cache. Hits are served without running the view or DRF rendering, and requests
+whose If-None-Match matches the ETag get a 304.
+
+The 'responses' cache alias of settings.CACHES is used, a local memory cache with LRU
+eviction by default or Redis when RESPONSE_CACHE_REDIS_URL is set. The local memory
+cache is per process, so with several server processes use Redis to share invalidations.
+"""
+import hashlib
+import time
+from functools import partial, wraps
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseNotModified
+
+from rest_framework.renderers import JSONRenderer
+
+from stream_api import metrics
+from stream_api.models import Detection, Mission, PersonDetectionModel, Victim
+
+
+CACHE_ALIAS = 'responses'
+
+# Models and the scope their writes invalidate
+SCOPES = {
+    Mission: 'mission',
+    PersonDetectionModel: 'person_detection_model',
+    Detection: 'detection',
+    Victim: 'victim',
+}
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def new_version():
+    return str(time.time_ns())
+
+
+def get_versions(scopes):
+    cache = get_cache()
+    keys = [f'version:{scope}' for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Never reuse an old version after the key was evicted, stale entries would match again
+            cache.add(key, new_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_version(scope):
+    get_cache().set(f'version:{scope}', new_version(), timeout=None)
+
+
+def invalidate(*scopes):
+    """Store new versions of scopes once the current transaction commits"""
+    connection = transaction.get_connection()
+    for scope in scopes:
+        # A cascade delete sends a signal per row, bump each scope once per transaction
+        if connection.in_atomic_block and any(getattr(hook[1], 'scope', None) == scope for hook in connection.run_on_commit):
+            continue
+        bump = partial(bump_version, scope)
+        bump.scope = scope
+        transaction.on_commit(bump)
+
+
+def cached_response(*scopes):
+    """
+    Cache the JSON of a successful APIView.get under the versions of scopes.
+    Hits return the cached bytes directly, error responses are never cached.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            endpoint = type(view).__name__
+            versions = get_versions(scopes)
+            key = 'response:' + hashlib.sha1(
+                '|'.join([endpoint, request.get_full_path(), *versions]).encode()
+            ).hexdigest()
+
+            cache = get_cache()
+            entry = cache.get(key)
+            if entry is None:
+                response = method(view, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                body = JSONRenderer().render(response.data)
+                entry = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+                cache.set(key, entry)
+                result = 'miss'
+            else:
+                result = 'hit'
+
+            body, etag = entry
+            if etag in request.headers.get('If-None-Match', ''):
+                metrics.inc('response_cache_total', endpoint=endpoint, result='not_modified')
+                response = HttpResponseNotModified()
+            else:
+                metrics.inc('response_cache_total', endpoint=endpoint, result=result)
+                response = HttpResponse(body, content_type='application/json')
+            response['ETag'] = etag
+            # Clients may keep the response but have to revalidate it
+            response['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+@receiver(post_save, dispatch_uid='invalidate_cached_responses_on_save')
+@receiver(post_delete, dispatch_uid='invalidate_cached_responses_on_delete')
+def invalidate_on_write(sender, **kwargs):
+    scope = SCOPES.get(sender)
+    if scope is not None:
+        invalidate(scope)
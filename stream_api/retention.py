@@ -0,0 +1,234 @@
+"""
+Retention of mission snapshots, run with `python manage.py apply_retention`.
+
+For every mission, following its RetentionPolicy or settings.RETENTION:
+  - snapshots older than full_resolution_days are replaced by thumbnails
+  - detections older than delete_after_days are deleted, when it is set
+and finally files below the snapshot prefix that no row refers to are deleted.
+
+The storage is listed once at the start, the sizes after the run follow from the files the
+run writes and deletes, so a run costs one listing of the bucket on S3.
+
+Work is done in chunks of CHUNK_SIZE detections, each in its own short transaction,
+and the database is vacuumed/analyzed after large deletions.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from stream_api.jpeg import get_codec
+from stream_api.models import Detection, Mission, SnapshotBlob
+from stream_api.response_cache import invalidate
+from stream_api.snapshot_storage import get_snapshot_storage
+
+
+DEFAULTS = {
+    'FULL_RESOLUTION_DAYS': 30,
+    'THUMBNAIL_SIZE': 320,
+    'DELETE_AFTER_DAYS': None,
+    'CHUNK_SIZE': 200,
+    'ORPHAN_GRACE_SECONDS': 3600,  # Files younger than this are never treated as orphans
+    'VACUUM_THRESHOLD': 1000,  # Deleted rows after which the database is vacuumed
+}
+
+THUMBNAIL_EXTENSION = '.thumb.jpg'
+THUMBNAIL_QUALITY = 75
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'RETENTION', {}))
+    return config
+
+
+def make_thumbnail(jpeg, size):
+    # Decoded at the smallest DCT scale that is still at least size, a 1/8 decode for most snapshots
+    return get_codec().resize(jpeg, size, quality=THUMBNAIL_QUALITY)
+
+
+class RetentionJob:
+    """
+    One run of the retention policies, the counts end up in report
+    """
+    def __init__(self, config=None, dry_run=False, pause=0.0, stdout=None):
+        self.config = config or get_config()
+        self.dry_run = dry_run
+        self.pause = pause
+        self.stdout = stdout
+        self.storage = get_snapshot_storage()
+        self.files = {}  # {name: (size, modification time)} of the stored files
+        self.report = {
+            'missions': 0,
+            'thumbnails_created': 0,
+            'detections_deleted': 0,
+            'rows_deleted': 0,
+            'orphaned_files_deleted': 0,
+            'bytes_before': 0,
+            'bytes_after': 0,
+            'bytes_reclaimed': 0,
+            'vacuumed': False,
+            'seconds': 0.0,
+        }
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def run(self, mission_ids=None, orphans=True, vacuum=True):
+        started = time.perf_counter()
+        self.files = {name: (size, modified) for name, size, modified in self.storage.backend.list(self.storage.config['PREFIX'])}
+        self.report['bytes_before'] = self.storage_usage()
+
+        missions = Mission.objects.select_related('retention_policy').order_by('id')
+        if mission_ids:
+            missions = missions.filter(id__in=mission_ids)
+        now = timezone.now()
+        for mission in missions.iterator():
+            policy = self.get_policy(mission)
+            self.report['missions'] += 1
+            delete_cutoff = None
+            if policy['delete_after_days'] is not None:
+                delete_cutoff = now - datetime.timedelta(days=policy['delete_after_days'])
+                self.delete_detections(mission, delete_cutoff)
+            self.downsample(mission, now - datetime.timedelta(days=policy['full_resolution_days']), policy['thumbnail_size'],
+                            delete_cutoff)
+
+        if orphans:
+            self.delete_orphans()
+
+        if vacuum and not self.dry_run and self.report['rows_deleted'] >= self.config['VACUUM_THRESHOLD']:
+            self.vacuum()
+
+        self.storage.flush()
+        self.report['bytes_after'] = self.storage_usage()
+        self.report['bytes_reclaimed'] = self.report['bytes_before'] - self.report['bytes_after']
+        self.report['seconds'] = round(time.perf_counter() - started, 3)
+        return self.report
+
+    def get_policy(self, mission):
+        try:
+            policy = mission.retention_policy
+        except Mission.retention_policy.RelatedObjectDoesNotExist:
+            policy = None
+        if policy is None:
+            return {
+                'full_resolution_days': self.config['FULL_RESOLUTION_DAYS'],
+                'thumbnail_size': self.config['THUMBNAIL_SIZE'],
+                'delete_after_days': self.config['DELETE_AFTER_DAYS'],
+            }
+        return {
+            'full_resolution_days': policy.full_resolution_days,
+            'thumbnail_size': policy.thumbnail_size,
+            'delete_after_days': policy.delete_after_days,
+        }
+
+    def chunks(self, queryset):
+        """Yield lists of (id, snapshot) by ascending id, each list is queried separately"""
+        last_id = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'snapshot')[:self.config['CHUNK_SIZE']])
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+            if self.pause:
+                time.sleep(self.pause)
+
+    def downsample(self, mission, cutoff, size, delete_cutoff=None):
+        queryset = (Detection.objects
+                    .filter(mission=mission, timestamp__lt=cutoff)
+                    .exclude(snapshot__isnull=True).exclude(snapshot='')
+                    .exclude(snapshot__endswith=THUMBNAIL_EXTENSION)
+                    # Files the storage failed to write, there is nothing to downsample
+                    .exclude(snapshot__in=SnapshotBlob.objects.filter(missing=True).values('name')))
+        if delete_cutoff is not None:
+            # Only matters for dry runs, otherwise these were just deleted
+            queryset = queryset.filter(timestamp__gte=delete_cutoff)
+        if self.dry_run:
+            self.report['thumbnails_created'] += queryset.count()
+            return
+
+        for rows in self.chunks(queryset):
+            # The seeded and deduplicated detections share files, thumbnail each file once
+            thumbnails = {}
+            for name in {snapshot for _, snapshot in rows}:
+                try:
+                    thumbnails[name] = make_thumbnail(self.storage.read(name), size)
+                except (OSError, ValueError) as e:
+                    self.log(f"Skipping snapshot {name}: {e}")
+
+            released = set()
+            with transaction.atomic():
+                for pk, name in rows:
+                    if name not in thumbnails:
+                        continue
+                    thumbnail_name = self.storage.store(thumbnails[name], extension=THUMBNAIL_EXTENSION)
+                    Detection.objects.filter(pk=pk).update(snapshot=thumbnail_name)
+                    self.storage.release(name)
+                    self.files.setdefault(thumbnail_name, (len(thumbnails[name]), time.time()))
+                    released.add(name)
+                    self.report['thumbnails_created'] += 1
+                if released:
+                    # QuerySet.update() sends no signals
+                    invalidate('detection')
+            self.delete_unreferenced(released)
+
+    def delete_detections(self, mission, cutoff):
+        queryset = Detection.objects.filter(mission=mission, timestamp__lt=cutoff)
+        if self.dry_run:
+            self.report['detections_deleted'] += queryset.count()
+            return
+
+        for rows in self.chunks(queryset):
+            with transaction.atomic():
+                # Cascades to the victims and their postures, releasing the snapshots through post_delete
+                deleted, per_model = Detection.objects.filter(pk__in=[pk for pk, _ in rows]).delete()
+            self.report['detections_deleted'] += per_model.get(Detection._meta.label, 0)
+            self.report['rows_deleted'] += deleted
+            self.delete_unreferenced({snapshot for _, snapshot in rows if snapshot})
+
+    def delete_unreferenced(self, names):
+        """
+        Delete the files nothing refers to anymore: files that are not content addressed, and
+        content addressed ones whose last reference was released (the storage deletes those too)
+        """
+        for name in names:
+            if SnapshotBlob.objects.filter(name=name).exists() or Detection.objects.filter(snapshot=name).exists():
+                continue
+            self.storage.backend.delete(name)
+            self.files.pop(name, None)
+
+    def delete_orphans(self):
+        """Delete files below the snapshot prefix that no detection refers to"""
+        referenced = set(Detection.objects.exclude(snapshot__isnull=True).exclude(snapshot='')
+                         .values_list('snapshot', flat=True).distinct().iterator())
+        referenced.update(SnapshotBlob.objects.values_list('name', flat=True).iterator())
+        # Files younger than the grace period may belong to a capture that is still being written
+        grace_cutoff = time.time() - self.config['ORPHAN_GRACE_SECONDS']
+
+        for name, (size, modified) in list(self.files.items()):
+            if name in referenced or modified > grace_cutoff:
+                continue
+            self.report['orphaned_files_deleted'] += 1
+            if not self.dry_run:
+                self.storage.backend.delete(name)
+                del self.files[name]
+
+    def storage_usage(self):
+        """Bytes of the stored files, from the listing at the start and the changes of this run"""
+        return sum(size for size, _ in self.files.values())
+
+    def vacuum(self):
+        self.log(f"Vacuuming the database after deleting {self.report['rows_deleted']} rows")
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('VACUUM')
+                cursor.execute('ANALYZE')
+            elif connection.vendor == 'postgresql':
+                cursor.execute('VACUUM ANALYZE')
+            else:
+                return
+        self.report['vacuumed'] = True
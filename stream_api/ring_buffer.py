@@ -0,0 +1,83 @@
+"""
+Pre-trigger buffer of the detection results of each frame source.
+
+The detection pipeline appends every result it produces. The buffer keeps the results of
+the last SECONDS, and drops the oldest ones earlier when they take more than MAX_BYTES.
+Results are compacted before they are kept: only the JPEG frame and the box arrays stay,
+the annotated frame is drawn again when a capture saves one. Captures look up the frame an
+operator saw by its seq, or save the best results of the seconds before the tap.
+"""
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from stream_api import metrics
+
+
+DEFAULTS = {
+    'SECONDS': 10.0,
+    'MAX_BYTES': 32 * 1024 * 1024,  # Per source, 10 s of a 640x480 feed at 15 fps take about 6 MB
+    'MAX_BURST_FRAMES': 10,  # Frames a single capture may save from the buffer
+}
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'PRETRIGGER_BUFFER', {}))
+    return config
+
+
+class ResultRingBuffer:
+    """
+    Detection results of one source in seq order, bounded in time and memory
+    """
+    def __init__(self, name, seconds, max_bytes):
+        self.name = name
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self._entries = deque()  # (result, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        metrics.register_gauge('ring_buffer_bytes', lambda: self._bytes, source=name)
+        metrics.register_gauge('ring_buffer_frames', lambda: len(self._entries), source=name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, result):
+        size = result.nbytes()
+        with self._lock:
+            self._entries.append((result, size))
+            self._bytes += size
+            cutoff = result.timestamp - self.seconds
+            # The newest result is always kept
+            while len(self._entries) > 1 and (self._entries[0][0].timestamp < cutoff or self._bytes > self.max_bytes):
+                _, dropped = self._entries.popleft()
+                self._bytes -= dropped
+
+    def get(self, seq):
+        """The result of the frame with this seq, None when it was not detected or is too old"""
+        with self._lock:
+            for result, _ in reversed(self._entries):
+                if result.seq == seq:
+                    return result
+                if result.seq < seq:
+                    break
+        return None
+
+    def window(self, start, end):
+        """Results of the frames taken from start to end (time.time() timestamps), oldest first"""
+        with self._lock:
+            return [result for result, _ in self._entries if start <= result.timestamp <= end]
+
+    def best(self, start, end, count=1, include=None):
+        """
+        The count results of the window with the most confident boxes, oldest first.
+        include is ranked with them, for a result that was detected outside the pipeline thread.
+        """
+        results = {result.seq: result for result in self.window(start, end)}
+        if include is not None:
+            results.setdefault(include.seq, include)
+        ranked = sorted(results.values(), key=lambda result: result.best_confidence(), reverse=True)
+        return sorted(ranked[:count], key=lambda result: result.seq)
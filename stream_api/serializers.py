@@ -43,3 +43,28 @@ class PostureClassificationSerializer(serializers.ModelSerializer):
     class Meta:
         model = PostureClassification
         fields = '__all__'
+
+
+class VictimChangesSerializer(serializers.ModelSerializer):
+    """Fields of a victim the field teams update"""
+    class Meta:
+        model = Victim
+        fields = ['movement_category', 'condition', 'is_found', 'estimated_latitude', 'estimated_longitude']
+
+
+class VictimBulkUpdateSerializer(serializers.Serializer):
+    """{"ids": [...], "changes": {...}} applies the same changes to every listed victim"""
+    MAX_VICTIMS = 1000
+
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=MAX_VICTIMS)
+    changes = serializers.DictField()
+
+    def validate_changes(self, value):
+        unknown = set(value) - set(VictimChangesSerializer.Meta.fields)
+        if unknown:
+            raise serializers.ValidationError(f"Fields that cannot be changed: {', '.join(sorted(unknown))}")
+        if not value:
+            raise serializers.ValidationError("No changes given")
+        changes = VictimChangesSerializer(data=value, partial=True)
+        changes.is_valid(raise_exception=True)
+        return changes.validated_data
@@ -0,0 +1,8 @@
+"""
+Signals of stream_api that are not sent by Django itself
+"""
+from django.dispatch import Signal
+
+
+# Sent once after a bulk victim update is committed, with ids=[victim ids] and changes={field: value}
+victims_updated = Signal()
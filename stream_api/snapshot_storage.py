@@ -0,0 +1,337 @@
+"""
+Snapshot storage: detection snapshots are named after the SHA-256 of their content,
+stored once however many detections use them and written by a background thread.
+
+    snapshots/3f/a2/3fa2...e9.jpg
+
+store() only hashes the JPEG and counts the reference, so the Detection row can be
+inserted with its final snapshot path right away. Until the writer has flushed a file,
+read() serves it from memory. Deleting a Detection releases its reference and the file
+is removed once nothing uses it anymore. A failed write is tried again RETRY_DELAY later
+without holding up the other writes, one that still fails after WRITE_RETRIES marks the
+blob missing, and the next capture of the same content writes it again.
+
+Files go to MEDIA_ROOT, or to an S3 compatible object store (e.g. a local MinIO) with
+SNAPSHOT_STORAGE['BACKEND'] = 's3'.
+"""
+import hashlib
+import heapq
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from stream_api import metrics
+from stream_api.models import Detection, SnapshotBlob
+
+
+DEFAULTS = {
+    'BACKEND': 'local',  # 'local' or 's3'
+    'ROOT': None,  # Directory of the local backend, MEDIA_ROOT when None
+    'PREFIX': 'snapshots',
+    'SHARD_DEPTH': 2,  # Directory levels below PREFIX
+    'SHARD_WIDTH': 2,  # Hex characters of the hash per level, 2 gives 256 directories per level
+    'QUEUE_SIZE': 256,  # Pending writes, captures write inline when the writer falls this far behind
+    'WRITE_RETRIES': 3,  # Failed writes are tried again this often before the blob is marked missing
+    'RETRY_DELAY': 1.0,  # Seconds before a failed write is tried again
+    'BUCKET': None,
+    'ENDPOINT_URL': None,  # e.g. http://127.0.0.1:9000 for a local MinIO
+    'ACCESS_KEY': None,
+    'SECRET_KEY': None,
+    'REGION': None,
+}
+
+# Seconds the writer waits for new work before it checks the retries again
+RETRY_POLL_INTERVAL = 0.5
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'SNAPSHOT_STORAGE', {}))
+    return config
+
+
+def content_name(data, prefix='snapshots', depth=2, width=2, extension='.jpg'):
+    """Storage path of some content, sharded on the leading characters of its hash"""
+    digest = hashlib.sha256(data).hexdigest()
+    shards = [digest[level * width:(level + 1) * width] for level in range(depth)]
+    return '/'.join([prefix, *shards, digest + extension])
+
+
+#========== BACKENDS ===========================================================================================================
+class LocalBackend:
+    """
+    Files below a directory, MEDIA_ROOT by default so the media URLs keep working
+    """
+    def __init__(self, root):
+        self.root = str(root)
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def write(self, name, data):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial JPEG
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def list(self, prefix):
+        """Yield (name, size, modification time) of every file below prefix"""
+        for directory, _, files in os.walk(self.path(prefix)):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield os.path.relpath(path, self.root).replace(os.sep, '/'), stat.st_size, stat.st_mtime
+
+
+class S3Backend:
+    """
+    Objects in an S3 compatible bucket, needs boto3
+    """
+    def __init__(self, config):
+        import boto3
+
+        self.bucket = config['BUCKET']
+        self.client = boto3.client(
+            's3',
+            endpoint_url=config['ENDPOINT_URL'],
+            aws_access_key_id=config['ACCESS_KEY'],
+            aws_secret_access_key=config['SECRET_KEY'],
+            region_name=config['REGION'],
+        )
+
+    def path(self, name):
+        return None
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=name)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def write(self, name, data):
+        self.client.put_object(Bucket=self.bucket, Key=name, Body=data, ContentType='image/jpeg')
+
+    def read(self, name):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=name)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(name)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def size(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=name)['ContentLength']
+
+    def list(self, prefix):
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix + '/'):
+            for item in page.get('Contents', []):
+                yield item['Key'], item['Size'], item['LastModified'].timestamp()
+
+
+#========== STORAGE ============================================================================================================
+class SnapshotStorage:
+    """
+    Reference counted, content addressed snapshots with a background writer
+    """
+    def __init__(self, backend, config):
+        self.backend = backend
+        self.config = config
+        self._queue = queue.Queue(maxsize=config['QUEUE_SIZE'])
+        self._pending = {}
+        self._rewrites = set()  # Names of missing blobs that are written again
+        self._retries = []  # Heap of (due time, name, attempt) of the failed writes
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        metrics.register_gauge('queue_depth', self._queue.qsize, path='snapshot', source=config['BACKEND'])
+
+    def store(self, data, extension='.jpg'):
+        """Count a reference to the content and return its storage path, the file is written later"""
+        name = content_name(data, self.config['PREFIX'], self.config['SHARD_DEPTH'], self.config['SHARD_WIDTH'], extension)
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    blob, created = SnapshotBlob.objects.get_or_create(name=name, defaults={'size': len(data)})
+            except IntegrityError:
+                # Another capture stored the same content at the same time
+                blob, created = SnapshotBlob.objects.get(name=name), False
+            SnapshotBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+
+            if created or blob.missing:
+                if blob.missing:
+                    with self._pending_lock:
+                        self._rewrites.add(name)
+                transaction.on_commit(lambda: self._enqueue('write', name, data))
+            else:
+                metrics.inc('snapshots_deduplicated_total')
+        return name
+
+    def release(self, name):
+        """Drop a reference, the file is deleted with the last one. Returns True when it was the last one"""
+        with transaction.atomic():
+            updated = SnapshotBlob.objects.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+            if not updated:
+                # Not a content addressed snapshot
+                return False
+            deleted, _ = SnapshotBlob.objects.filter(name=name, ref_count=0).delete()
+            if deleted:
+                transaction.on_commit(lambda: self._enqueue('delete', name))
+        return bool(deleted)
+
+    def read(self, name):
+        """Snapshot bytes, raises FileNotFoundError when the file is missing"""
+        with self._pending_lock:
+            data = self._pending.get(name)
+        if data is not None:
+            return data
+        with metrics.span('snapshot', 'read'):
+            return self.backend.read(name)
+
+    def flush(self):
+        """Wait for every queued write and delete, including the retries of failed writes"""
+        while True:
+            self._queue.join()
+            with self._pending_lock:
+                if not self._retries:
+                    return
+            time.sleep(0.01)
+
+    def _enqueue(self, action, name, data=None):
+        if action == 'write':
+            with self._pending_lock:
+                self._pending[name] = data
+        try:
+            self._queue.put_nowait((action, name, 0))
+        except queue.Full:
+            metrics.inc('snapshot_writes_inline_total')
+            self._process(action, name, 0)
+
+    def _run(self):
+        while True:
+            self._queue_due_retries()
+            try:
+                action, name, attempt = self._queue.get(timeout=self._retry_wait())
+            except queue.Empty:
+                continue
+            try:
+                self._process(action, name, attempt)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def _process(self, action, name, attempt):
+        try:
+            self._handle(action, name)
+        except Exception as e:
+            print(f"Snapshot storage error ({action} {name}, attempt {attempt + 1}): {e}")
+            if action == 'write':
+                self._write_failed(name, attempt)
+
+    def _retry_wait(self):
+        """Seconds until the next retry is due"""
+        with self._pending_lock:
+            if not self._retries:
+                return RETRY_POLL_INTERVAL
+            return max(self._retries[0][0] - time.monotonic(), 0)
+
+    def _queue_due_retries(self):
+        """Move the retries that are due to the queue, called by the writer thread"""
+        now = time.monotonic()
+        with self._pending_lock:
+            while self._retries and self._retries[0][0] <= now:
+                _, name, attempt = self._retries[0]
+                try:
+                    self._queue.put_nowait(('write', name, attempt))
+                except queue.Full:
+                    # Queued once the writer caught up
+                    return
+                heapq.heappop(self._retries)
+
+    def _write_failed(self, name, attempt):
+        """Schedule the write again, or give up on it and mark the blob missing"""
+        if attempt < self.config['WRITE_RETRIES']:
+            # Neither the writer nor a capture writing inline waits for the retry
+            with self._pending_lock:
+                heapq.heappush(self._retries, (time.monotonic() + self.config['RETRY_DELAY'], name, attempt + 1))
+            metrics.inc('snapshot_write_errors_total', outcome='retried')
+            return
+        metrics.inc('snapshot_write_errors_total', outcome='missing')
+        with self._pending_lock:
+            self._pending.pop(name, None)
+            self._rewrites.discard(name)
+        SnapshotBlob.objects.filter(name=name).update(missing=True)
+
+    def _handle(self, action, name):
+        if action == 'write':
+            with self._pending_lock:
+                data = self._pending.get(name)
+            if data is None:
+                return
+            with metrics.span('snapshot', 'write'):
+                self.backend.write(name, data)
+            with self._pending_lock:
+                self._pending.pop(name, None)
+                rewritten = name in self._rewrites
+                self._rewrites.discard(name)
+            if rewritten:
+                SnapshotBlob.objects.filter(name=name).update(missing=False)
+        elif action == 'delete':
+            # The same content may have been captured again since it was released
+            if SnapshotBlob.objects.filter(name=name).exists():
+                return
+            with metrics.span('snapshot', 'delete'):
+                self.backend.delete(name)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_snapshot_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            config = get_config()
+            if config['BACKEND'] == 's3':
+                backend = S3Backend(config)
+            else:
+                backend = LocalBackend(config['ROOT'] or settings.MEDIA_ROOT)
+            _storage = SnapshotStorage(backend, config)
+        return _storage
+
+
+@receiver(post_delete, sender=Detection, dispatch_uid='release_detection_snapshot')
+def release_detection_snapshot(sender, instance, **kwargs):
+    if instance.snapshot:
+        get_snapshot_storage().release(instance.snapshot.name)
@@ -1,3 +1,1390 @@
-from django.test import TestCase
+import importlib.util
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+
+PARITY_MODEL_PATH = os.environ.get('PARITY_MODEL_PATH', 'ai_models/front_side_view/best.pt')
+HAS_BACKENDS = all(importlib.util.find_spec(name) for name in ('ultralytics', 'onnxruntime'))
+HAS_PYAV = importlib.util.find_spec('av') is not None
+
+# Modules only the vision endpoints may load
+VISION_MODULES = ('torch', 'ultralytics', 'onnxruntime', 'cv2')
+# Seconds the CRUD-only startup may take, generous so it only catches the vision stack
+IMPORT_TIME_BUDGET = 3.0
+
+CRUD_IMPORT_SCRIPT = """
+import json, os, sys, time
+started = time.perf_counter()
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'camera_stream_project.settings')
+django.setup()
+from django.test import Client
+from django.test.utils import setup_test_environment
+from django.urls import resolve
+setup_test_environment()
+import camera_stream_project.urls
+for path in ('/api/missions/', '/api/mission/1/', '/api/victims/', '/api/person-detection-models/'):
+    resolve(path)
+client = Client()
+client.get('/api/person-detection-models/')
+client.get('/api/missions/')
+elapsed = time.perf_counter() - started
+loaded = sorted({name.split('.')[0] for name in sys.modules} & set(json.loads(sys.argv[1])))
+print(json.dumps({'elapsed': elapsed, 'loaded': loaded}))
+"""
+
+
+def box_iou(box, boxes):
+    import numpy as np
+
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    intersection = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / ((box[2] - box[0]) * (box[3] - box[1]) + areas - intersection)
+
+
+class ImportBudgetTest(SimpleTestCase):
+    """
+    Starting Django and serving the CRUD endpoints must not load the vision stack
+    """
+    def setUp(self):
+        # Serve from a migrated copy of the database so unapplied migrations don't break the requests
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.env = dict(os.environ, DATABASE_PATH=os.path.join(directory, 'db.sqlite3'))
+        shutil.copy(settings.BASE_DIR / 'db.sqlite3', self.env['DATABASE_PATH'])
+        subprocess.check_call([sys.executable, 'manage.py', 'migrate', '--verbosity', '0'], cwd=settings.BASE_DIR, env=self.env)
+
+    def test_crud_paths_do_not_import_vision_stack(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c', CRUD_IMPORT_SCRIPT, json.dumps(VISION_MODULES)],
+            cwd=settings.BASE_DIR,
+            env=self.env,
+            text=True,
+        )
+        report = json.loads(output.strip().splitlines()[-1])
+        self.assertEqual(report['loaded'], [])
+        self.assertLess(report['elapsed'], IMPORT_TIME_BUDGET)
+
+
+@skipUnless(HAS_BACKENDS and os.path.exists(PARITY_MODEL_PATH), "needs ultralytics, onnxruntime and the model weights")
+@override_settings(INFERENCE_BACKEND={'BACKEND': 'onnx', 'INT8': False})
+class InferenceBackendParityTest(SimpleTestCase):
+    """
+    The ONNX Runtime backend has to find the same boxes as the PyTorch model it was exported from
+    """
+    def test_onnx_boxes_match_pytorch(self):
+        import cv2
+        from stream_api.inference_backends import OnnxBackend, PyTorchBackend, export_onnx, get_config
+
+        config = get_config()
+        pytorch_backend = PyTorchBackend(PARITY_MODEL_PATH)
+        onnx_backend = OnnxBackend(export_onnx(PARITY_MODEL_PATH, config), config)
+
+        image_paths = ['image.jpg'] + sorted(glob.glob('media/snapshots/*.jpg'))[:5]
+        for image_path in image_paths:
+            image = cv2.imread(image_path)
+            expected = pytorch_backend.predict(image, conf=0.25)
+            actual = onnx_backend.predict(image, conf=0.25)
+
+            with self.subTest(image=image_path):
+                self.assertEqual(len(actual), len(expected))
+                for box, confidence in zip(expected.boxes, expected.confidences):
+                    ious = box_iou(box, actual.boxes)
+                    best = int(ious.argmax())
+                    self.assertGreater(ious[best], 0.9)
+                    self.assertAlmostEqual(float(actual.confidences[best]), float(confidence), delta=0.02)
+
+
+class StubBackend:
+    """Backend that finds one person in every frame, without loading a model"""
+    name = 'stub'
+
+    def decode_for_inference(self, jpeg, tiling=None):
+        from stream_api.jpeg import decode
+        return decode(jpeg), 1
+
+    def predict(self, image, conf):
+        from stream_api.inference_backends import Detections
+        return Detections(image, [[10, 20, 110, 220]], [0.9], [0], {0: 'person'})
+
+    def predict_jpeg(self, jpeg, conf, annotate=False, tiling=None):
+        return self.predict(self.decode_for_inference(jpeg)[0], conf)
+
+
+class InferenceServiceTest(SimpleTestCase):
+    """
+    Frames round trip through a forked worker, which only accepts models and frames from its
+    directories, and the client runs the model in-process while the service is missing
+    """
+    def setUp(self):
+        from unittest import mock
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.model_dir = os.path.join(self.root, 'models')
+        self.frame_dir = os.path.join(self.root, 'frames')
+        os.makedirs(self.model_dir)
+        os.makedirs(self.frame_dir)
+        self.model_path = os.path.join(self.model_dir, 'best.pt')
+        open(self.model_path, 'wb').close()
+        with open('image.jpg', 'rb') as f:
+            self.jpeg = f.read()
+
+        # Patched before forking, so the worker gets the stub as well
+        patcher = mock.patch('stream_api.inference_backends.load_backend', return_value=StubBackend())
+        self.load_backend = patcher.start()
+        self.addCleanup(patcher.stop)
+        overrides = override_settings(INFERENCE_BACKEND={'MODEL_DIR': self.model_dir, 'FRAME_DIR': self.frame_dir})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def fork_worker(self, socket_path):
+        import signal
+        from stream_api.inference_service import InferenceWorker, bind_socket
+
+        listener = bind_socket(socket_path)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                InferenceWorker(0, listener).run()
+            finally:
+                os._exit(1)
+        listener.close()
+        self.addCleanup(os.waitpid, pid, 0)
+        self.addCleanup(os.kill, pid, signal.SIGKILL)
+
+    def test_round_trip(self):
+        import stat
+        from stream_api.inference_service import RemoteBackend
+
+        socket_path = os.path.join(self.root, 'service', 'inference.sock')
+        self.fork_worker(socket_path)
+        self.assertEqual(stat.S_IMODE(os.stat(socket_path).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(socket_path)).st_mode), 0o700)
+
+        backend = RemoteBackend(self.model_path, socket_path)
+        detections = backend.predict_jpeg(self.jpeg, 0.5, annotate=True)
+        self.assertEqual(detections.boxes.tolist(), [[10, 20, 110, 220]])
+        self.assertAlmostEqual(float(detections.confidences[0]), 0.9, places=5)
+        self.assertEqual(detections.orig_shape, (480, 640))
+        self.assertEqual(detections.annotated_jpeg[:2], b'\xff\xd8')
+
+        frame_path = os.path.join(self.frame_dir, 'frame.jpg')
+        with open(frame_path, 'wb') as f:
+            f.write(self.jpeg)
+        self.assertEqual(len(backend.predict_file(frame_path, 0.5)), 1)
+        self.assertIsNone(backend._fallback)
+
+        # Files outside the directories are refused, even through a symlink
+        os.symlink(os.path.abspath('image.jpg'), os.path.join(self.frame_dir, 'link.jpg'))
+        for path in (os.path.abspath('image.jpg'), os.path.join(self.frame_dir, 'link.jpg'), os.path.join(self.frame_dir, '..', 'x.jpg')):
+            with self.assertRaisesRegex(Exception, 'is outside'):
+                backend.predict_file(path, 0.5)
+        with self.assertRaisesRegex(Exception, 'is outside'):
+            RemoteBackend(os.path.join(self.root, 'best.pt'), socket_path).predict_jpeg(self.jpeg, 0.5)
+
+    def test_more_clients_than_workers(self):
+        import threading
+        from stream_api.inference_service import RemoteBackend
+
+        socket_path = os.path.join(self.root, 'service', 'inference.sock')
+        self.fork_worker(socket_path)
+        backend = RemoteBackend(self.model_path, socket_path, timeout=2.0)
+        results = []
+        # The threads live on after their requests, like the pipeline thread and request threads
+        done = threading.Barrier(4)
+
+        def client():
+            for _ in range(3):
+                results.append(len(backend.predict_jpeg(self.jpeg, 0.5)))
+            done.wait(15)
+        threads = [threading.Thread(target=client) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(results, [1] * 12)
+        self.assertIsNone(backend._fallback)
+
+    def test_slow_service_does_not_fall_back(self):
+        from stream_api.inference_service import RemoteBackend, bind_socket
+
+        # Nobody accepts, so the request waits in the backlog like behind busy workers
+        listener = bind_socket(os.path.join(self.root, 'service', 'inference.sock'))
+        self.addCleanup(listener.close)
+        backend = RemoteBackend(self.model_path, listener.getsockname(), timeout=0.2)
+        with self.assertRaisesRegex(RuntimeError, 'did not answer'):
+            backend.predict_jpeg(self.jpeg, 0.5)
+        self.assertIsNone(backend._fallback)
+        self.load_backend.assert_not_called()
+
+    def test_fallback_without_service(self):
+        from stream_api.inference_service import RemoteBackend
+
+        backend = RemoteBackend(self.model_path, os.path.join(self.root, 'missing.sock'))
+        detections = backend.predict_jpeg(self.jpeg, 0.5)
+        self.assertEqual(detections.boxes.tolist(), [[10, 20, 110, 220]])
+        self.assertIsInstance(backend._fallback, StubBackend)
+        self.load_backend.assert_called_once_with(self.model_path, allow_remote=False)
+
+
+class TilingTest(SimpleTestCase):
+    """
+    Tiles cover every pixel of the frame, NMS merges within a class only, and tiling settings are validated
+    """
+    def test_tiles_cover_frame(self):
+        import numpy as np
+        from stream_api.tiling import make_tiles
+
+        for height, width, tile_size, overlap in [(1080, 1920, 640, 0.2), (700, 641, 640, 0.0), (2000, 3000, 160, 0.75)]:
+            tiles = make_tiles(height, width, tile_size, overlap)
+            covered = np.zeros((height, width), dtype=bool)
+            for x1, y1, x2, y2 in tiles:
+                self.assertTrue(0 <= x1 < x2 <= width and 0 <= y1 < y2 <= height)
+                self.assertEqual((x2 - x1, y2 - y1), (min(tile_size, width), min(tile_size, height)))
+                covered[y1:y2, x1:x2] = True
+            self.assertTrue(covered.all())
+        # Frames no larger than a tile are one tile, at their own size
+        self.assertEqual(make_tiles(480, 640, 640, 0.2), [(0, 0, 640, 480)])
+        for overlap in (1.0, -0.1):
+            with self.assertRaises(ValueError):
+                make_tiles(1080, 1920, 640, overlap)
+
+    def test_nms(self):
+        import numpy as np
+        from stream_api.tiling import nms
+
+        empty = nms(np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32), 0.5)
+        self.assertEqual((empty.shape, empty.dtype), ((0,), np.int64))
+
+        boxes = np.array([[0, 0, 100, 100], [5, 5, 105, 105], [0, 0, 100, 100], [300, 300, 400, 400]], dtype=np.float32)
+        scores = np.array([0.6, 0.9, 0.7, 0.5], dtype=np.float32)
+        # One class: the overlapping boxes collapse into the most confident one
+        self.assertEqual(nms(boxes, scores, 0.5).tolist(), [1, 3])
+        # A box of another class at the same place is kept
+        self.assertEqual(nms(boxes, scores, 0.5, np.array([0, 0, 1, 0])).tolist(), [1, 2, 3])
+
+    def test_settings_validated(self):
+        from rest_framework.exceptions import ValidationError
+        from stream_api.models import PersonDetectionModel
+        from stream_api.serializers import PersonDetectionModelSerializer
+
+        fields = PersonDetectionModelSerializer().fields
+        for name, value in [('tile_overlap', 1.0), ('tile_overlap', -0.1), ('tile_size', 16), ('tile_parallelism', 0)]:
+            with self.assertRaises(ValidationError):
+                fields[name].run_validation(value)
+        self.assertEqual(fields['tile_overlap'].run_validation(0.5), 0.5)
+
+        # Rows saved before the validation are clamped
+        model = PersonDetectionModel(tiled_inference=True, tile_size=16, tile_overlap=1.0, tile_parallelism=0)
+        self.assertEqual(model.get_tiling(), {'tile_size': 160, 'overlap': 0.75, 'parallelism': 1})
+
+
+class PostureClassificationTest(SimpleTestCase):
+    """
+    Postures follow the torso and thigh angles of the keypoints
+    """
+    def keypoints(self, shoulders, hips, knees=None):
+        import numpy as np
+
+        keypoints = np.zeros((17, 3), dtype=np.float32)
+        keypoints[[5, 6], :2] = shoulders
+        keypoints[[11, 12], :2] = hips
+        keypoints[[5, 6, 11, 12], 2] = 0.9
+        if knees is not None:
+            keypoints[[13, 14], :2] = knees
+            keypoints[[13, 14], 2] = 0.9
+        return keypoints
+
+    def test_postures(self):
+        from stream_api.pose import classify_posture
+
+        self.assertEqual(classify_posture(self.keypoints((50, 0), (50, 60), (50, 120)))[0], 'standing')
+        self.assertEqual(classify_posture(self.keypoints((50, 0), (50, 60), (100, 65)))[0], 'sitting')
+        self.assertEqual(classify_posture(self.keypoints((0, 50), (60, 55)))[0], 'lying')
+        self.assertEqual(classify_posture(self.keypoints((50, 0), (50, 60)) * [1, 1, 0])[0], 'unknown')
+
+
+class StubPoseModel:
+    """Pose model that finds a standing person in every crop and records the crops it got, like the real one it fails on empty crops"""
+    def __init__(self):
+        self.crops = []
+
+    def predict_batch(self, crops):
+        import numpy as np
+
+        if any(crop.size == 0 for crop in crops):
+            raise ValueError("empty crop")
+        self.crops.extend(crops)
+        keypoints = np.zeros((17, 3), dtype=np.float32)
+        keypoints[[5, 6, 11, 12, 13, 14]] = [[40, 10, 0.9], [60, 10, 0.9], [40, 50, 0.8], [60, 50, 0.8],
+                                              [40, 90, 0.7], [60, 90, 0.7]]
+        return [keypoints.copy() for _ in crops]
+
+
+class PoseStageTest(TransactionTestCase):
+    """
+    A batch writes the keypoints and postures of every victim with a usable box, and skips the others
+    """
+    def test_batch_skips_empty_crops(self):
+        from stream_api.models import Detection, Mission, PersonDetectionModel, PostureClassification, Victim
+        from stream_api.pose import DEFAULTS, PoseStage
+        from django.utils import timezone
+
+        with open('image.jpg', 'rb') as f:
+            jpeg = f.read()
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        detection = Detection.objects.create(mission=Mission.objects.create(date_time_started=timezone.now()),
+                                             person_detection_model=model)
+        victims = [Victim.objects.create(detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.9,
+                                         bounding_box={}, coco_keypoints={}) for i in range(4)]
+        boxes = [(100, 100, 200, 300), (50, 50, 50, 120), (900, 700, 1000, 800), (600, 400, 700, 600)]
+
+        stage = PoseStage(dict(DEFAULTS, CROP_PADDING=0.0))
+        stage._model = StubPoseModel()
+        stage.process(jpeg, [(victim.id, box) for victim, box in zip(victims, boxes)])
+
+        # Zero-area and out of frame boxes never reach the model, the last box is clamped to the 640x480 frame
+        self.assertEqual([crop.shape[:2] for crop in stage._model.crops], [(200, 100), (80, 40)])
+        keypoints = {victim.person_id: victim.coco_keypoints for victim in Victim.objects.order_by('id')}
+        self.assertEqual(keypoints['person_1'], {})
+        self.assertEqual(keypoints['person_2'], {})
+        self.assertEqual(keypoints['person_0']['num_keypoints'], 6)
+        self.assertEqual(keypoints['person_0']['keypoints'][5 * 3:5 * 3 + 3], [140.0, 110.0, 0.9])
+        self.assertEqual(keypoints['person_3']['keypoints'][5 * 3:5 * 3 + 3], [640.0, 410.0, 0.9])
+        self.assertEqual(list(PostureClassification.objects.order_by('victim_id').values_list('victim__person_id', 'posture_class')),
+                         [('person_0', 'standing'), ('person_3', 'standing')])
+
+    def test_deleted_victim_is_skipped(self):
+        from stream_api.models import Detection, Mission, PersonDetectionModel, PostureClassification, Victim
+        from stream_api.pose import DEFAULTS, PoseStage
+        from django.utils import timezone
+
+        with open('image.jpg', 'rb') as f:
+            jpeg = f.read()
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        detection = Detection.objects.create(mission=Mission.objects.create(date_time_started=timezone.now()),
+                                             person_detection_model=model)
+        victims = [Victim.objects.create(detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.9,
+                                         bounding_box={}, coco_keypoints={}) for i in range(2)]
+        queued = [(victim.id, (100, 100, 200, 300)) for victim in victims]
+        # Deleted between the capture and the pose stage
+        victims[0].delete()
+
+        stage = PoseStage(DEFAULTS)
+        stage._model = StubPoseModel()
+        stage.process(jpeg, queued)
+
+        self.assertEqual(Victim.objects.get().coco_keypoints['num_keypoints'], 6)
+        self.assertEqual(list(PostureClassification.objects.values_list('victim_id', 'posture_class')),
+                         [(victims[1].id, 'standing')])
+
+
+class SnapshotStorageTest(TransactionTestCase):
+    """
+    Identical snapshots are stored once and deleted with their last reference, failed writes are not kept forever
+    """
+    def setUp(self):
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = SnapshotStorage(LocalBackend(self.root), get_config())
+
+    def test_deduplicates_and_releases(self):
+        from stream_api.models import SnapshotBlob
+
+        first = self.storage.store(b'snapshot')
+        second = self.storage.store(b'snapshot')
+        self.storage.flush()
+
+        self.assertEqual(first, second)
+        self.assertRegex(first, r'^snapshots/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(SnapshotBlob.objects.get(name=first).ref_count, 2)
+        self.assertEqual(self.storage.read(first), b'snapshot')
+
+        self.storage.release(first)
+        self.storage.flush()
+        self.assertTrue(self.storage.backend.exists(first))
+
+        self.storage.release(first)
+        self.storage.flush()
+        self.assertFalse(self.storage.backend.exists(first))
+        self.assertFalse(SnapshotBlob.objects.filter(name=first).exists())
+
+    def test_failed_write_marks_blob_missing(self):
+        from unittest import mock
+        from stream_api.models import SnapshotBlob
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config
+
+        storage = SnapshotStorage(LocalBackend(self.root), dict(get_config(), WRITE_RETRIES=1, RETRY_DELAY=0))
+        with mock.patch.object(storage.backend, 'write', side_effect=OSError("disk full")) as write:
+            name = storage.store(b'snapshot')
+            storage.flush()
+        # Tried again once, then given up: nothing left in memory and the blob says so
+        self.assertEqual(write.call_count, 2)
+        self.assertEqual(storage._pending, {})
+        self.assertTrue(SnapshotBlob.objects.get(name=name).missing)
+        with self.assertRaises(FileNotFoundError):
+            storage.read(name)
+
+        # The next capture of the same content writes the file
+        self.assertEqual(storage.store(b'snapshot'), name)
+        storage.flush()
+        self.assertEqual(storage.read(name), b'snapshot')
+        blob = SnapshotBlob.objects.get(name=name)
+        self.assertEqual((blob.missing, blob.ref_count), (False, 2))
+
+    def test_retry_does_not_hold_up_other_writes(self):
+        import time
+        from stream_api.models import SnapshotBlob
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config
+
+        class FlakyBackend(LocalBackend):
+            """Fails the first write of the bad snapshot"""
+            failures = 0
+
+            def write(self, name, data):
+                if data == b'bad' and not self.failures:
+                    self.failures += 1
+                    raise OSError("disk full")
+                super().write(name, data)
+
+        storage = SnapshotStorage(FlakyBackend(self.root), dict(get_config(), WRITE_RETRIES=1, RETRY_DELAY=2.0))
+        started = time.monotonic()
+        bad = storage.store(b'bad')
+        good = [storage.store(f"good {i}".encode()) for i in range(3)]
+        while not all(storage.backend.exists(name) for name in good):
+            self.assertLess(time.monotonic() - started, 1.0, "the retry held up the queued writes")
+            time.sleep(0.01)
+        self.assertFalse(storage.backend.exists(bad))
+        self.assertEqual(storage.read(bad), b'bad')  # Still served from memory while the retry waits
+
+        storage.flush()
+        self.assertGreaterEqual(time.monotonic() - started, 2.0)
+        self.assertEqual(storage.backend.read(bad), b'bad')
+        self.assertEqual(storage._pending, {})
+        self.assertFalse(SnapshotBlob.objects.get(name=bad).missing)
+
+        # A capture writing inline because the queue is full makes one attempt and does not wait
+        storage.backend.failures = 0
+        storage._pending[bad] = b'bad'
+        started = time.monotonic()
+        storage._process('write', bad, 0)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(storage.backend.failures, 1)
+        self.assertEqual(len(storage._retries), 1)
+        storage.flush()
+
+
+class RetentionJobTest(TransactionTestCase):
+    """
+    Old snapshots become thumbnails, orphans go after the grace period and shared files stay while referenced
+    """
+    def test_thumbnails_and_orphans(self):
+        import datetime
+        import time
+        from unittest import mock
+        from django.utils import timezone
+        from stream_api.jpeg import get_codec
+        from stream_api.models import Detection, Mission, PersonDetectionModel, RetentionPolicy
+        from stream_api.retention import THUMBNAIL_EXTENSION, RetentionJob, get_config
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config as get_storage_config
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = SnapshotStorage(LocalBackend(root), get_storage_config())
+        with open('image.jpg', 'rb') as f:
+            shared_jpeg = f.read()
+        own_jpeg = get_codec().resize(shared_jpeg, 400)
+
+        now = timezone.now()
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        mission = Mission.objects.create(date_time_started=now)
+        RetentionPolicy.objects.create(mission=mission, full_resolution_days=30, thumbnail_size=64)
+
+        def detection(days_ago, jpeg):
+            return Detection.objects.create(mission=mission, person_detection_model=model, snapshot=storage.store(jpeg),
+                                            timestamp=now - datetime.timedelta(days=days_ago))
+
+        old_shared, recent_shared, old_own = detection(40, shared_jpeg), detection(1, shared_jpeg), detection(40, own_jpeg)
+        shared_name, own_name = old_shared.snapshot.name, old_own.snapshot.name
+        storage.backend.write('snapshots/orphan-old.jpg', b'x' * 1000)
+        storage.backend.write('snapshots/orphan-new.jpg', b'x' * 1000)
+        two_hours_ago = time.time() - 7200
+        os.utime(storage.backend.path('snapshots/orphan-old.jpg'), (two_hours_ago, two_hours_ago))
+        storage.flush()
+
+        def disk_usage():
+            return sum(size for _, size, _ in storage.backend.list('snapshots'))
+
+        bytes_before = disk_usage()
+        with mock.patch('stream_api.retention.get_snapshot_storage', return_value=storage), \
+                mock.patch('stream_api.snapshot_storage.get_snapshot_storage', return_value=storage):
+            report = RetentionJob(dict(get_config(), ORPHAN_GRACE_SECONDS=3600)).run(vacuum=False)
+
+        old_shared.refresh_from_db()
+        old_own.refresh_from_db()
+        recent_shared.refresh_from_db()
+        self.assertTrue(old_shared.snapshot.name.endswith(THUMBNAIL_EXTENSION))
+        self.assertTrue(old_own.snapshot.name.endswith(THUMBNAIL_EXTENSION))
+        self.assertLessEqual(max(get_codec().decode(storage.read(old_own.snapshot.name)).shape[:2]), 64)
+        # The recent detection still refers to the shared file, the other full resolution file is gone
+        self.assertEqual(recent_shared.snapshot.name, shared_name)
+        self.assertTrue(storage.backend.exists(shared_name))
+        self.assertFalse(storage.backend.exists(own_name))
+        self.assertFalse(storage.backend.exists('snapshots/orphan-old.jpg'))
+        self.assertTrue(storage.backend.exists('snapshots/orphan-new.jpg'))
+
+        self.assertEqual(report['thumbnails_created'], 2)
+        self.assertEqual(report['orphaned_files_deleted'], 1)
+        self.assertEqual(report['bytes_before'], bytes_before)
+        self.assertEqual(report['bytes_after'], disk_usage())
+        self.assertEqual(report['bytes_reclaimed'], bytes_before - disk_usage())
+
+
+class MissionArchiveTest(TransactionTestCase):
+    """
+    An exported mission imports as a new mission with the same rows
+    """
+    def test_export_import_round_trip(self):
+        import io
+        from django.utils import timezone
+        from stream_api.mission_archive import export_mission, import_mission
+        from stream_api.models import Detection, Mission, PersonDetectionModel, PostureClassification, Victim
+
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        for i in range(3):
+            detection = Detection.objects.create(mission=mission, person_detection_model=model, latitude=10.5 + i)
+            victim = Victim.objects.create(
+                detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.9,
+                bounding_box={'x1': 1.5, 'y1': 2.0, 'x2': 30.25, 'y2': 40.0}, coco_keypoints={}, condition=None,
+            )
+            PostureClassification.objects.create(victim=victim, posture_class='lying', confidence=0.8)
+
+        archive = b''.join(export_mission(mission, chunk_size=2))
+        imported, counts = import_mission(io.BytesIO(archive), batch_size=2)
+
+        self.assertEqual(counts, {'detections': 3, 'victims': 3, 'postures': 3, 'snapshots': 0})
+        self.assertEqual(
+            list(Detection.objects.filter(mission=imported).order_by('id').values_list('latitude', 'timestamp', 'person_detection_model')),
+            list(Detection.objects.filter(mission=mission).order_by('id').values_list('latitude', 'timestamp', 'person_detection_model')),
+        )
+        victim = Victim.objects.filter(detection__mission=imported).order_by('id').first()
+        self.assertEqual(victim.bounding_box, {'x1': 1.5, 'y1': 2.0, 'x2': 30.25, 'y2': 40.0})
+        self.assertEqual(victim.person_id, f"person_0_mission_{imported.id}")
+        self.assertIsNone(victim.condition)
+        self.assertEqual(PostureClassification.objects.filter(victim__detection__mission=imported, posture_class='lying').count(), 3)
+
+    def test_victims_without_box(self):
+        import io
+        from django.utils import timezone
+        from stream_api.mission_archive import export_mission, import_mission
+        from stream_api.models import Detection, Mission, PersonDetectionModel, Victim
+
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        detection = Detection.objects.create(mission=mission, person_detection_model=model)
+        boxes = [{}, {'x1': 5.0, 'y1': 6.0}, [1, 2, 3, 4]]
+        for i, box in enumerate(boxes):
+            Victim.objects.create(detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.9,
+                                  bounding_box=box, coco_keypoints={})
+
+        imported, _ = import_mission(io.BytesIO(b''.join(export_mission(mission))))
+        self.assertEqual(list(Victim.objects.filter(detection__mission=imported).order_by('id').values_list('bounding_box', flat=True)),
+                         [{}, {'x1': 5.0, 'y1': 6.0}, {}])
+        self.assertEqual(self.client.get('/api/victims/').status_code, 200)
+
+    def test_truncated_archive_leaves_nothing(self):
+        import io
+        import tarfile
+        from unittest import mock
+        from django.utils import timezone
+        from stream_api.mission_archive import export_mission, import_mission
+        from stream_api.models import Detection, Mission, PersonDetectionModel, SnapshotBlob, Victim
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = SnapshotStorage(LocalBackend(root), get_config())
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        for i in range(3):
+            detection = Detection.objects.create(mission=mission, person_detection_model=model,
+                                                 snapshot=storage.store(f"frame {i}".encode()))
+            Victim.objects.create(detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.9,
+                                  bounding_box={'x1': 1, 'y1': 2, 'x2': 3, 'y2': 4}, coco_keypoints={})
+        storage.flush()
+        ref_counts = dict(SnapshotBlob.objects.values_list('name', 'ref_count'))
+
+        with mock.patch('stream_api.mission_archive.get_snapshot_storage', return_value=storage), \
+                mock.patch('stream_api.snapshot_storage.get_snapshot_storage', return_value=storage):
+            archive = b''.join(export_mission(mission, chunk_size=2))
+            # Cut the archive inside the first victims chunk, after the snapshots and detections
+            with tarfile.open(fileobj=io.BytesIO(archive), mode='r:*') as tar:
+                victims = next(member for member in tar if member.name.startswith('victims-'))
+            with self.assertRaises(tarfile.ReadError):
+                import_mission(io.BytesIO(archive[:victims.offset_data + 10]), batch_size=2)
+            storage.flush()
+
+        self.assertEqual(list(Mission.objects.values_list('id', flat=True)), [mission.id])
+        self.assertEqual(Detection.objects.count(), 3)
+        self.assertEqual(dict(SnapshotBlob.objects.values_list('name', 'ref_count')), ref_counts)
+        self.assertEqual(len(list(storage.backend.list('snapshots'))), 3)
+
+
+class MissionStatisticsTest(TransactionTestCase):
+    """
+    The counters kept on writes match a full recount
+    """
+    def stored(self, mission):
+        from stream_api.models import MissionStatistic
+
+        return {(kind, key): count for kind, key, count in
+                MissionStatistic.objects.filter(mission=mission).exclude(count=0).values_list('kind', 'key', 'count')}
+
+    def test_counters_follow_writes(self):
+        from django.utils import timezone
+        from stream_api.mission_statistics import compute_statistics
+        from stream_api.models import Detection, Mission, PersonDetectionModel, Victim
+
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        detections = [Detection.objects.create(mission=mission, person_detection_model=model) for _ in range(2)]
+        for i, detection in enumerate(detections * 2):
+            Victim.objects.create(detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.45 + i / 10,
+                                  bounding_box={}, coco_keypoints={})
+
+        victim = Victim.objects.only('id', 'is_found').first()
+        victim.is_found = True
+        victim.condition = 'Injured'
+        victim.save()
+        detections[1].delete()
+
+        self.assertEqual(self.stored(mission), compute_statistics(mission.id))
+        self.assertEqual(self.stored(mission)[('victims', 'total')], 2)
+
+
+class ResponseCacheTest(TransactionTestCase):
+    """
+    Cached responses are revalidated with ETags and dropped after writes
+    """
+    def test_cached_until_write(self):
+        from django.core.cache import caches
+        from django.utils import timezone
+        from stream_api.models import Mission
+
+        caches['responses'].clear()
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        url = f'/api/mission/{mission.pk}/'
+
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(self.client.get(url).content, first.content)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        mission.date_time_ended = timezone.now()
+        mission.save()
+        changed = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.assertIsNotNone(json.loads(changed.content)['date_time_ended'])
+
+
+class FastJsonTest(TransactionTestCase):
+    """
+    The fast list endpoints return what the serializers return, streamed or not
+    """
+    def test_matches_serializers(self):
+        from django.test import RequestFactory
+        from django.utils import timezone
+        from stream_api.models import Detection, Mission, PersonDetectionModel, Victim
+        from stream_api.serializers import DetectionSerializer, VictimSerializer
+
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        detections = [Detection.objects.create(mission=mission, person_detection_model=model, snapshot=snapshot)
+                      for snapshot in ('snapshots/ab/cd/abcd.jpg', None)]
+        for i, detection in enumerate(detections):
+            Victim.objects.create(detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.5,
+                                  bounding_box={'x1': 1.5}, coco_keypoints={}, estimated_latitude=None)
+
+        request = RequestFactory().get('/')
+        expected = []
+        for detection in Detection.objects.order_by('-timestamp'):
+            data = DetectionSerializer(detection).data
+            data['image_url'] = request.build_absolute_uri(f'/api/detection/{detection.id}/image/') if detection.snapshot else None
+            expected.append(json.loads(json.dumps(data)))
+        expected_victims = json.loads(json.dumps(VictimSerializer(Victim.objects.order_by('-detection__timestamp'), many=True).data))
+
+        for query in ('', '?stream=1'):
+            response = self.client.get(f'/api/mission/{mission.id}/detections/{query}')
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            self.assertEqual(json.loads(content), {'mission_id': mission.id, 'detections_count': 2, 'detections': expected})
+
+            response = self.client.get(f'/api/victims/{query}')
+            content = b''.join(response.streaming_content) if response.streaming else response.content
+            self.assertEqual(json.loads(content), {'victims_count': 2, 'victims': expected_victims})
+
+
+class BulkVictimUpdateTest(TransactionTestCase):
+    """
+    A bulk PATCH updates every listed victim, the counters and sends one notification
+    """
+    def test_bulk_patch(self):
+        from django.utils import timezone
+        from stream_api.mission_statistics import compute_statistics
+        from stream_api.models import Detection, Mission, MissionStatistic, PersonDetectionModel, Victim
+        from stream_api.signals import victims_updated
+
+        model = PersonDetectionModel.objects.create(model_type='Top View')
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        detection = Detection.objects.create(mission=mission, person_detection_model=model)
+        victims = [Victim.objects.create(detection=detection, person_id=f"person_{i}", person_recognition_confidence=0.5,
+                                         bounding_box={}, coco_keypoints={}) for i in range(3)]
+        ids = [victim.id for victim in victims[:2]]
+
+        notifications = []
+        handler = lambda sender, **kwargs: notifications.append(kwargs['ids'])  # noqa: E731
+        victims_updated.connect(handler)
+        self.addCleanup(victims_updated.disconnect, handler)
+
+        response = self.client.patch('/api/victims/', {'ids': ids, 'changes': {'is_found': True, 'condition': 'Injured'}},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['id'], row['is_found']) for row in json.loads(response.content)['victims']],
+                         [(pk, True) for pk in ids])
+        self.assertEqual(notifications, [ids])
+
+        stored = {(kind, key): count for kind, key, count in
+                  MissionStatistic.objects.filter(mission=mission).exclude(count=0).values_list('kind', 'key', 'count')}
+        self.assertEqual(stored, compute_statistics(mission.id))
+        self.assertEqual(stored[('found', 'found')], 2)
+
+        for body in ({'ids': ids, 'changes': {'person_id': 'x'}}, {'ids': [], 'changes': {'is_found': True}}):
+            self.assertEqual(self.client.patch('/api/victims/', body, content_type='application/json').status_code, 400)
+        missing = self.client.patch('/api/victims/', {'ids': [ids[0], 999], 'changes': {'is_found': False}},
+                                    content_type='application/json')
+        self.assertEqual(missing.status_code, 404)
+        self.assertTrue(Victim.objects.get(pk=ids[0]).is_found)
+
+        put = self.client.put(f'/api/victim/{victims[2].id}/', {'condition': 'Critical'}, content_type='application/json')
+        self.assertEqual(json.loads(put.content)['condition'], 'Critical')
+
+
+class HTTPCameraSourceTest(SimpleTestCase):
+    """
+    MJPEG parts are split into frames however the bytes arrive, and one connection feeds every reader
+    """
+    def test_parser(self):
+        from camera_consumer_api.upstream import MultipartParser, parse_boundary
+
+        frames = [b'\xff\xd8' + bytes([i]) * 100 + b'\xff\xd9' for i in range(3)]
+        stream = b'junk\r\n' + b''.join(
+            b'--123456\r\nContent-Type: image/jpeg\r\n' + (b'Content-Length: %d\r\n' % len(frame) if i % 2 else b'')
+            + b'\r\n' + frame + b'\r\n' for i, frame in enumerate(frames)
+        ) + b'--123456\r\n'
+        boundary = parse_boundary('multipart/x-mixed-replace;boundary=123456')
+
+        for size in (1, 7, len(stream)):
+            parser = MultipartParser(boundary)
+            parts = [part for offset in range(0, len(stream), size) for part in parser.feed(stream[offset:offset + size])]
+            self.assertEqual(parts, frames)
+
+    def serve_camera(self, num_frames):
+        """Start a camera sending num_frames frames per connection, returns its URL and the list of connections"""
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        connections = []
+
+        class Camera(BaseHTTPRequestHandler):
+            def do_GET(self):
+                connections.append(self.path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace;boundary=frame')
+                self.end_headers()
+                try:
+                    for i in range(num_frames):
+                        jpeg = b'\xff\xd8' + bytes([i % 256]) * 1000 + b'\xff\xd9'
+                        self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(jpeg) + jpeg + b'\r\n')
+                        self.wfile.flush()
+                        threading.Event().wait(0.01)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Camera)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        self.addCleanup(server.server_close)
+        return f'http://127.0.0.1:{server.server_port}/stream', connections
+
+    def test_shared_connection(self):
+        from camera_consumer_api.upstream import DEFAULTS, HTTPCameraSource
+
+        url, connections = self.serve_camera(50)
+        source = HTTPCameraSource('test-camera', dict(DEFAULTS, URL=url))
+        viewers = [source.wait_for_frame(timeout=5.0) for _ in range(3)]
+        self.assertTrue(all(frame is not None and frame.jpeg.startswith(b'\xff\xd8') for frame in viewers))
+        frame = source.wait_for_frame(viewers[-1].seq, timeout=5.0)
+        self.assertGreater(frame.seq, viewers[-1].seq)
+        self.assertEqual(len(connections), 1)
+
+    def test_idle_reader_stops(self):
+        import threading
+        from camera_consumer_api.upstream import DEFAULTS, HTTPCameraSource
+
+        url, connections = self.serve_camera(1000)
+        source = HTTPCameraSource('idle-camera', dict(DEFAULTS, URL=url, IDLE_TIMEOUT=0.3))
+        self.assertIsNotNone(source.wait_for_frame(timeout=5.0))
+        thread = source._thread
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(source.connected)
+        seq = source.latest().seq
+        threading.Event().wait(0.1)
+        self.assertIsNotNone(source.wait_for_frame(seq, timeout=5.0))
+        self.assertEqual(len(connections), 2)
+
+    def test_cameras_created_on_first_use(self):
+        from unittest import mock
+        from camera_consumer_api.upstream import HTTPCameraSource
+        from stream_api import frames
+
+        with override_settings(HTTP_CAMERAS={'lazy-camera': {'URL': 'http://127.0.0.1:9/stream'}}), \
+                mock.patch.dict(frames._sources):
+            self.assertNotIn('lazy-camera', frames._sources)
+            source = frames.get_frame_source('lazy-camera')
+            self.assertIsInstance(source, HTTPCameraSource)
+            self.assertIsNone(source._thread)
+            with self.assertRaises(KeyError):
+                frames.get_frame_source('no-such-camera')
+
+
+@skipUnless(HAS_PYAV, "needs PyAV")
+class VideoEncoderTest(SimpleTestCase):
+    """
+    Every viewer of a stream gets the same fragmented MP4, encoded once
+    """
+    def test_viewers_share_encoder(self):
+        import threading
+        from io import BytesIO
+        import av
+        import numpy as np
+        from PIL import Image
+        from stream_api.frames import FrameSource
+        from stream_api.video import DEFAULTS, VideoEncoder, raw_frames
+
+        source = FrameSource('video-test')
+        encoder = VideoEncoder('video-test', raw_frames(source), dict(DEFAULTS, KEYFRAME_INTERVAL=5, IDLE_TIMEOUT=0.5))
+        streams = [encoder.stream() for _ in range(2)]
+        outputs = [bytearray() for _ in streams]
+
+        def watch(stream, output):
+            for chunk in stream:
+                output += chunk
+                if len(output) > 4000:
+                    return
+        threads = [threading.Thread(target=watch, args=pair, daemon=True) for pair in zip(streams, outputs)]
+        for thread in threads:
+            thread.start()
+
+        for i in range(40):
+            image = np.zeros((96, 128, 3), np.uint8)
+            image[20:60, i * 2:i * 2 + 30] = 255
+            buffer = BytesIO()
+            Image.fromarray(image).save(buffer, 'JPEG')
+            source.publish(buffer.getvalue())
+            threading.Event().wait(0.02)
+            if not any(thread.is_alive() for thread in threads):
+                break
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(outputs[0][4:8], b'ftyp')
+        self.assertEqual(outputs[0][:4000], outputs[1][:4000])
+        frames = list(av.open(BytesIO(bytes(outputs[0]))).decode(video=0))
+        self.assertGreater(len(frames), 1)
+        self.assertEqual((frames[0].width, frames[0].height), (128, 96))
+
+
+class AdmissionTest(SimpleTestCase):
+    """
+    Queued requests are admitted by priority and the rest is shed with 503
+    """
+    def test_priority_queue(self):
+        import threading
+        from stream_api.admission import Gate
+
+        gate = Gate('test', 1, {'capture': {'PRIORITY': 0, 'LIMIT': 1}, 'viewer': {'PRIORITY': 2, 'LIMIT': 1}}, queue_size=2)
+        held = gate.acquire('viewer')
+        self.assertIsNone(gate.acquire('viewer'))
+
+        admitted = []
+        threads = [threading.Thread(target=lambda request_class=request_class: admitted.append(
+            (request_class, gate.acquire(request_class, timeout=2.0)))) for request_class in ('viewer', 'capture')]
+        for thread in threads:
+            thread.start()
+            threading.Event().wait(0.05)
+        self.assertIsNone(gate.acquire('capture', timeout=0.1))  # Queue full
+
+        held.release()
+        threads[1].join(1)
+        self.assertEqual(admitted[0][0], 'capture')
+        admitted[0][1].release()
+        threads[0].join(3)
+        self.assertEqual([request_class for request_class, ticket in admitted if ticket], ['capture', 'viewer'])
+
+    @override_settings(ADMISSION={'RAW_LIMIT': 1, 'RETRY_AFTER': 7})
+    def test_raw_stream_shed(self):
+        from unittest import mock
+        from stream_api import admission
+
+        with mock.patch.dict(admission._gates, clear=True):
+            first = self.client.get('/api/stream/')
+            second = self.client.get('/api/stream/')
+            self.assertEqual(second.status_code, 503)
+            self.assertEqual(second['Retry-After'], '7')
+            first.close()
+            third = self.client.get('/api/stream/')
+            self.assertEqual(third.status_code, 200)
+            third.close()
+
+    @override_settings(ADMISSION={'METADATA_LIMIT': 1})
+    def test_metadata_stream_shed(self):
+        from unittest import mock
+        from stream_api import admission
+
+        with mock.patch.dict(admission._gates, clear=True), mock.patch('stream_api.views.get_source_pipeline'):
+            first = self.client.get('/api/detection-metadata-stream/')
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(self.client.get('/api/detection-metadata-stream/').status_code, 503)
+            first.close()
+            second = self.client.get('/api/detection-metadata-stream/')
+            self.assertEqual(second.status_code, 200)
+            second.close()
+
+    def test_operator_class_follows_user(self):
+        from django.contrib.auth.models import AnonymousUser, User
+        from stream_api.admission import stream_class
+
+        self.assertEqual(stream_class(AnonymousUser()), 'viewer')
+        self.assertEqual(stream_class(User(username='operator', is_staff=True)), 'operator')
+
+
+class MetricsViewTest(SimpleTestCase):
+    """
+    /api/metrics/ serves recorded spans as a Prometheus histogram with recent quantiles
+    """
+    def test_prometheus_exposition(self):
+        from unittest import mock
+        from stream_api import metrics
+
+        with mock.patch('stream_api.metrics.time.perf_counter', side_effect=[10.0, 10.25]):
+            with metrics.span('metrics-test', 'encode'):
+                pass
+
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        labels = 'path="metrics-test",stage="encode"'
+        for line in (
+            '# HELP ahon_stage_latency_seconds Latency of each stage of the vision pipeline',
+            '# TYPE ahon_stage_latency_seconds histogram',
+            f'ahon_stage_latency_seconds_bucket{{{labels},le="0.1"}} 0',
+            f'ahon_stage_latency_seconds_bucket{{{labels},le="0.25"}} 1',
+            f'ahon_stage_latency_seconds_bucket{{{labels},le="+Inf"}} 1',
+            f'ahon_stage_latency_seconds_sum{{{labels}}} 0.25',
+            f'ahon_stage_latency_seconds_count{{{labels}}} 1',
+            '# TYPE ahon_stage_latency_recent_seconds gauge',
+            f'ahon_stage_latency_recent_seconds{{{labels},quantile="0.5"}} 0.25',
+            f'ahon_stage_latency_recent_seconds{{{labels},quantile="0.99"}} 0.25',
+        ):
+            self.assertIn(line, lines)
+        # Every sample line is a metric name, optional labels and a number
+        for line in lines:
+            if not line.startswith('#'):
+                self.assertRegex(line, r'^ahon_[a-z_]+(\{[^}]*\})? [-+0-9.eInf]+$')
+
+
+class JpegCodecTest(SimpleTestCase):
+    """
+    Header dimensions match a full decode, scaled decodes and their boxes map back to full size
+    """
+    def test_scaled_decode(self):
+        from PIL import Image
+        from stream_api import jpeg as jpeg_codec
+        from stream_api.inference_backends import Detections
+
+        with open('image.jpg', 'rb') as f:
+            jpeg = f.read()
+        width, height = jpeg_codec.jpeg_size(jpeg)
+        self.assertEqual((width, height), Image.open('image.jpg').size)
+        with self.assertRaises(ValueError):
+            jpeg_codec.jpeg_size(b'not a jpeg')
+
+        for scale in jpeg_codec.SCALES:
+            with self.subTest(scale=scale):
+                image = jpeg_codec.decode(jpeg, scale)
+                self.assertEqual(image.shape[:2], (-(-height // scale), -(-width // scale)))
+        self.assertEqual(jpeg_codec.scale_for((width, height), 160), 4)
+        self.assertEqual(jpeg_codec.scale_for((width, height), 1000), 1)
+
+        thumbnail = jpeg_codec.get_codec().resize(jpeg, 100)
+        self.assertEqual(max(jpeg_codec.jpeg_size(thumbnail)), 100)
+
+        reduced = jpeg_codec.decode(jpeg, 4)
+        detections = Detections(reduced, [[10, 20, 30, 40]], [0.9], [0], {0: 'person'})
+        detections.restore_scale(jpeg)
+        self.assertEqual(detections.boxes.tolist(), [[40, 80, 120, 160]])
+        self.assertEqual(detections.plot().shape[:2], (height, width))
+
+
+class OverlayRendererTest(SimpleTestCase):
+    """
+    The renderer draws into one reused buffer, at full or reduced size
+    """
+    def test_render(self):
+        import numpy as np
+        from stream_api import jpeg as jpeg_codec
+        from stream_api.inference_backends import Detections
+        from stream_api.overlay import BOX_COLOR, OverlayRenderer
+
+        image = np.zeros((480, 640, 3), dtype=np.uint8)
+        boxes, confidences, class_ids, names = [[100, 200, 300, 400]], [0.87], [0], {0: 'person'}
+        renderer = OverlayRenderer()
+        frame = renderer.render(image, boxes, confidences, class_ids, names)
+        self.assertEqual(frame[300, 100].tolist(), list(BOX_COLOR))
+        self.assertEqual(frame[300, 200].tolist(), [0, 0, 0])
+        self.assertFalse(image.any())
+        self.assertIs(renderer.render(image, boxes, confidences, class_ids, names), frame)
+
+        small = renderer.render(image, boxes, confidences, class_ids, names, size=(160, 120))
+        self.assertEqual(small.shape, (120, 160, 3))
+        self.assertEqual(small[75, 25].tolist(), list(BOX_COLOR))
+
+        # Boxes at the frame edges are clipped
+        renderer.render(image, [[-10, -10, 700, 20]], confidences, class_ids, names)
+
+        detections = Detections(image, boxes, confidences, class_ids, names)
+        self.assertEqual(jpeg_codec.jpeg_size(detections.render_jpeg(4)), (160, 120))
+
+
+class DetectionMetadataStreamTest(SimpleTestCase):
+    """
+    The SSE stream sends the boxes of every result, and nothing draws the annotated frame for its viewers
+    """
+    def test_events(self):
+        from unittest import mock
+        from stream_api.detection_pipeline import get_detection_pipeline
+        from stream_api.frames import FrameSource, register_frame_source
+        from stream_api.inference_backends import Detections
+
+        source = register_frame_source(FrameSource('sse-test'))
+        pipeline = get_detection_pipeline('sse-test')
+        backend = mock.Mock(wraps=StubBackend())
+        with open('image.jpg', 'rb') as f:
+            jpeg = f.read()
+        source.publish(jpeg)
+
+        with mock.patch.object(pipeline, 'load_detection_model', return_value=(backend, 0.5, 7, None)), \
+                mock.patch.object(Detections, 'render_jpeg') as render_jpeg:
+            response = self.client.get('/api/detection-metadata-stream/', {'source': 'sse-test'})
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            events = []
+            chunks = iter(response.streaming_content)
+            self.assertTrue(next(chunks).startswith(b'event: source\n'))
+            for chunk in chunks:
+                if chunk.startswith(b'id: '):
+                    events.append(chunk)
+                    if len(events) == 2:
+                        break
+                    source.publish(jpeg)
+            response.close()
+
+        seqs = []
+        for event in events:
+            self.assertTrue(event.endswith(b'\n\n'))
+            lines = event.decode().strip().split('\n')
+            self.assertEqual(lines[1], 'event: detection')
+            data = json.loads(lines[2][len('data: '):])
+            self.assertEqual(lines[0], f"id: {data['seq']}")
+            self.assertEqual(data['boxes'], [[10.0, 20.0, 110.0, 220.0]])
+            self.assertEqual(data['confidences'], [0.9])
+            self.assertEqual((data['model_id'], data['width'], data['height']), (7, 640, 480))
+            seqs.append(data['seq'])
+        self.assertEqual(seqs, [1, 2])
+        self.assertEqual({call.kwargs['annotate'] for call in backend.predict_jpeg.call_args_list}, {False})
+        render_jpeg.assert_not_called()
+
+
+class FrameAccurateCaptureTest(TransactionTestCase):
+    """
+    A capture with the seq of a streamed frame saves that frame's result without running inference
+    """
+    def test_capture_streamed_frame(self):
+        from unittest import mock
+        from django.utils import timezone
+        from stream_api.detection_pipeline import DetectionResult, get_detection_pipeline
+        from stream_api.frames import FrameSource, register_frame_source
+        from stream_api.inference_backends import Detections
+        from stream_api.models import Detection, Mission, PersonDetectionModel
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config
+
+        model = PersonDetectionModel.objects.create(model_type='Top View', confidence=0.3)
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        source = register_frame_source(FrameSource('capture-test'))
+        pipeline = get_detection_pipeline('capture-test')
+        with open('image.jpg', 'rb') as f:
+            frame = source.publish(f.read())
+        detections = Detections(None, [[10, 20, 110, 220]], [0.42], [0], {0: 'person'}, orig_shape=(480, 640))
+        pipeline.buffer.append(DetectionResult(frame, detections, model.id, 0.3))
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = SnapshotStorage(LocalBackend(root), get_config())
+        with mock.patch('stream_api.model_views.detection_views.get_snapshot_storage', return_value=storage), \
+                mock.patch.object(pipeline, 'process', side_effect=AssertionError("inference ran again")):
+            response = self.client.post('/api/capture-detection/', {'mission_id': mission.id, 'seq': frame.seq,
+                                                                     'source': 'capture-test'}, content_type='application/json')
+            expired = self.client.post('/api/capture-detection/', {'mission_id': mission.id, 'seq': frame.seq + 100,
+                                                                    'source': 'capture-test'}, content_type='application/json')
+        storage.flush()
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(expired.status_code, 410)
+        detection = Detection.objects.get()
+        self.assertEqual(detection.person_detection_model_id, model.id)
+        self.assertEqual(response.json()['victims'][0]['bounding_box'], {'x1': 10.0, 'y1': 20.0, 'x2': 110.0, 'y2': 220.0})
+        self.assertAlmostEqual(response.json()['victims'][0]['confidence'], 0.42, places=5)
+        self.assertEqual(storage.read(detection.snapshot.name)[:2], b'\xff\xd8')
+
+        # Boxes of a model that was deleted meanwhile are not saved under another one
+        deleted = PersonDetectionModel.objects.create(model_type='Angled View')
+        frame = source.publish(frame.jpeg)
+        pipeline.buffer.append(DetectionResult(frame, detections, deleted.id, 0.3))
+        deleted.delete()
+        response = self.client.post('/api/capture-detection/', {'mission_id': mission.id, 'seq': frame.seq,
+                                                                 'source': 'capture-test'}, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Detection.objects.count(), 1)
+
+
+class BurstCaptureTest(TransactionTestCase):
+    """
+    A burst saves the most confident buffered frames with the times they were taken
+    """
+    def test_burst_keeps_frame_times(self):
+        from unittest import mock
+        from django.utils import timezone
+        from stream_api.detection_pipeline import DetectionResult, get_detection_pipeline
+        from stream_api.frames import Frame, FrameSource, register_frame_source
+        from stream_api.inference_backends import Detections
+        from stream_api.models import Detection, Mission, PersonDetectionModel
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config
+
+        model = PersonDetectionModel.objects.create(model_type='Top View', confidence=0.3)
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        register_frame_source(FrameSource('burst-test'))
+        pipeline = get_detection_pipeline('burst-test')
+        with open('image.jpg', 'rb') as f:
+            jpeg = f.read()
+        for seq, confidence in enumerate([0.9, 0.5, 0.8, 0.4, 0.6], start=1):
+            detections = Detections(None, [[10, 20, 110, 220]], [confidence], [0], {0: 'person'}, orig_shape=(480, 640))
+            pipeline.buffer.append(DetectionResult(Frame('burst-test', seq, jpeg, 1_700_000_000.5 + seq), detections, model.id, 0.3))
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = SnapshotStorage(LocalBackend(root), get_config())
+        with mock.patch('stream_api.model_views.detection_views.get_snapshot_storage', return_value=storage):
+            response = self.client.post('/api/capture-detection/', {'mission_id': mission.id, 'seq': 5, 'source': 'burst-test',
+                                                                     'burst_seconds': 3, 'burst_frames': 2},
+                                        content_type='application/json')
+        storage.flush()
+
+        self.assertEqual(response.status_code, 201)
+        # Frames 2-5 are within the 3 s before frame 5, frames 3 and 5 are the most confident
+        timestamps = sorted(detection.timestamp.timestamp() for detection in Detection.objects.all())
+        self.assertEqual(timestamps, [1_700_000_003.5, 1_700_000_005.5])
+
+
+class ResultRingBufferTest(SimpleTestCase):
+    """
+    The pre-trigger buffer keeps the last seconds within its memory cap and ranks a burst by confidence
+    """
+    def test_window_and_cap(self):
+        from stream_api.detection_pipeline import DetectionResult
+        from stream_api.frames import Frame
+        from stream_api.inference_backends import Detections
+        from stream_api.ring_buffer import ResultRingBuffer
+
+        def result(seq, timestamp, confidences):
+            detections = Detections(None, [[0, 0, 10, 10]] * len(confidences), confidences, [0] * len(confidences),
+                                    {0: 'person'}, orig_shape=(480, 640))
+            return DetectionResult(Frame('test', seq, b'\xff\xd8' + b'\x00' * 998, timestamp), detections, 1, 0.5)
+
+        buffer = ResultRingBuffer('ring-test', seconds=5.0, max_bytes=10_000)
+        for seq in range(1, 13):
+            buffer.append(result(seq, 100.0 + seq, [0.1 * (seq % 7)]))
+        # Frames older than 5 s before the newest are gone
+        self.assertEqual([r.seq for r in buffer.window(0, 200)], [7, 8, 9, 10, 11, 12])
+        self.assertIsNone(buffer.get(3))
+        self.assertEqual(buffer.get(9).seq, 9)
+        self.assertEqual([r.seq for r in buffer.best(109.0, 112.0, count=2)], [11, 12])
+        self.assertEqual([r.seq for r in buffer.best(109.0, 112.0, include=result(13, 112.5, [0.99]))], [13])
+
+        # The byte cap drops the oldest results first, the newest is always kept
+        buffer.max_bytes = 2_500
+        buffer.append(result(13, 113.0, []))
+        self.assertEqual([r.seq for r in buffer.window(0, 200)], [12, 13])
+        buffer.append(result(14, 114.0, [0.5] * 400))
+        self.assertEqual([r.seq for r in buffer.window(0, 200)], [14])
+
+
+class FrameSourceStatusTest(SimpleTestCase):
+    """
+    Status comes from the metadata of the latest frame, and stale sources are pushed to viewers
+    """
+    def test_stale_source(self):
+        import time
+        from stream_api.frames import STALE_AFTER, FrameSource, register_frame_source
+
+        source = register_frame_source(FrameSource('status-test'))
+        self.assertEqual(self.client.get('/api/status/?source=status-test').status_code, 404)
+        with open('image.jpg', 'rb') as f:
+            jpeg = f.read()
+        source.publish(jpeg)
+
+        response = self.client.get('/api/status/?source=status-test').json()
+        self.assertEqual(response['status'], 'available')
+        self.assertEqual(response['dimensions'], {'width': 640, 'height': 480})
+        self.assertEqual((response['file_size'], response['seq']), (len(jpeg), 1))
+
+        stream = self.client.get('/api/stream/?source=status-test')
+        parts = iter(stream.streaming_content)
+        self.assertIn(b'X-Frame-Seq: 1', next(parts))
+        version = source.state_version
+        source.check_stale(time.monotonic() + STALE_AFTER + 1)
+        self.assertEqual(self.client.get('/api/status/?source=status-test').json()['status'], 'stale')
+        started = time.monotonic()
+        self.assertIsNone(source.wait_for_frame(1, timeout=5.0, state_version=version))
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertIn(b'X-Source-State: stale', next(parts))
+        stream.close()
+
+        source.publish(jpeg)
+        self.assertFalse(source.stale)
+
+
+class ProfilingTest(TransactionTestCase):
+    """
+    Only admins can profile, and a session yields folded stacks and allocation sites
+    """
+    def test_profile_session(self):
+        import threading
+        from django.contrib.auth.models import User
+        from stream_api import profiling
+
+        self.assertEqual(self.client.post('/api/profile/', {'duration': 0.2}, content_type='application/json').status_code, 403)
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+
+        stop = threading.Event()
+
+        def busy_worker():
+            while not stop.is_set():
+                sum(range(1000))
+
+        worker = threading.Thread(target=busy_worker, name='busy-worker')
+        worker.start()
+        try:
+            response = self.client.post('/api/profile/', {'duration': 0.3, 'interval': 0.005, 'trace_memory': True},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(self.client.post('/api/profile/', {'duration': 0.3}, content_type='application/json').status_code, 409)
+            profiling.get_session().join(5)
+        finally:
+            stop.set()
+            worker.join()
+
+        stacks = self.client.get('/api/profile/?download=stacks').content.decode()
+        self.assertRegex(stacks, r'(?m)^busy-worker;.*busy_worker \(stream_api/tests\.py:\d+\).* \d+$')
+        self.assertIsInstance(self.client.get('/api/profile/?download=allocations').json(), list)
+        self.assertFalse(self.client.get('/api/profile/').json()['running'])
+
+
+@override_settings(AUTO_CAPTURE={'MAX_PER_MINUTE': 1, 'BURST': 2, 'FLUSH_INTERVAL': 0.05})
+class AutoCaptureTest(TransactionTestCase):
+    """
+    Auto-capture saves each new person once, within the mission's rate, in batches through the writer
+    """
+    def test_new_people_captured_once(self):
+        from unittest import mock
+        from django.utils import timezone
+        from stream_api import auto_capture
+        from stream_api.detection_pipeline import DetectionResult
+        from stream_api.frames import Frame, FrameSource, register_frame_source
+        from stream_api.inference_backends import Detections
+        from stream_api.mission_statistics import get_summary
+        from stream_api.models import Detection, Mission, PersonDetectionModel, Victim
+        from stream_api.snapshot_storage import LocalBackend, SnapshotStorage, get_config
+
+        model = PersonDetectionModel.objects.create(model_type='Top View', confidence=0.3)
+        mission = Mission.objects.create(date_time_started=timezone.now())
+        register_frame_source(FrameSource('auto-test'))
+        with open('image.jpg', 'rb') as f:
+            jpeg = f.read()
+
+        def result(seq, boxes, confidences):
+            detections = Detections(None, boxes, confidences, [0] * len(boxes), {0: 'person'}, orig_shape=(480, 640))
+            return DetectionResult(Frame('auto-test', seq, jpeg, 1_700_000_000.0 + seq), detections, model.id, 0.3)
+
+        response = self.client.post('/api/auto-capture/', {'mission_id': mission.id, 'source': 'auto-test', 'latitude': 14.5},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        session = auto_capture.get_session('auto-test')
+
+        a, b, c = [10, 10, 110, 210], [300, 50, 380, 250], [500, 200, 600, 400]
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        storage = SnapshotStorage(LocalBackend(root), get_config())
+        with mock.patch('stream_api.auto_capture.get_snapshot_storage', return_value=storage):
+            self.assertTrue(session.handle(result(1, [a], [0.8])))
+            # The same person a little further on, and someone below the model's confidence
+            self.assertFalse(session.handle(result(2, [[14, 12, 116, 214], c], [0.8, 0.2])))
+            self.assertTrue(session.handle(result(3, [[18, 14, 120, 218], b], [0.8, 0.7])))
+            # The burst is used up, the new person waits for the bucket
+            self.assertFalse(session.handle(result(4, [[18, 14, 120, 218], b, c], [0.8, 0.7, 0.9])))
+            auto_capture.get_writer().flush()
+        storage.flush()
+
+        self.assertEqual((session.captured, session.people, session.rate_limited), (2, 2, 1))
+        detections = list(Detection.objects.order_by('id'))
+        self.assertEqual([detection.timestamp.timestamp() for detection in detections], [1_700_000_001.0, 1_700_000_003.0])
+        self.assertTrue(all(detection.is_live and detection.latitude == 14.5 for detection in detections))
+        victims = Victim.objects.order_by('id')
+        self.assertEqual([victim.person_id for victim in victims], [f"person_{detections[0].id}_1", f"person_{detections[1].id}_2"])
+        self.assertEqual(victims[1].bounding_box, {'x1': 300.0, 'y1': 50.0, 'x2': 380.0, 'y2': 250.0})
+        summary = get_summary(mission.id)
+        self.assertEqual((summary['detections_count'], summary['victims_count']), (2, 2))
+
+        response = self.client.delete('/api/auto-capture/?source=auto-test')
+        self.assertFalse(response.json()['enabled'])
+        self.assertIsNone(auto_capture.get_session('auto-test'))
@@ -0,0 +1,99 @@
+"""
+Tiled (sliced) inference for high resolution top view frames.
+
+The frame is split into overlapping tiles at native resolution, all tiles plus the full
+frame (which the backend letterboxes down to its input size, for people larger than a
+tile) go through the model together, and the boxes are merged back with a vectorized NMS.
+"""
+import time
+
+import numpy as np
+
+from stream_api import metrics
+
+
+def make_tiles(height, width, tile_size, overlap):
+    """Return (x1, y1, x2, y2) tiles that cover the frame, the last row/column is aligned to the edge"""
+    if tile_size < 1 or not 0 <= overlap < 1:
+        raise ValueError(f"Invalid tiling: tile_size {tile_size}, overlap {overlap}")
+    step = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, step))
+        positions.append(length - tile_size)
+        return positions
+
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in starts(height)
+        for x in starts(width)
+    ]
+
+
+def nms(boxes, scores, iou_threshold, class_ids=None):
+    """Vectorized non-maximum suppression, returns the indices to keep by descending score"""
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    if class_ids is not None:
+        # Offset the boxes per class so boxes of different classes never overlap
+        boxes = boxes + class_ids[:, None].astype(boxes.dtype) * (boxes.max() + 1)
+
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        width = (np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest])).clip(0)
+        height = (np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest])).clip(0)
+        intersection = width * height
+        iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def predict_tiled(backend, image, conf, tile_size=640, overlap=0.2, parallelism=2, iou=0.5):
+    """Run a backend over the tiles of an image and merge the boxes"""
+    from stream_api.inference_backends import Detections
+
+    height, width = image.shape[:2]
+    timings = {}
+
+    started = time.perf_counter()
+    tiles = make_tiles(height, width, tile_size, overlap)
+    crops = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in tiles]
+    if len(tiles) > 1:
+        # The full frame keeps people that are larger than a tile
+        tiles.append((0, 0, width, height))
+        crops.append(image)
+    timings['crop'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = backend.predict_batch(crops, conf, parallelism=parallelism)
+    timings['inference'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    offsets = np.concatenate([
+        np.tile(np.array([x1, y1, x1, y1], dtype=np.float32), (len(result), 1))
+        for (x1, y1, _, _), result in zip(tiles, results)
+    ])
+    boxes = np.concatenate([result.boxes for result in results]) + offsets
+    confidences = np.concatenate([result.confidences for result in results])
+    class_ids = np.concatenate([result.class_ids for result in results])
+
+    keep = nms(boxes, confidences, iou, class_ids)
+    timings['merge'] = time.perf_counter() - started
+
+    for stage, seconds in timings.items():
+        metrics.observe('stage_latency_seconds', seconds, path='tiling', stage=stage)
+
+    names = results[0].names
+    detections = Detections(image, boxes[keep], confidences[keep], class_ids[keep], names)
+    detections.tiles = len(tiles)
+    detections.timings = timings
+    return detections
@@ -20,23 +20,29 @@ from django.conf.urls.static import static
 from django.conf import settings
 
 from . import views
-from stream_api.model_views import MissionList, MissionDetail, AllVictimsView, VictimDetailView, VictimsByDetectionView ,PersonDetectionModelDetail, PersonDetectionModelList, DetectionList, CaptureDetectionView, DetectionImageView, DetectionDetail, DetectionsByMissionView
+from stream_api.model_views import MissionList, MissionDetail, MissionExportView, MissionSummaryView, AllVictimsView, VictimDetailView, VictimsByDetectionView ,PersonDetectionModelDetail, PersonDetectionModelList, DetectionList, CaptureDetectionView, AutoCaptureView, DetectionImageView, DetectionDetail, DetectionsByMissionView
 
 urlpatterns = [
     path('stream/', views.ImageStreamView.as_view(), name='image-stream'),
     path('status/', views.ImageStatusView.as_view(), name='image-status'),
     path('detection-stream/', views.DetectionStreamView.as_view(), name='detection-stream'),
+    path('detection-metadata-stream/', views.DetectionMetadataStreamView.as_view(), name='detection-metadata-stream'),
 
     path('image/', views.SimpleImageView.as_view(), name='simple-image'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    path('profile/', views.ProfileView.as_view(), name='profile'),
 
     # Mission URLs
     path('missions/', MissionList.as_view()),
     path('mission/<int:pk>/', MissionDetail.as_view()),
+    path('mission/<int:pk>/export/', MissionExportView.as_view(), name='mission-export'),
+    path('mission/<int:pk>/summary/', MissionSummaryView.as_view(), name='mission-summary'),
 
     # Detection URLs
     path('detections/', DetectionList.as_view(), name='detection_list'),
     path('detection/<int:pk>/', DetectionDetail.as_view(), name='detection_detail'),
     path('capture-detection/', CaptureDetectionView.as_view(), name='capture_detection'),
+    path('auto-capture/', AutoCaptureView.as_view(), name='auto_capture'),
     path('detection/<int:detection_id>/image/', DetectionImageView.as_view(), name='detection-image'),
     # Detections by mission ID
     path('mission/<int:mission_id>/detections/', DetectionsByMissionView.as_view(), name='detections-by-mission'),
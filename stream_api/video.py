@@ -0,0 +1,291 @@
+"""
+H.264 output of the live and detection streams, served as fragmented MP4.
+
+One VideoEncoder per stream (raw or detection frames of a source) decodes the JPEG frames,
+encodes them once with libx264 and muxes every frame into its own MP4 fragment. Viewers
+get the init segment, then the fragments from the latest keyframe on, so all of them share
+the encoder output and a new viewer starts playing at most one keyframe interval later.
+The encoder stops when nobody watched for IDLE_TIMEOUT and starts again with the next viewer.
+
+Needs PyAV (`pip install av`), which bundles FFmpeg with libx264.
+"""
+import struct
+import threading
+import time
+from collections import deque
+from fractions import Fraction
+
+from django.conf import settings
+
+from stream_api import metrics
+from stream_api.jpeg import jpeg_size
+
+
+DEFAULTS = {
+    'CODEC': 'libx264',
+    'BITRATE': 150_000,  # Bits per second, a 640x480 JPEG stream at 15 fps is about 1 Mbit/s
+    'KEYFRAME_INTERVAL': 15,  # Frames between keyframes, new viewers wait for the next one
+    'FPS': 15,  # Nominal frame rate for the rate control, timestamps follow the real frame times
+    'PRESET': 'veryfast',
+    'TUNE': 'zerolatency',  # No B-frames or lookahead, every frame is sent as soon as it is encoded
+    'IDLE_TIMEOUT': 5.0,
+}
+
+CONTENT_TYPE = 'video/mp4'
+
+
+def get_config():
+    config = dict(DEFAULTS)
+    config.update(getattr(settings, 'VIDEO_STREAM', {}))
+    return config
+
+
+class BoxReader:
+    """
+    Collects the bytes the MP4 muxer writes and splits them into top level boxes
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def boxes(self):
+        """Yield (type, bytes) of the complete boxes written so far"""
+        while len(self.buffer) >= 8:
+            size, = struct.unpack('>I', self.buffer[:4])
+            if len(self.buffer) < size:
+                return
+            box = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            yield box[4:8], box
+
+
+class H264Session:
+    """
+    One libx264 encoder and fragmented MP4 muxer, sized after the first frame
+    """
+    def __init__(self, width, height, config):
+        import av
+
+        self.width = width - width % 2
+        self.height = height - height % 2
+        self.output = BoxReader()
+        self.container = av.open(self.output, mode='w', format='mp4',
+                                 options={'movflags': 'frag_every_frame+empty_moov+default_base_moof'})
+        self.stream = self.container.add_stream(config['CODEC'], rate=config['FPS'])
+        self.stream.width = self.width
+        self.stream.height = self.height
+        self.stream.pix_fmt = 'yuv420p'
+        self.stream.bit_rate = config['BITRATE']
+        self.stream.codec_context.gop_size = config['KEYFRAME_INTERVAL']
+        self.stream.codec_context.time_base = Fraction(1, 1000)
+        self.stream.codec_context.options = {'preset': config['PRESET'], 'tune': config['TUNE']}
+        self.decoder = av.CodecContext.create('mjpeg', 'r')
+
+        self.started = None  # Time of the first frame
+        self.last_pts = -1
+        self.init_segment = b''
+        self._moof = None
+        # Keyframe flags of the muxed packets whose fragments were not written yet
+        self._keyframes = deque()
+
+    def encode(self, jpeg, timestamp):
+        """Encode a JPEG frame, returns the completed fragments as (bytes, starts with a keyframe)"""
+        import av
+        from av.video.frame import PictureType
+
+        with metrics.span('video', 'decode'):
+            frames = self.decoder.decode(av.Packet(jpeg))
+        if self.started is None:
+            self.started = timestamp
+        fragments = []
+        for frame in frames:
+            with metrics.span('video', 'encode'):
+                frame = frame.reformat(width=self.width, height=self.height, format='yuv420p')
+                # Millisecond timestamps from the frame times, players then keep the real pace
+                frame.pts = self.last_pts = max(int((timestamp - self.started) * 1000), self.last_pts + 1)
+                frame.time_base = Fraction(1, 1000)
+                # Decoded JPEGs are intra frames, which would force a keyframe every frame
+                frame.pict_type = PictureType.NONE
+                for packet in self.stream.encode(frame):
+                    self._keyframes.append(packet.is_keyframe)
+                    self.container.mux(packet)
+            fragments.extend(self.fragments())
+        return fragments
+
+    def fragments(self):
+        completed = []
+        for kind, box in self.output.boxes():
+            if kind in (b'ftyp', b'moov'):
+                self.init_segment += box
+            elif kind == b'moof':
+                self._moof = box
+            elif kind == b'mdat' and self._moof is not None:
+                completed.append((self._moof + box, self._keyframes.popleft() if self._keyframes else False))
+                self._moof = None
+        return completed
+
+    def close(self):
+        try:
+            self.container.close()
+        except Exception:
+            pass
+
+
+class VideoEncoder:
+    """
+    Encodes the frames of one stream once and fans the fragments out to every viewer.
+    next_jpeg(after_seq, timeout) returns (seq, timestamp, jpeg) of a newer frame or None.
+    """
+    def __init__(self, name, next_jpeg, config=None):
+        self.name = name
+        self.next_jpeg = next_jpeg
+        self.config = config or get_config()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._viewers = 0
+        self._last_viewer = time.monotonic()
+        # Output of the running session: init segment and the fragments since the latest keyframe
+        self._session_id = 0
+        self._init_segment = None
+        self._fragments = []
+        self._index = 0
+
+    def add_viewer(self):
+        with self._condition:
+            self._viewers += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"video-{self.name}", daemon=True)
+                self._thread.start()
+
+    def remove_viewer(self):
+        with self._condition:
+            self._viewers -= 1
+            self._last_viewer = time.monotonic()
+
+    def is_idle(self):
+        return self._viewers <= 0 and time.monotonic() - self._last_viewer > self.config['IDLE_TIMEOUT']
+
+    def _run(self):
+        session = None
+        last_seq = 0
+        try:
+            while True:
+                with self._condition:
+                    if self.is_idle():
+                        self._thread = None
+                        self._init_segment = None
+                        self._fragments = []
+                        return
+                item = self.next_jpeg(last_seq, 1.0)
+                if item is None:
+                    continue
+                last_seq, timestamp, jpeg = item
+                try:
+                    if session is None:
+                        session = self.start_session(jpeg)
+                    fragments = session.encode(jpeg, timestamp)
+                except Exception as e:
+                    print(f"Error encoding video {self.name}: {e}")
+                    if session is not None:
+                        session.close()
+                    session = None
+                    time.sleep(0.1)
+                    continue
+                if fragments:
+                    self.publish(session, fragments)
+                metrics.mark_frame('video')
+        finally:
+            if session is not None:
+                session.close()
+
+    def start_session(self, jpeg):
+        width, height = jpeg_size(jpeg)
+        with self._condition:
+            self._session_id += 1
+            self._init_segment = None
+            self._fragments = []
+        return H264Session(width, height, self.config)
+
+    def publish(self, session, fragments):
+        with self._condition:
+            self._init_segment = session.init_segment
+            for data, keyframe in fragments:
+                self._index += 1
+                if keyframe:
+                    # Viewers that are further behind skip ahead to this keyframe
+                    self._fragments = []
+                if keyframe or self._fragments:
+                    self._fragments.append((self._index, data))
+            self._condition.notify_all()
+
+    def stream(self):
+        """Generator of the fragmented MP4 bytes for one viewer"""
+        self.add_viewer()
+        try:
+            with metrics.track_viewer('video-stream'):
+                session_id = None
+                cursor = 0
+                while True:
+                    with self._condition:
+                        self._condition.wait_for(lambda: self._init_segment is not None and self._fragments and (
+                            session_id != self._session_id or self._fragments[-1][0] > cursor), timeout=1.0)
+                        if self._init_segment is None or not self._fragments:
+                            continue
+                        if session_id is None:
+                            session_id = self._session_id
+                            pending = [self._init_segment] + [data for _, data in self._fragments]
+                        elif session_id != self._session_id:
+                            # The encoder restarted, the client reconnects for the new init segment
+                            return
+                        else:
+                            if self._fragments[0][0] > cursor + 1:
+                                metrics.inc('frames_dropped_total', self._fragments[0][0] - cursor - 1, path='video-stream')
+                            pending = [data for index, data in self._fragments if index > cursor]
+                        cursor = self._fragments[-1][0]
+                    if not pending:
+                        continue
+                    data = b''.join(pending)
+                    with metrics.span('video-stream', 'send'):
+                        yield data
+                    metrics.inc('stream_bytes_total', len(data), path='video-stream')
+                    metrics.mark_frame('video-stream')
+        finally:
+            self.remove_viewer()
+
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+def raw_frames(source):
+    def next_jpeg(after_seq, timeout):
+        frame = source.wait_for_frame(after_seq, timeout=timeout)
+        return None if frame is None else (frame.seq, frame.timestamp, frame.jpeg)
+    return next_jpeg
+
+
+def detection_frames(pipeline):
+    def next_jpeg(after_seq, timeout):
+        result = pipeline.wait_for_result(after_seq, timeout=timeout, annotated=True)
+        return None if result is None else (result.seq, result.timestamp, result.annotated_jpeg())
+    return next_jpeg
+
+
+def get_video_encoder(kind, source_name):
+    """Shared encoder of the 'raw' or 'detection' frames of a frame source, raises KeyError for unknown sources"""
+    import av  # noqa: F401, fail before a viewer subscribes
+
+    with _encoders_lock:
+        encoder = _encoders.get((kind, source_name))
+        if encoder is None:
+            if kind == 'detection':
+                from stream_api.detection_pipeline import get_detection_pipeline
+                next_jpeg = detection_frames(get_detection_pipeline(source_name))
+            else:
+                from stream_api.frames import get_frame_source
+                next_jpeg = raw_frames(get_frame_source(source_name))
+            encoder = _encoders[(kind, source_name)] = VideoEncoder(f"{kind}-{source_name}", next_jpeg)
+        return encoder
@@ -4,23 +4,35 @@ from django.http import Http404
 
 from rest_framework.decorators import api_view
 from rest_framework.views import APIView
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
 
-from io import BytesIO
+import json
 import os
 import time
+from functools import lru_cache
 
-from ultralytics import YOLO
-import cv2
-import numpy as np
-from PIL import Image
+from stream_api import metrics, profiling
+from stream_api.admission import admit_stream, get_config as get_admission_config, get_gate, shed, stream_class
+from stream_api.frames import DEFAULT_SOURCE, get_frame_source
+from stream_api.jpeg import jpeg_size
 
-from stream_api.models import PersonDetectionModel
+# The vision stack (cv2, numpy, ONNX Runtime / torch) is only imported by the views that
+# need it, so manage.py commands and the CRUD endpoints start without it
 
+# Serve the placeholder frame when no new frame arrived for this long
+FRAME_TIMEOUT = 2.0
+# Send the placeholder again after this long while there are still no frames
+PLACEHOLDER_INTERVAL = 10.0
 
-# Load the model once
-detection_model = YOLO("best.pt")
+
+def read_jpeg(path):
+    """Bytes of a JPEG file, checked through its header, raises ValueError when it is not a JPEG"""
+    with open(path, "rb") as f:
+        data = f.read()
+    jpeg_size(data)
+    return data
 
 class SimpleImageView(APIView):
     """
@@ -55,196 +67,289 @@ class SimpleImageView(APIView):
             )
 
 
+def get_stream_scale(request):
+    """Reduction of the streamed frames from ?scale=1|2|4|8, None when it is not one of those"""
+    scale = request.query_params.get('scale', '1')
+    return int(scale) if scale in ('1', '2', '4', '8') else None
+
+
+def invalid_scale_response():
+    return Response({"error": "scale must be 1, 2, 4 or 8"}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def get_source(request):
+    """Frame source named by ?source=, the drone feed by default"""
+    try:
+        return get_frame_source(request.query_params.get('source', DEFAULT_SOURCE))
+    except KeyError:
+        raise Http404("Unknown frame source")
+
+
+def get_source_pipeline(request):
+    """Detection pipeline of the frame source named by ?source=, the drone feed by default"""
+    from stream_api.detection_pipeline import get_detection_pipeline
+
+    try:
+        return get_detection_pipeline(request.query_params.get('source', DEFAULT_SOURCE))
+    except KeyError:
+        raise Http404("Unknown frame source")
+
+
+@lru_cache(maxsize=1)
+def placeholder_jpeg():
+    return read_jpeg("placeholder.jpg")
+
+
+def placeholder_part(state):
+    """Multipart part of the placeholder frame, tagged with the state of the source"""
+    try:
+        img_bytes = placeholder_jpeg()
+    except (OSError, ValueError) as e:
+        print(f"Fallback image error: {e}")
+        # Empty frame if the placeholder is missing too
+        img_bytes = b''
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n'
+            b'X-Source-State: ' + state.encode() + b'\r\n\r\n' + img_bytes + b'\r\n')
+
+
+class PlaceholderSchedule:
+    """
+    When a stream has no new frame to send: the placeholder is sent once when the source
+    state changes (stale, not_found, or waiting for detections) and then every
+    PLACEHOLDER_INTERVAL to keep the connection open, not with every timeout
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sent_state = None
+        self.sent_at = 0.0
+
+    def state(self):
+        if self.source.stale:
+            return 'stale'
+        return 'not_found' if self.source.latest() is None else 'waiting'
+
+    def due(self):
+        """State to send the placeholder for, or None when it is not due"""
+        state = self.state()
+        if state != self.sent_state or time.monotonic() - self.sent_at >= PLACEHOLDER_INTERVAL:
+            self.sent_state = state
+            self.sent_at = time.monotonic()
+            return state
+        return None
+
+    def frame_sent(self):
+        self.sent_state = None
+
+
+def video_response(request, kind):
+    """Fragmented MP4 of the shared H.264 encoder of a stream, see stream_api/video.py"""
+    try:
+        from stream_api.video import CONTENT_TYPE, get_video_encoder
+        encoder = get_video_encoder(kind, request.query_params.get('source', DEFAULT_SOURCE))
+    except ImportError:
+        return Response({"error": "H.264 output needs PyAV"}, status=status.HTTP_400_BAD_REQUEST)
+    except KeyError:
+        raise Http404("Unknown frame source")
+    response = StreamingHttpResponse(encoder.stream(), content_type=CONTENT_TYPE)
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def admitted_stream(ticket, build):
+    """Hold ticket while the streaming response of build() is sent, error responses release it right away"""
+    try:
+        response = build()
+    except BaseException:
+        ticket.release()
+        raise
+    if not response.streaming:
+        ticket.release()
+        return response
+    return admit_stream(response, ticket)
+
+
 #======== STREAM VIEWS ========================================================================================================
 class DetectionStreamView(APIView):
     """
-    API View that streams fine-tuned YOLO detection frames in multipart format
+    API View that streams fine-tuned YOLO detection frames in multipart format,
+    drawn at 1/2, 1/4 or 1/8 size with ?scale=, or as H.264 in fragmented MP4 with ?format=mp4
     """
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.current_model = None
-        self.current_model_id = None
-        self.current_confidence = 0.5
-        
-    def get_selected_model(self):
-        """Get the currently selected model from database"""
-        models = PersonDetectionModel.objects.all()
-        
-        # Find the model with is_selected=True
-        for model in models:
-            if model.is_selected:
-                return model
-        
-        # If no model is selected, return default (ID=2)
-        return PersonDetectionModel.objects.get(id=2)
-    
-    def get_model_path(self, model_type):
-        """Map model type to file path"""
-        model_paths = {
-            'Top View': 'ai_models/top_view/best.pt',
-            'Front/Side View': 'ai_models/front_side_view/best.pt',
-            'Angled View': 'ai_models/angled_view/best.pt'
-        }
-        return model_paths.get(model_type, 'ai_models/front_side_view/best.pt')
-    
-    def load_detection_model(self):
-        """Load the selected detection model"""
-        selected_model = self.get_selected_model()
-        
-        # Check if we need to reload the model
-        if (self.current_model is None or self.current_model_id != selected_model.id):
-            model_path = self.get_model_path(selected_model.model_type)
-            
-            if os.path.exists(model_path):
-                print(f"Loading model: {selected_model.model_type} from {model_path}")
-                self.current_model = YOLO(model_path)
-                self.current_model_id = selected_model.id
-                self.current_confidence = selected_model.confidence
-                print(f"Model loaded successfully with confidence: {self.current_confidence}")
-            else:
-                print(f"Model file not found: {model_path}")
-                # Fallback to default model
-                fallback_path = 'ai_models/front_side_view/best.pt'
-                if os.path.exists(fallback_path):
-                    self.current_model = YOLO(fallback_path)
-                    self.current_model_id = selected_model.id
-                    self.current_confidence = selected_model.confidence
-                else:
-                    raise FileNotFoundError("No valid model files found")
-                
-        # Update confidence if it changed
-        if self.current_confidence != selected_model.confidence:
-            self.current_confidence = selected_model.confidence
-            print(f"Updated confidence to: {self.current_confidence}")
-
-        return self.current_model, self.current_confidence
-    
-
-    def get_detection_generator(self):
-        """Generator that yields YOLO-annotated frames at ~10 fps"""
-        while True:
-            try:
-                # Load/reload model if needed
-                detection_model, confidence = self.load_detection_model()
-                
-                if os.path.exists("image.jpg"):
-                    image = cv2.imread("image.jpg")
-                else:
-                    raise FileNotFoundError("image.jpg not found")
-                
-                # Use dynamic confidence from database
-                results = detection_model(image, conf=confidence)
-                annotated_frame = results[0].plot()
-                ret, jpeg = cv2.imencode('.jpg', annotated_frame)
-                
-                if not ret:
-                    raise Exception("Failed to encode image")
-                
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
-                time.sleep(0.1)  # ~10 FPS
-                
-            except Exception as e:
-                print(f"Error streaming image: {e}")
-                # Fallback to placeholder image
+    def get_detection_generator(self, pipeline, scale=1):
+        """Generator that yields the shared YOLO-annotated frames as they are detected, at 1/scale size"""
+        last_seq = 0
+        placeholder = PlaceholderSchedule(pipeline.source)
+        with metrics.track_viewer('detection-stream'):
+            while True:
                 try:
-                    with open("placeholder.jpg", "rb") as f:
-                        image_bytes = f.read()
-                    image = Image.open(BytesIO(image_bytes))
-                    img_io = BytesIO()
-                    image.save(img_io, 'JPEG')
-                    img_io.seek(0)
-                    img_bytes = img_io.read()
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + img_bytes + b'\r\n')
-                except Exception as fallback_error:
-                    print(f"Fallback image error: {fallback_error}")
-                    # Yield empty frame if both images fail
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + b'\r\n')
-                time.sleep(0.1)
+                    result = pipeline.wait_for_result(last_seq, timeout=FRAME_TIMEOUT, annotated=True)
+                    if result is None:
+                        state = placeholder.due()
+                        if state is not None:
+                            yield placeholder_part(state)
+                        continue
+                    if last_seq and result.seq > last_seq + 1:
+                        metrics.inc('frames_dropped_total', result.seq - last_seq - 1, path='detection-stream')
+                    last_seq = result.seq
+
+                    jpeg_bytes = result.annotated_jpeg(scale)
+                    with metrics.span('detection-stream', 'send'):
+                        # Clients send the seq back to capture exactly this frame
+                        yield (b'--frame\r\n'
+                               b'Content-Type: image/jpeg\r\n'
+                               b'X-Frame-Seq: %d\r\n\r\n' % result.seq + jpeg_bytes + b'\r\n')
+                    placeholder.frame_sent()
+                    metrics.inc('stream_bytes_total', len(jpeg_bytes), path='detection-stream')
+                    metrics.mark_frame('detection-stream')
+
+                except Exception as e:
+                    print(f"Error streaming image: {e}")
+                    yield placeholder_part('error')
+                    time.sleep(0.1)
     
     def get(self, request):
+        # Operators wait for a slot, passive viewers get the raw stream when the server is busy
+        request_class = stream_class(request.user)
+        gate = get_gate('vision')
+        ticket = gate.acquire(request_class, timeout=get_admission_config()['QUEUE_TIMEOUT'] if request_class == 'operator' else 0)
+        if ticket is None:
+            if request_class == 'operator':
+                return shed(gate, request_class)
+            metrics.inc('admission_degraded_total', gate=gate.name)
+            response = ImageStreamView().get(request)
+            response['X-Stream-Degraded'] = 'raw'
+            return response
+
+        return admitted_stream(ticket, lambda: self.stream_response(request))
+
+    def stream_response(self, request):
+        if request.query_params.get('format') == 'mp4':
+            return video_response(request, 'detection')
+        scale = get_stream_scale(request)
+        if scale is None:
+            return invalid_scale_response()
+        pipeline = get_source_pipeline(request)
         return StreamingHttpResponse(
-            self.get_detection_generator(),
+            self.get_detection_generator(pipeline, scale),
             content_type='multipart/x-mixed-replace; boundary=frame'
         )
-    
 
 
-class ImageStreamView(APIView):
+class DetectionMetadataStreamView(APIView):
     """
-    API View that streams images in multipart format for live camera feed
+    API View that streams the boxes of the shared detection results as Server-Sent Events,
+    so clients can draw the overlay themselves without the server plotting or encoding frames.
+    A 'source' event with the source status is sent first and whenever the source goes stale or live
     """
+    def get_metadata_generator(self, pipeline):
+        last_seq = 0
+        source = pipeline.source
+        sent_state = None
+        with metrics.track_viewer('detection-metadata-stream'):
+            while True:
+                state = source.status()
+                if state['status'] != sent_state:
+                    # The source went stale, came back, or this is the first event
+                    sent_state = state['status']
+                    data = json.dumps(state, separators=(',', ':'))
+                    yield f"event: source\ndata: {data}\n\n".encode()
+
+                result = pipeline.wait_for_result(last_seq, timeout=FRAME_TIMEOUT)
+                if result is None:
+                    # Keep the connection open while no frames arrive
+                    yield b': keep-alive\n\n'
+                    continue
+                if last_seq and result.seq > last_seq + 1:
+                    metrics.inc('frames_dropped_total', result.seq - last_seq - 1, path='detection-metadata-stream')
+                last_seq = result.seq
+
+                data = json.dumps(result.to_dict(), separators=(',', ':'))
+                with metrics.span('detection-metadata-stream', 'send'):
+                    yield f"id: {result.seq}\nevent: detection\ndata: {data}\n\n".encode()
+                metrics.mark_frame('detection-metadata-stream')
 
-    def get_image_generator(self):
-        SCALE_FACTOR = 0.25  # Adjust this to 0.3 or 0.25 if you want it even smaller
-
-        """Generator function that yields image frames"""
-        while True:
-            try:
-                # Try to read the main image
-                if os.path.exists("image.jpg"):
-                    with open("image.jpg", "rb") as f:
-                        image_bytes = f.read()
-                else:
-                    raise FileNotFoundError("image.jpg not found")
-
-                # Validate and process image
-                image = Image.open(BytesIO(image_bytes))
-
-
-                # Resize proportionally
-                # original_width, original_height = image.size
-                # new_width = int(original_width * SCALE_FACTOR)
-                # new_height = int(original_height * SCALE_FACTOR)
-                # image = image.resize((new_width, new_height))
-
+    def get(self, request):
+        # Cheap per viewer, but each one holds a worker thread and keeps the pipeline running
+        gate = get_gate('metadata')
+        ticket = gate.acquire('metadata')
+        if ticket is None:
+            return shed(gate, 'metadata')
+        return admitted_stream(ticket, lambda: self.stream_response(request))
+
+    def stream_response(self, request):
+        pipeline = get_source_pipeline(request)
+        response = StreamingHttpResponse(
+            self.get_metadata_generator(pipeline),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    
 
-                img_io = BytesIO()
-                image.save(img_io, 'JPEG')
-                img_io.seek(0)
-                img_bytes = img_io.read()
 
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + img_bytes + b'\r\n')
-                
-                # time.sleep(0.9)
+class ImageStreamView(APIView):
+    """
+    API View that streams the frames of a source (?source=, the drone feed by default) in
+    multipart format as they arrive, or as H.264 in fragmented MP4 with ?format=mp4.
+    While the source is stale, viewers get the placeholder frame tagged X-Source-State: stale.
+    """
 
-            except Exception as e:
-                print(f"Error streaming image: {e}")
-                # Fallback to placeholder image
+    def get_image_generator(self, source, scale=1):
+        """Generator that yields the frames of a source as they arrive, decoded at 1/scale and re-encoded when scale > 1"""
+        last_seq = 0
+        placeholder = PlaceholderSchedule(source)
+        with metrics.track_viewer('stream'):
+            while True:
                 try:
-                    with open("placeholder.jpg", "rb") as f:
-                        image_bytes = f.read()
-
-                    image = Image.open(BytesIO(image_bytes))
-
+                    # Returns early when the source goes stale, so viewers see it right away
+                    frame = source.wait_for_frame(last_seq, timeout=FRAME_TIMEOUT, state_version=source.state_version)
+                    if frame is None:
+                        state = placeholder.due()
+                        if state is not None:
+                            yield placeholder_part(state)
+                        continue
+                    if last_seq and frame.seq > last_seq + 1:
+                        metrics.inc('frames_dropped_total', frame.seq - last_seq - 1, path='stream')
+                    last_seq = frame.seq
+
+                    img_bytes = frame.jpeg
+                    if scale > 1:
+                        from stream_api import jpeg as jpeg_codec
+
+                        with metrics.span('stream', 'reencode'):
+                            img_bytes = jpeg_codec.encode(jpeg_codec.decode(img_bytes, scale))
+
+                    with metrics.span('stream', 'send'):
+                        yield (b'--frame\r\n'
+                               b'Content-Type: image/jpeg\r\n'
+                               b'X-Frame-Seq: %d\r\n\r\n' % frame.seq + img_bytes + b'\r\n')
+                    placeholder.frame_sent()
+                    metrics.inc('stream_bytes_total', len(img_bytes), path='stream')
+                    metrics.mark_frame('stream')
 
-                    # original_width, original_height = image.size
-                    # new_width = int(original_width * SCALE_FACTOR)
-                    # new_height = int(original_height * SCALE_FACTOR)
-                    # image = image.resize((new_width, new_height))
-
-                    img_io = BytesIO()
-                    image.save(img_io, 'JPEG')
-                    img_io.seek(0)
-                    img_bytes = img_io.read()
-
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + img_bytes + b'\r\n')
-                    
-                    # time.sleep(0.9)
-                except Exception as fallback_error:
-                    print(f"Fallback image error: {fallback_error}")
-                    # Yield empty frame if both images fail
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + b'\r\n')
+                except Exception as e:
+                    print(f"Error streaming image: {e}")
+                    yield placeholder_part('error')
+                    time.sleep(0.1)
 
     def get(self, request):
         """Stream images as multipart response"""
+        gate = get_gate('raw')
+        ticket = gate.acquire('raw')
+        if ticket is None:
+            return shed(gate, 'raw')
+        return admitted_stream(ticket, lambda: self.stream_response(request))
+
+    def stream_response(self, request):
+        if request.query_params.get('format') == 'mp4':
+            return video_response(request, 'raw')
+        scale = get_stream_scale(request)
+        if scale is None:
+            return invalid_scale_response()
+        source = get_source(request)
         response = StreamingHttpResponse(
-            self.get_image_generator(),
+            self.get_image_generator(source, scale),
             content_type='multipart/x-mixed-replace; boundary=frame'
         )
         return response
@@ -252,31 +357,73 @@ class ImageStreamView(APIView):
 
 class ImageStatusView(APIView):
     """
-    API View to check if image exists and get basic info
+    API View with the status of a frame source, read from the metadata recorded when its latest
+    frame arrived: size, dimensions, seq, age and fps. 'stale' when no frame arrived for a while
     """
 
     def get(self, request):
         """Get status of current image"""
-        try:
-            if os.path.exists("image.jpg"):
-                # Get file size
-                file_size = os.path.getsize("image.jpg")
+        source_status = get_source(request).status()
+        if source_status['status'] == 'not_found':
+            source_status['message'] = 'No image available'
+            return Response(source_status, status=status.HTTP_404_NOT_FOUND)
+        return Response(source_status)
 
-                # Try to get image dimensions
-                try:
-                    with open("image.jpg", "rb") as f:
-                        image = Image.open(f)
-                        width, height = image.size
-
-                    return Response({
-                        'status': 'available',
-                        'file_size': file_size,
-                        'dimensions': { 'width': width, 'height': height }
-                    })
-                except Exception as e:
-                    return Response({ 'status': 'invalid', 'file_size': file_size, 'error': str(e) })
-            else:
-                return Response({'status': 'not_found', 'message': 'No image available' }, status=status.HTTP_404_NOT_FOUND)
 
-        except Exception as e:
-            return Response({ 'status': 'error', 'message': str(e) }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+class MetricsView(APIView):
+    """
+    API View that exposes the vision pipeline metrics in the Prometheus text format
+    """
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ProfileView(APIView):
+    """
+    Admin only, profiles the process that serves the request (see stream_api/profiling.py).
+    POST {"duration": 10, "interval": 0.01, "trace_memory": true} starts a session, DELETE stops it early.
+    GET returns the state of the session, ?download=stacks its folded stacks for a flamegraph and
+    ?download=allocations the allocation sites that grew during it
+    """
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        try:
+            duration = float(request.data.get('duration', 10))
+            interval = request.data.get('interval')
+            interval = None if interval is None else float(interval)
+        except (TypeError, ValueError):
+            return Response({"error": "duration and interval must be numbers of seconds"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            session = profiling.start_session(duration, interval, bool(request.data.get('trace_memory', False)))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except RuntimeError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(session.to_dict(), status=status.HTTP_202_ACCEPTED)
+
+    def get(self, request):
+        session = profiling.get_session()
+        if session is None:
+            return Response({"error": "No profiling session yet"}, status=status.HTTP_404_NOT_FOUND)
+
+        download = request.query_params.get('download')
+        if download == 'stacks':
+            response = HttpResponse(session.folded(), content_type='text/plain; charset=utf-8')
+            response['Content-Disposition'] = f'attachment; filename="profile-{session.id}.folded"'
+            return response
+        if download == 'allocations':
+            if session.allocations is None:
+                return Response({"error": "The session traced no allocations or is still running"}, status=status.HTTP_404_NOT_FOUND)
+            return Response(session.allocations)
+        if download is not None:
+            return Response({"error": "download must be stacks or allocations"}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(session.to_dict())
+
+    def delete(self, request):
+        session = profiling.get_session()
+        if session is None:
+            return Response({"error": "No profiling session yet"}, status=status.HTTP_404_NOT_FOUND)
+        session.stop()
+        session.join(timeout=5.0)
+        return Response(session.to_dict())